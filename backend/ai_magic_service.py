@@ -1,55 +1,118 @@
 """
 AI Magic: формирует отчёт-консалтинг на основе документа и готовых анализов.
 Промпт загружается из docs/AI_MAGIC_PROMPT.md.
+Длинный документ не обрезается, а сжимается в заметки по частям (backend/chunking.py).
+Отчёт сохраняется в results (analysis_type="ai_magic") с ключом входных данных:
+аудитория, версия промпта, набор анализов и маршруты моделей. Повторный запрос с тем же ключом отдаёт
+сохранённый отчёт, новый анализ, изменённый промпт или маршруты дают новый ключ.
 """
 
+import hashlib
+import json
+import threading
 from pathlib import Path
 
-from backend.document_parser import extract_text
+from sqlalchemy import select
+
+from backend import llm_limiter, llm_router, metrics
+from backend.chunking import ProgressCallback, chunking_enabled, map_chunks, reduce_partials
 from backend.file_upload import get_document_file_path
 from backend.models import Document, Result
-from backend.openai_client import complete
+from backend.openai_client import acomplete, served_model
+from backend.prompts import get_notes_system_prompt
+from backend.text_cache import aget_text
 
 # Путь к мастер-промпту (от корня проекта)
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 PROMPT_PATH = PROJECT_ROOT / "docs" / "AI_MAGIC_PROMPT.md"
 
-# Лимиты длины для входа (укладываемся в лимит токенов OpenRouter)
+# Лимиты длины для входа (укладываемся в лимит токенов OpenRouter). Текст документа — не больше
+# MAX_DOCUMENT_CHARS, если контекст моделей маршрута неизвестен (llm_router.input_budget)
 MAX_DOCUMENT_CHARS = 4_000
 MAX_ANALYSIS_CHARS_PER_RESULT = 1_200
 
+# analysis_type сохранённых отчётов AI Magic (не входит в ANALYSIS_TYPES: это не вход, а итог)
+AI_MAGIC_TYPE = "ai_magic"
+
+_prompt_lock = threading.Lock()
+_prompt_cache: tuple[tuple[int, int], str, str] | None = None  # ((mtime_ns, size), текст, версия)
+
 
-def _load_prompt() -> str:
-    """Загружает текст промпта из docs/AI_MAGIC_PROMPT.md."""
-    if not PROMPT_PATH.exists():
+def _load_prompt() -> tuple[str, str]:
+    """
+    Загружает текст промпта из docs/AI_MAGIC_PROMPT.md и его версию (хеш содержимого).
+    Файл перечитывается, только если изменились время модификации или размер.
+    """
+    global _prompt_cache
+    try:
+        st = PROMPT_PATH.stat()
+    except FileNotFoundError:
         raise FileNotFoundError(f"Промпт не найден: {PROMPT_PATH}")
-    return PROMPT_PATH.read_text(encoding="utf-8").strip()
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _prompt_lock:
+        if _prompt_cache is not None and _prompt_cache[0] == stamp:
+            return _prompt_cache[1], _prompt_cache[2]
+    text = PROMPT_PATH.read_text(encoding="utf-8").strip()
+    version = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+    with _prompt_lock:
+        _prompt_cache = (stamp, text, version)
+    return text, version
+
 
+def _document_budget(overhead_chars: int, budget: int | None) -> int:
+    """Сколько символов документа помещается рядом с промптом и анализами (overhead_chars) в бюджет модели."""
+    return MAX_DOCUMENT_CHARS if budget is None else max(1_000, budget - overhead_chars)
 
-def _get_document_text(document: Document) -> str:
-    """Извлекает текст документа с ограничением длины. Если файла нет — возвращает пояснение."""
+
+async def _get_document_text(
+    document: Document, overhead_chars: int = 0, on_progress: ProgressCallback | None = None
+) -> tuple[str, int]:
+    """
+    Извлекает текст документа с ограничением длины. Если файла нет — возвращает пояснение.
+    overhead_chars — остальной вход запроса (промпт, анализы): ярус модели выбирается по полному размеру,
+    документ обрезается до её бюджета. Текст длиннее бюджета при включённом анализе по частям заменяется
+    сжатыми заметками по всему документу. Возвращает (текст для запроса, длина исходного текста).
+    """
     path = get_document_file_path(document)
     if not path.exists():
-        return "[Текст документа недоступен — файл не найден (например, после перезапуска сервера). Ниже приведены сохранённые анализы.]"
+        return "[Текст документа недоступен — файл не найден (например, после перезапуска сервера). Ниже приведены сохранённые анализы.]", 0
     try:
-        text = extract_text(str(path), document.filename).strip()
+        # Без анализа по частям достаточно начала документа — читаем файл только до наибольшего бюджета
+        max_chars = None
+        if not chunking_enabled():
+            max_chars = _document_budget(overhead_chars, llm_router.max_input_budget()) + 1
+        text = (await aget_text(path, document.filename, document.content_hash, max_chars)).strip()
     except (FileNotFoundError, OSError):
-        return "[Текст документа недоступен. Ниже приведены сохранённые анализы.]"
+        return "[Текст документа недоступен. Ниже приведены сохранённые анализы.]", 0
     if not text:
-        return "[Текст документа пуст или не извлечён.]"
-    if len(text) > MAX_DOCUMENT_CHARS:
-        text = text[:MAX_DOCUMENT_CHARS] + "\n\n[... документ обрезан ...]"
-    return text
-
-
-def _get_structured_analysis(document_id: int, db) -> str:
-    """Собирает тексты всех анализов по документу в один блок."""
-    results = (
-        db.query(Result)
-        .filter(Result.document_id == document_id)
-        .order_by(Result.created_at.desc())
-        .all()
+        return "[Текст документа пуст или не извлечён.]", 0
+    budget = llm_router.input_budget(overhead_chars + len(text))
+    limit = _document_budget(overhead_chars, budget)
+    if len(text) > limit:
+        if chunking_enabled():
+            notes_prompt = get_notes_system_prompt()
+            # Фрагменты — по бюджету модели, если он известен, иначе DOCMIND_CHUNK_CHARS
+            notes = await map_chunks(text, notes_prompt, limit if budget is not None else None, on_progress)
+            return await reduce_partials(notes, notes_prompt, limit, on_progress), len(text)
+        return text[:limit] + "\n\n[... документ обрезан ...]", len(text)
+    return text, len(text)
+
+
+async def _get_analysis_results(document_id: int, db) -> list[Result]:
+    """Сохранённые анализы документа (без отчётов AI Magic), новые первыми."""
+    return list(
+        (
+            await db.scalars(
+                select(Result)
+                .where(Result.document_id == document_id, Result.analysis_type != AI_MAGIC_TYPE)
+                .order_by(Result.created_at.desc(), Result.id.desc())
+            )
+        ).all()
     )
+
+
+def _format_structured_analysis(results: list[Result]) -> str:
+    """Собирает тексты анализов по документу в один блок."""
     if not results:
         return "[По документу пока нет сохранённых анализов. Сначала запустите анализ.]"
     parts = []
@@ -61,18 +124,73 @@ def _get_structured_analysis(document_id: int, db) -> str:
     return "\n\n".join(parts)
 
 
-def run_ai_magic(document_id: int, db, audience: str | None = None) -> str:
+def _input_key(document: Document, audience: str | None, prompt_version: str, result_ids: list[int]) -> str:
     """
-    Строит AI Magic отчёт: загружает промпт, документ и анализы, вызывает LLM.
-    audience: для кого отчёт (business, legal, manager, student) — влияет на тон.
+    Ключ входных данных отчёта: всё, от чего зависит ответ модели. Модели — маршруты AI Magic
+    (DOCMIND_LLM_ROUTES_AI_MAGIC / DOCMIND_LLM_ROUTES) и окна их контекста: смена маршрутов даёт новый отчёт.
+    Порядок внутри цепочки в ключ не входит — понижение медленной модели не сбрасывает отчёты.
     """
-    document = db.query(Document).filter(Document.id == document_id).first()
+    tiers = llm_router.routes(AI_MAGIC_TYPE)
+    windows = llm_router.context_windows()
+    payload = {
+        "document_id": document.id,
+        "content_hash": document.content_hash,
+        "audience": (audience or "").lower() or None,
+        "prompt": prompt_version,
+        "routes": [[limit, list(models)] for limit, models in tiers],
+        "context": {m: windows[m] for _, models in tiers for m in models if m in windows},
+        "results": sorted(result_ids),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+async def _load_inputs(document_id: int, db, audience: str | None):
+    """Документ, промпт, анализы и ключ входных данных — без извлечения текста и вызова LLM."""
+    document = await db.get(Document, document_id)
     if not document:
         raise ValueError(f"Документ с id={document_id} не найден")
+    llm_limiter.set_user(document.user_id)
+    system_prompt, prompt_version = _load_prompt()
+    results = await _get_analysis_results(document_id, db)
+    input_key = _input_key(document, audience, prompt_version, [r.id for r in results])
+    return document, system_prompt, results, input_key
 
-    system_prompt = _load_prompt()
-    doc_text = _get_document_text(document)
-    analysis_text = _get_structured_analysis(document_id, db)
+
+async def find_ai_magic_report(document_id: int, db, audience: str | None = None) -> tuple[Result | None, str]:
+    """
+    Ищет сохранённый отчёт для текущих входных данных.
+    Возвращает (Result или None, ключ входных данных).
+    """
+    _, _, _, input_key = await _load_inputs(document_id, db, audience)
+    report = await db.scalar(
+        select(Result)
+        .where(
+            Result.document_id == document_id,
+            Result.analysis_type == AI_MAGIC_TYPE,
+            Result.input_key == input_key,
+        )
+        .order_by(Result.id.desc())
+        .limit(1)
+    )
+    return report, input_key
+
+
+async def build_ai_magic_prompt(
+    document_id: int, db, audience: str | None = None, on_progress: ProgressCallback | None = None
+) -> tuple[str, str, str]:
+    """
+    Собирает (system_prompt, user_content, input_key) для AI Magic: промпт, документ и анализы.
+    audience: для кого отчёт (business, legal, manager, student) — влияет на тон.
+    on_progress — ход сжатия длинного документа по частям.
+    """
+    metrics.tag(analysis_type=AI_MAGIC_TYPE)
+    # Запросы сжатия документа маршрутизируются по своему размеру
+    llm_router.set_input_chars(None)
+    # Стадия prompt — загрузка и сборка входа; извлечение текста (extract) и запросы сжатия (llm) — свои стадии
+    with metrics.stage("prompt"):
+        document, system_prompt, results, input_key = await _load_inputs(document_id, db, audience)
+        analysis_text = _format_structured_analysis(results)
+    doc_text, doc_chars = await _get_document_text(document, len(system_prompt) + len(analysis_text), on_progress)
 
     user_content = (
         "Original document:\n\n"
@@ -89,5 +207,37 @@ def run_ai_magic(document_id: int, db, audience: str | None = None) -> str:
         }
         label = role_labels.get(audience.lower(), audience)
         user_content = user_content + f"\n\nОтчёт предназначен для аудитории: {label}. Учитывай это в тоне и формулировках."
+    # Итоговый запрос — в ярус по полному размеру документа, а не по обрезанному или сжатому тексту
+    llm_router.set_input_chars(len(user_content) - len(doc_text) + max(doc_chars, len(doc_text)))
+    return system_prompt, user_content, input_key
+
+
+async def save_ai_magic_report(
+    document_id: int, input_key: str, content: str, db, model: str | None = None
+) -> Result:
+    """Сохраняет отчёт AI Magic в results и коммитит сессию. model — модель, ответившая на запрос."""
+    result = Result(
+        document_id=document_id, analysis_type=AI_MAGIC_TYPE, content=content, input_key=input_key, model=model
+    )
+    db.add(result)
+    with metrics.stage("db_commit", analysis_type=AI_MAGIC_TYPE):
+        await db.commit()
+        await db.refresh(result)
+    return result
 
-    return complete(system_prompt, user_content)
+
+async def run_ai_magic(document_id: int, db, audience: str | None = None) -> tuple[Result, bool]:
+    """
+    Возвращает отчёт AI Magic: сохранённый (если входные данные не менялись) или новый.
+    Новый отчёт строится по промпту, документу и анализам и сохраняется в results.
+    db — AsyncSession.
+    audience: для кого отчёт (business, legal, manager, student) — влияет на тон.
+    Возвращает (Result, взят ли отчёт из сохранённых).
+    """
+    metrics.tag(analysis_type=AI_MAGIC_TYPE)
+    stored, _ = await find_ai_magic_report(document_id, db, audience)
+    if stored is not None:
+        return stored, True
+    system_prompt, user_content, input_key = await build_ai_magic_prompt(document_id, db, audience)
+    content = await acomplete(system_prompt, user_content)
+    return await save_ai_magic_report(document_id, input_key, content, db, model=served_model()), False
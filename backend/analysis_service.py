@@ -1,39 +1,191 @@
 """
 Сервис анализа документов: извлечение текста, вызов OpenAI, сохранение в results.
+Документы длиннее одного запроса анализируются по частям с последующим сведением (backend/chunking.py).
 """
 
-from backend.document_parser import extract_text
+import asyncio
+import os
+
+from backend import llm_limiter, llm_router, metrics
+from backend.chunking import ProgressCallback, chunking_enabled, map_chunks, needs_chunking, reduce_partials
 from backend.file_upload import get_document_file_path
 from backend.models import Document, Result
-from backend.openai_client import complete
-from backend.prompts import ANALYSIS_TYPES, get_system_prompt, get_user_content
+from backend.openai_client import acomplete, served_model
+from backend.prompts import (
+    ANALYSIS_TYPES,
+    MAX_USER_CONTENT_CHARS,
+    get_chunk_system_prompt,
+    get_reduce_system_prompt,
+    get_system_prompt,
+    get_user_content,
+)
+from backend.text_cache import aget_text
 
 
-def run_analysis(document_id: int, analysis_type: str, db, audience: str | None = None) -> Result:
-    """
-    Запускает анализ документа по типу, сохраняет результат в БД и возвращает его.
-    audience: для кого документ (business, legal, manager, student) — влияет на тон.
-    """
+def _batch_concurrency() -> int:
+    """Сколько LLM-запросов пакетного анализа выполняется одновременно. DOCMIND_BATCH_CONCURRENCY, по умолчанию 4."""
+    v = os.environ.get("DOCMIND_BATCH_CONCURRENCY")
+    if v is not None:
+        try:
+            return max(1, int(v))
+        except ValueError:
+            pass
+    return 4
+
+
+def _check_analysis_type(analysis_type: str) -> None:
     if analysis_type not in ANALYSIS_TYPES:
         raise ValueError(
             f"Неизвестный тип анализа: {analysis_type}. Допустимы: {list(ANALYSIS_TYPES)}"
         )
-    document = db.query(Document).filter(Document.id == document_id).first()
+
+
+async def _load_document_text(document_id: int, db, analysis_types: list[str]) -> str:
+    """
+    Находит документ и возвращает его текст (через кэш текста).
+    Без анализа по частям нужен только начальный фрагмент — файл читается лишь до наибольшего бюджета
+    моделей (для маршрутизации длиннее бюджета — всё равно последний ярус).
+    """
+    document = await db.get(Document, document_id)
     if not document:
         raise ValueError(f"Документ с id={document_id} не найден")
+    llm_limiter.set_user(document.user_id)
     path = get_document_file_path(document)
     if not path.exists():
         raise FileNotFoundError(f"Файл документа не найден: {path}")
-    text = extract_text(str(path), document.filename)
-    system_prompt = get_system_prompt(analysis_type, audience)
-    user_content = get_user_content(text)
-    content = complete(system_prompt, user_content)
+    max_chars = None
+    if not chunking_enabled():
+        budgets = [llm_router.max_input_budget(t) or 0 for t in analysis_types]
+        max_chars = max(MAX_USER_CONTENT_CHARS, *budgets) + 1
+    return await aget_text(path, document.filename, document.content_hash, max_chars)
+
+
+def _user_budget(system_prompt: str, text: str) -> int | None:
+    """Бюджет user-сообщения для модели, выбранной по полному размеру запроса; None — прежние лимиты."""
+    budget = llm_router.input_budget(len(system_prompt) + len(text))
+    return None if budget is None else max(1, budget - len(system_prompt))
+
+
+async def build_prompt(
+    text: str, analysis_type: str, audience: str | None = None, on_progress: ProgressCallback | None = None
+) -> tuple[str, str]:
+    """
+    Возвращает (system_prompt, user_content) итогового запроса.
+    Короткий текст — один запрос. Длинный — map по фрагментам, затем вход для сводящего запроса.
+    Бюджет обрезки и фрагментов — по модели, выбранной по размеру всего текста; итоговый запрос
+    маршрутизируется по нему же (llm_router.set_input_chars), а не по обрезанному или сведённому входу.
+    on_progress — ход анализа по частям (chunking.ProgressCallback).
+    Стадия prompt — только локальная сборка промпта; map/reduce-запросы учитываются стадией llm.
+    """
+    # Запросы по фрагментам маршрутизируются по своему размеру
+    llm_router.set_input_chars(None)
+    with metrics.stage("prompt"):
+        system_prompt = get_system_prompt(analysis_type, audience)
+        budget = _user_budget(system_prompt, text)
+        chunked = needs_chunking(text, budget)
+        if chunked:
+            chunk_prompt = get_chunk_system_prompt(analysis_type, audience)
+            reduce_prompt = get_reduce_system_prompt(analysis_type, audience)
+        else:
+            user_content = get_user_content(text, budget)
+    if chunked:
+        partials = await map_chunks(text, chunk_prompt, budget, on_progress)
+        system_prompt = reduce_prompt
+        user_content = await reduce_partials(partials, reduce_prompt, budget, on_progress)
+    llm_router.set_input_chars(len(text.strip()))
+    return system_prompt, user_content
+
+
+async def prepare_analysis(
+    document_id: int,
+    analysis_type: str,
+    db,
+    audience: str | None = None,
+    on_progress: ProgressCallback | None = None,
+) -> tuple[str, str]:
+    """
+    Проверяет тип и документ, возвращает (system_prompt, user_content) для LLM.
+    on_progress — ход анализа длинного документа по частям.
+    """
+    _check_analysis_type(analysis_type)
+    metrics.tag(analysis_type=analysis_type)
+    text = await _load_document_text(document_id, db, [analysis_type])
+    return await build_prompt(text, analysis_type, audience, on_progress)
+
+
+async def save_result(document_id: int, analysis_type: str, content: str, db, model: str | None = None) -> Result:
+    """Сохраняет результат анализа в БД и возвращает его. model — модель, ответившая на запрос."""
     result = Result(
         document_id=document_id,
         analysis_type=analysis_type,
         content=content,
+        model=model,
     )
     db.add(result)
-    db.commit()
-    db.refresh(result)
+    with metrics.stage("db_commit"):
+        await db.commit()
+        await db.refresh(result)
     return result
+
+
+async def run_analysis(document_id: int, analysis_type: str, db, audience: str | None = None) -> Result:
+    """
+    Запускает анализ документа по типу, сохраняет результат в БД и возвращает его.
+    db — AsyncSession. Извлечение текста выполняется в пуле потоков, запрос к LLM — асинхронно.
+    audience: для кого документ (business, legal, manager, student) — влияет на тон.
+    """
+    system_prompt, user_content = await prepare_analysis(document_id, analysis_type, db, audience)
+    content = await acomplete(system_prompt, user_content)
+    return await save_result(document_id, analysis_type, content, db, model=served_model())
+
+
+async def run_analyses(
+    document_id: int,
+    analysis_types: list[str],
+    db,
+    audience: str | None = None,
+    max_concurrency: int | None = None,
+) -> dict[str, Result | BaseException]:
+    """
+    Пакетный анализ: текст извлекается один раз, LLM-запросы по типам идут параллельно
+    (не более max_concurrency одновременно), все Result сохраняются одной транзакцией.
+    Возвращает {тип: Result или исключение} — ошибка одного типа не отменяет остальные.
+    """
+    types = list(dict.fromkeys(analysis_types))
+    if not types:
+        raise ValueError("Не указаны типы анализа")
+    for analysis_type in types:
+        _check_analysis_type(analysis_type)
+    text = await _load_document_text(document_id, db, types)
+
+    limit = min(max_concurrency or _batch_concurrency(), _batch_concurrency())
+    semaphore = asyncio.Semaphore(max(1, limit))
+
+    async def one(analysis_type: str) -> tuple[str, str | None]:
+        # Каждый тип — отдельная задача gather: метка типа анализа не видна соседним
+        metrics.tag(analysis_type=analysis_type)
+        async with semaphore:
+            system_prompt, user_content = await build_prompt(text, analysis_type, audience)
+            content = await acomplete(system_prompt, user_content)
+            # Модель из контекста задачи gather — вызывающему она не видна, возвращается вместе с ответом
+            return content, served_model()
+
+    contents = await asyncio.gather(*(one(t) for t in types), return_exceptions=True)
+
+    outcome: dict[str, Result | BaseException] = {}
+    saved = []
+    for analysis_type, value in zip(types, contents):
+        if isinstance(value, BaseException):
+            outcome[analysis_type] = value
+            continue
+        content, model = value
+        result = Result(document_id=document_id, analysis_type=analysis_type, content=content, model=model)
+        db.add(result)
+        saved.append(result)
+        outcome[analysis_type] = result
+    if saved:
+        with metrics.stage("db_commit", analysis_type="batch"):
+            await db.commit()
+            for result in saved:
+                await db.refresh(result)
+    return outcome
@@ -0,0 +1,172 @@
+"""
+Анализ длинных документов по частям (map-reduce).
+Текст режется по границам страниц/абзацев, фрагменты анализируются параллельно (ограниченно),
+затем частичные результаты сводятся (при необходимости в несколько уровней) в один вход для итогового запроса.
+"""
+
+import asyncio
+import os
+import re
+from collections.abc import Callable
+
+from backend.openai_client import acomplete
+from backend.prompts import MAX_USER_CONTENT_CHARS, get_chunk_user_content, get_partials_user_content
+
+
+def _env_int(name: str, default: int, minimum: int = 1) -> int:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(minimum, int(v))
+        except ValueError:
+            pass
+    return default
+
+
+def chunking_enabled() -> bool:
+    """Анализ по частям включён по умолчанию; DOCMIND_CHUNKED_ANALYSIS=0 — старое поведение (обрезка)."""
+    return os.environ.get("DOCMIND_CHUNKED_ANALYSIS", "1").strip().lower() not in ("0", "false", "no")
+
+
+def chunk_chars() -> int:
+    """Размер фрагмента в символах (~ лимит одного запроса). DOCMIND_CHUNK_CHARS."""
+    return _env_int("DOCMIND_CHUNK_CHARS", 6_000, 500)
+
+
+def chunk_concurrency() -> int:
+    """Сколько фрагментов одного документа анализируется одновременно. DOCMIND_CHUNK_CONCURRENCY."""
+    return _env_int("DOCMIND_CHUNK_CONCURRENCY", 4)
+
+
+def max_chunks() -> int:
+    """Предел числа фрагментов на документ (защита от очень дорогих запросов). DOCMIND_MAX_CHUNKS."""
+    return _env_int("DOCMIND_MAX_CHUNKS", 30)
+
+
+# Границы по убыванию приоритета: разрыв страницы, пустая строка (абзац), перевод строки, конец предложения
+_SEPARATORS = (re.compile(r"\f"), re.compile(r"\n\s*\n"), re.compile(r"\n"), re.compile(r"(?<=[.!?…])\s+"))
+
+
+def _split_piece(piece: str, max_chars: int, level: int) -> list[str]:
+    """Делит кусок, который длиннее max_chars, по границе следующего уровня (в крайнем случае — жёстко)."""
+    if len(piece) <= max_chars:
+        return [piece]
+    if level >= len(_SEPARATORS):
+        return [piece[i:i + max_chars] for i in range(0, len(piece), max_chars)]
+    parts = [p for p in _SEPARATORS[level].split(piece) if p.strip()]
+    if len(parts) <= 1:
+        return _split_piece(piece, max_chars, level + 1)
+    result = []
+    for part in parts:
+        result.extend(_split_piece(part, max_chars, level + 1))
+    return result
+
+
+def split_text(text: str, max_chars: int | None = None) -> list[str]:
+    """
+    Делит текст на фрагменты не длиннее max_chars, по возможности по границам страниц и абзацев.
+    Соседние мелкие куски склеиваются, чтобы фрагментов было как можно меньше.
+    """
+    max_chars = max_chars or chunk_chars()
+    text = (text or "").strip()
+    if not text:
+        return []
+    pieces = _split_piece(text, max_chars, 0)
+    chunks: list[str] = []
+    current = ""
+    for piece in pieces:
+        piece = piece.strip()
+        if not piece:
+            continue
+        candidate = f"{current}\n\n{piece}" if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+        else:
+            chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def needs_chunking(text: str, max_chars: int | None = None) -> bool:
+    """
+    Текст не помещается в один запрос и анализ по частям включён. max_chars — бюджет user-сообщения
+    модели (llm_router.input_budget), по умолчанию — меньший из DOCMIND_CHUNK_CHARS и MAX_USER_CONTENT_CHARS.
+    """
+    limit = max_chars or min(chunk_chars(), MAX_USER_CONTENT_CHARS)
+    return chunking_enabled() and len((text or "").strip()) > limit
+
+
+# on_progress(стадия, готово, всего) — ход анализа по частям (например, для событий SSE)
+ProgressCallback = Callable[[str, int, int], None]
+
+
+async def _gather_limited(
+    system_prompt: str, user_contents: list[str], on_progress: ProgressCallback | None = None, stage: str = "map"
+) -> list[str]:
+    semaphore = asyncio.Semaphore(chunk_concurrency())
+    total = len(user_contents)
+    completed = 0
+
+    async def one(user_content: str) -> str:
+        nonlocal completed
+        async with semaphore:
+            content = await acomplete(system_prompt, user_content)
+        completed += 1
+        if on_progress is not None:
+            on_progress(stage, completed, total)
+        return content
+
+    return list(await asyncio.gather(*(one(u) for u in user_contents)))
+
+
+async def map_chunks(
+    text: str, system_prompt: str, max_chars: int | None = None, on_progress: ProgressCallback | None = None
+) -> list[str]:
+    """
+    Map: анализирует фрагменты текста параллельно (не более chunk_concurrency одновременно).
+    max_chars — размер фрагмента (бюджет модели), по умолчанию DOCMIND_CHUNK_CHARS.
+    on_progress вызывается после каждого фрагмента (стадия map).
+    """
+    chunks = split_text(text, max_chars)
+    limit = max_chunks()
+    truncated = len(chunks) > limit
+    chunks = chunks[:limit]
+    total = len(chunks)
+    contents = [get_chunk_user_content(chunk, i + 1, total, truncated) for i, chunk in enumerate(chunks)]
+    return await _gather_limited(system_prompt, contents, on_progress)
+
+
+async def reduce_partials(
+    partials: list[str],
+    system_prompt: str,
+    max_chars: int | None = None,
+    on_progress: ProgressCallback | None = None,
+) -> str:
+    """
+    Готовит вход итогового запроса из частичных результатов, не длиннее max_chars.
+    Если всё вместе не помещается, группы частичных результатов сводятся промежуточными запросами
+    (тем же system_prompt), пока итог не уложится в лимит. on_progress — после каждого запроса (стадия reduce).
+    """
+    max_chars = max_chars or min(chunk_chars(), MAX_USER_CONTENT_CHARS)
+    partials = [p.strip() for p in partials if p and p.strip()]
+    joined = get_partials_user_content(partials)
+    while len(joined) > max_chars and len(partials) > 1:
+        groups: list[list[str]] = []
+        for partial in partials:
+            if groups and len(get_partials_user_content(groups[-1] + [partial])) <= max_chars:
+                groups[-1].append(partial)
+            else:
+                groups.append([partial])
+        if len(groups) == len(partials):
+            # Каждый результат сам по себе крупный — сводим попарно
+            groups = [partials[i:i + 2] for i in range(0, len(partials), 2)]
+        merged = await _gather_limited(
+            system_prompt, [get_partials_user_content(g) for g in groups], on_progress, "reduce"
+        )
+        partials = [p.strip() for p in merged if p and p.strip()]
+        joined = get_partials_user_content(partials)
+    if len(joined) > max_chars:
+        joined = joined[:max_chars] + "\n\n[... обрезано из-за лимита длины ...]"
+    return joined
@@ -1,33 +1,227 @@
 """
-Подключение к SQLite и настройка SQLAlchemy для DocMind.
+Подключение к БД и настройка SQLAlchemy для DocMind.
+URL и параметры пула задаются окружением (DATABASE_URL, DOCMIND_DB_POOL_*); по умолчанию — SQLite-файл
+backend/docmind.db. Работа с БД асинхронная (AsyncSession), для SQLite — драйвер aiosqlite.
 """
 
 import os
+import threading
+import time
 from pathlib import Path
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import event, inspect, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-# Файл БД рядом с backend (backend/docmind.db)
+# Файл БД по умолчанию рядом с backend (backend/docmind.db)
 BASE_DIR = Path(__file__).resolve().parent
 DB_PATH = BASE_DIR / "docmind.db"
-DATABASE_URL = f"sqlite:///{DB_PATH}"
 
-# check_same_thread=False нужен для использования сессий в FastAPI
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    echo=False,
-)
+# Синхронные схемы URL -> async-драйверы SQLAlchemy
+_ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+def _async_url(url: str) -> str:
+    """Подставляет async-драйвер, если в URL указана только СУБД (postgresql://… -> postgresql+asyncpg://…)."""
+    scheme, sep, rest = url.partition("://")
+    if "+" in scheme:
+        return url
+    return _ASYNC_DRIVERS.get(scheme, scheme) + sep + rest
+
+
+DATABASE_URL = _async_url(os.environ.get("DATABASE_URL") or f"sqlite:///{DB_PATH}")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+
+def _env_choice(name: str, default: str, allowed: tuple[str, ...]) -> str:
+    v = os.environ.get(name, "").strip().upper()
+    return v if v in allowed else default
+
+
+def _env_int(name: str, default: int) -> int:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return int(v)
+        except ValueError:
+            pass
+    return default
+
+
+def pool_options() -> dict:
+    """
+    Параметры пула соединений (переменные окружения, см. .env.example):
+    размер пула, допустимое превышение, ожидание свободного соединения и пересоздание старых соединений.
+    """
+    return {
+        "pool_size": max(1, _env_int("DOCMIND_DB_POOL_SIZE", 5)),
+        "max_overflow": max(0, _env_int("DOCMIND_DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": max(1, _env_int("DOCMIND_DB_POOL_TIMEOUT_SECONDS", 30)),
+        "pool_recycle": _env_int("DOCMIND_DB_POOL_RECYCLE_SECONDS", 1800),
+    }
+
+
+class _PoolMetrics:
+    """Счётчики выдачи соединений из пула: сколько раз и сколько ждали (в т.ч. открытие нового соединения)."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def observe(self, seconds: float, timed_out: bool) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+                "wait_seconds_avg": round(self.wait_seconds_total / self.checkouts, 6) if self.checkouts else 0.0,
+            }
+
+
+_pool_metrics = _PoolMetrics()
+
+
+class _TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Пул SQLAlchemy, замеряющий ожидание при выдаче соединения."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except PoolTimeoutError:
+            _pool_metrics.observe(time.perf_counter() - start, timed_out=True)
+            raise
+        _pool_metrics.observe(time.perf_counter() - start, timed_out=False)
+        return conn
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
 
+def _engine_options() -> dict:
+    options: dict = {"echo": False}
+    if IS_SQLITE and (":memory:" in DATABASE_URL or DATABASE_URL.rstrip("/").endswith(":")):
+        # SQLite в памяти: одно соединение на процесс, пул не настраивается
+        return options
+    options["poolclass"] = _TimedAsyncQueuePool
+    options.update(pool_options())
+    if not IS_SQLITE:
+        # Серверная СУБД может закрыть простаивающее соединение — проверяем перед выдачей
+        options["pool_pre_ping"] = True
+    return options
 
-def get_db():
-    """Генератор сессии БД для FastAPI Depends."""
-    db = SessionLocal()
+
+async_engine = create_async_engine(DATABASE_URL, **_engine_options())
+
+
+def sqlite_pragmas() -> dict[str, str | int]:
+    """
+    Профиль SQLite для каждого нового соединения (переменные окружения, см. .env.example):
+    - journal_mode=WAL — читатели не блокируют писателя и наоборот (режим сохраняется в файле БД);
+    - busy_timeout — сколько ждать блокировки вместо немедленной ошибки «database is locked»;
+    - synchronous=NORMAL — в WAL безопасно для целостности, fsync только при checkpoint;
+    - cache_size — отрицательное значение в КиБ (по умолчанию ~20 МиБ страничного кэша);
+    - temp_store=MEMORY — временные таблицы сортировок в памяти.
+    """
+    return {
+        "journal_mode": _env_choice("DOCMIND_SQLITE_JOURNAL_MODE", "WAL", ("WAL", "DELETE", "TRUNCATE", "PERSIST")),
+        "busy_timeout": max(0, _env_int("DOCMIND_SQLITE_BUSY_TIMEOUT_MS", 5_000)),
+        "synchronous": _env_choice("DOCMIND_SQLITE_SYNCHRONOUS", "NORMAL", ("OFF", "NORMAL", "FULL", "EXTRA")),
+        "cache_size": _env_int("DOCMIND_SQLITE_CACHE_SIZE", -20_000),
+        "temp_store": "MEMORY",
+    }
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record=None) -> None:
+    """Обработчик события connect: выставляет sqlite_pragmas() на новом соединении."""
+    cursor = dbapi_connection.cursor()
     try:
-        yield db
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f"PRAGMA {name}={value}")
     finally:
-        db.close()
+        cursor.close()
+
+
+if IS_SQLITE:
+    # Для async engine событие вешается на его синхронную обёртку (срабатывает для соединений aiosqlite)
+    event.listen(async_engine.sync_engine, "connect", apply_sqlite_pragmas)
+
+# expire_on_commit=False: после commit атрибуты не перечитываются неявно (в async это недопустимо)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+Base = declarative_base()
+
+
+async def get_db():
+    """Async-сессия БД для FastAPI Depends."""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def pool_stats() -> dict:
+    """Состояние пула соединений и время ожидания выдачи соединения (для отладки и метрик)."""
+    pool = async_engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+            idle=pool.checkedin(),
+            **pool_options(),
+        )
+        stats.update(_pool_metrics.stats())
+    return stats
+
+
+# Колонки, добавленные после первой версии схемы: (таблица, колонка, DDL-тип).
+# create_all создаёт только новые таблицы, поэтому в существующие БД колонки добавляем сами.
+_COLUMN_MIGRATIONS = [
+    ("documents", "content_hash", "VARCHAR(64)"),
+    ("results", "input_key", "VARCHAR(64)"),
+    ("results", "model", "VARCHAR(128)"),
+]
+
+
+def _migrate(conn) -> None:
+    insp = inspect(conn)
+    tables = set(insp.get_table_names())
+    for table, column, ddl in _COLUMN_MIGRATIONS:
+        if table not in tables:
+            continue
+        columns = {c["name"] for c in insp.get_columns(table)}
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    # Индексы из моделей (в т.ч. на добавленных колонках); существующие пропускаются
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=conn, checkfirst=True)
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("PRAGMA optimize"))
+
+
+async def init_db() -> None:
+    """
+    Создаёт таблицы и добавляет недостающие колонки и индексы в существующие.
+    Перевод существующей SQLite-БД в WAL происходит при первом соединении (apply_sqlite_pragmas);
+    после создания индексов обновляется статистика планировщика (PRAGMA optimize).
+    """
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate)
@@ -2,54 +2,364 @@
 Извлечение текста из документов: TXT, PDF, DOCX.
 """
 
+import codecs
+import io
+import mmap
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from pathlib import Path
+from threading import Lock
+from typing import NamedTuple
+from xml.etree.ElementTree import ParseError, iterparse
 
+# Версия логики извлечения. Увеличивайте при изменении парсеров — от неё зависит ключ кэша текста.
+PARSER_VERSION = "3"
 
-def extract_text(file_path: str, filename: str) -> str:
+
+def _env_int(name: str, default: int, minimum: int = 0) -> int:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(minimum, int(v))
+        except ValueError:
+            pass
+    return default
+
+
+def _pdf_workers() -> int:
+    """Процессов для параллельного извлечения больших PDF. DOCMIND_PDF_WORKERS (1 — без пула)."""
+    return _env_int("DOCMIND_PDF_WORKERS", min(4, os.cpu_count() or 1), 1)
+
+
+def _pdf_parallel_min_pages() -> int:
+    """С какого числа страниц PDF разбирается в пуле процессов. DOCMIND_PDF_PARALLEL_MIN_PAGES."""
+    return _env_int("DOCMIND_PDF_PARALLEL_MIN_PAGES", 64, 1)
+
+
+def check_pages(filename: str, pages: tuple[int, int] | None) -> None:
+    """
+    Проверяет диапазон страниц (первая, последняя) — с 1, включительно. Страницы есть только у PDF:
+    диапазон для другого формата или некорректный диапазон — ValueError.
+    """
+    if pages is None:
+        return
+    if Path(filename).suffix.lower() != ".pdf":
+        raise ValueError("Диапазон страниц поддерживается только для PDF")
+    _check_page_range(pages)
+
+
+def _check_page_range(pages: tuple[int, int]) -> None:
+    first, last = pages
+    if first < 1 or last < first:
+        raise ValueError(f"Некорректный диапазон страниц: {first}–{last}")
+
+
+def extract_text(
+    file_path: str,
+    filename: str,
+    max_chars: int | None = None,
+    pages: tuple[int, int] | None = None,
+) -> str:
     """
     Извлекает текст из файла по пути. Тип определяется по расширению filename.
     Поддерживаются: .txt, .pdf, .docx (без учёта регистра).
+    max_chars — бюджет символов (≈3–4 символа на токен): чтение прекращается, как только он набран,
+    результат обрезается до max_chars. pages — диапазон страниц PDF (см. check_pages).
+    Смещения страниц возвращает extract_pdf.
     """
     path = Path(file_path)
     if not path.exists():
         raise FileNotFoundError(f"Файл не найден: {file_path}")
+    check_pages(filename, pages)
 
     ext = Path(filename).suffix.lower()
 
     if ext == ".txt":
-        return _extract_txt(file_path)
-    if ext == ".pdf":
-        return _extract_pdf(file_path)
-    if ext == ".docx":
-        return _extract_docx(file_path)
+        text = _extract_txt(file_path, max_chars=max_chars)
+    elif ext == ".pdf":
+        return extract_pdf(file_path, max_chars=max_chars, pages=pages).text
+    elif ext == ".docx":
+        text = _extract_docx(file_path, max_chars=max_chars)
+    else:
+        raise ValueError(f"Неподдерживаемый формат: {ext}. Ожидается .txt, .pdf или .docx")
+    if max_chars is not None:
+        text = text[:max_chars]
+    return text
+
+
+# Сколько байт читается для определения кодировки и размер блока потокового декодирования
+_TXT_SAMPLE_BYTES = 64 * 1024
+_TXT_CHUNK_BYTES = 1024 * 1024
+
+# Кодировки-кандидаты для текста не в UTF-8 (наши пользователи — в основном русскоязычные)
+_TXT_LEGACY_ENCODINGS = ("cp1251", "koi8_r")
+
+
+def _txt_mmap_min_bytes() -> int:
+    """С какого размера TXT читается через mmap, а не блоками read(). DOCMIND_TXT_MMAP_MIN_BYTES."""
+    return _env_int("DOCMIND_TXT_MMAP_MIN_BYTES", 64 * 1024 * 1024, 0)
+
+
+def _detect_encoding(sample: bytes) -> str:
+    """
+    Определяет кодировку по началу файла: BOM, затем строгая проверка UTF-8,
+    затем выбор между cp1251 и koi8-r по доле строчных кириллических букв
+    (в обычном тексте их большинство, а при неверной кодировке буквы «переворачиваются» в заглавные).
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        # final=False: выборка может обрываться посреди многобайтового символа
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+
+    def lowercase_cyrillic(encoding: str) -> int:
+        text = sample.decode(encoding, errors="replace")
+        return sum(1 for ch in text if "а" <= ch <= "я" or ch == "ё")
+
+    return max(_TXT_LEGACY_ENCODINGS, key=lowercase_cyrillic)
+
+
+def _iter_txt_bytes(f, size: int):
+    """Блоки байт файла: для больших файлов — срезы mmap (без чтения файла в память целиком)."""
+    if size >= _txt_mmap_min_bytes() and size > 0:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos in range(0, size, _TXT_CHUNK_BYTES):
+                yield mm[pos:pos + _TXT_CHUNK_BYTES]
+        return
+    yield from iter(lambda: f.read(_TXT_CHUNK_BYTES), b"")
+
+
+def _extract_txt(file_path: str, max_chars: int | None = None) -> str:
+    """
+    Чтение TXT с определением кодировки (UTF-8/UTF-16 с BOM, UTF-8, cp1251, koi8-r).
+    Файл декодируется потоково блоками; с бюджетом max_chars чтение прекращается, как только он набран.
+    Переводы строк нормализуются к \\n, нераспознанные байты заменяются символом замены.
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        encoding = _detect_encoding(f.read(_TXT_SAMPLE_BYTES))
+        f.seek(0)
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(encoding)(errors="replace"), translate=True
+        )
+        parts: list[str] = []
+        total = 0
+        for block in _iter_txt_bytes(f, size):
+            text = decoder.decode(block)
+            parts.append(text)
+            total += len(text)
+            if max_chars is not None and total >= max_chars:
+                break
+        else:
+            parts.append(decoder.decode(b"", final=True))
+    return "".join(parts)
 
-    raise ValueError(f"Неподдерживаемый формат: {ext}. Ожидается .txt, .pdf или .docx")
 
+class PdfText(NamedTuple):
+    """Результат извлечения PDF: текст, смещения начала каждой прочитанной страницы в тексте и номер первой страницы."""
 
-def _extract_txt(file_path: str) -> str:
-    """Чтение TXT в UTF-8 с обработкой ошибок кодировки."""
-    with open(file_path, encoding="utf-8", errors="replace") as f:
-        return f.read()
+    text: str
+    page_offsets: list[int]
+    first_page: int  # с 1
+    page_count: int  # всего страниц в документе
 
 
-def _extract_pdf(file_path: str) -> str:
-    """Извлечение текста из PDF через PyMuPDF (fitz)."""
+_PAGE_SEPARATOR = "\n"
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    """Пул процессов создаётся один раз на процесс приложения (spawn — безопасно при потоках)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=_pdf_workers(), mp_context=get_context("spawn"))
+        return _pool
+
+
+def shutdown_extract_pool() -> None:
+    """Останавливает пул процессов извлечения PDF (при остановке приложения)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _extract_pdf_range(file_path: str, start: int, stop: int) -> list[str]:
+    """Тексты страниц [start, stop) — выполняется в процессе пула."""
     import fitz  # PyMuPDF
 
     doc = fitz.open(file_path)
     try:
-        parts = []
-        for page in doc:
-            parts.append(page.get_text())
-        return "\n".join(parts)
+        return [doc[i].get_text() for i in range(start, stop)]
     finally:
         doc.close()
 
 
-def _extract_docx(file_path: str) -> str:
-    """Извлечение текста из DOCX через python-docx."""
-    from docx import Document
+def _join_pages(page_texts: list[str]) -> tuple[str, list[int]]:
+    offsets = []
+    pos = 0
+    for t in page_texts:
+        offsets.append(pos)
+        pos += len(t) + len(_PAGE_SEPARATOR)
+    return _PAGE_SEPARATOR.join(page_texts), offsets
+
+
+def extract_pdf(
+    file_path: str,
+    max_chars: int | None = None,
+    pages: tuple[int, int] | None = None,
+) -> PdfText:
+    """
+    Извлечение текста из PDF через PyMuPDF (fitz) в одном из режимов:
+    - с бюджетом max_chars — страницы читаются по порядку, пока бюджет не набран;
+    - полный — большие PDF (от DOCMIND_PDF_PARALLEL_MIN_PAGES страниц) делятся на диапазоны
+      и разбираются в пуле процессов, остальные читаются последовательно.
+    pages — (первая, последняя) страница с 1 включительно; по умолчанию весь документ.
+    Диапазон за концом документа обрезается по последней странице.
+    """
+    import fitz  # PyMuPDF
+
+    if pages is not None:
+        _check_page_range(pages)
+    doc = fitz.open(file_path)
+    try:
+        page_count = doc.page_count
+        start, stop = 0, page_count
+        if pages is not None:
+            start = pages[0] - 1
+            stop = min(page_count, pages[1])
+        if start >= stop:
+            return PdfText("", [], start + 1, page_count)
+
+        workers = _pdf_workers()
+        if max_chars is None and workers > 1 and stop - start >= _pdf_parallel_min_pages():
+            # Полный режим: параллельно, документ в этом процессе больше не нужен
+            doc.close()
+            doc = None
+            step = -(-(stop - start) // workers)
+            ranges = [(s, min(s + step, stop)) for s in range(start, stop, step)]
+            pool = _get_pool()
+            futures = [pool.submit(_extract_pdf_range, file_path, s, e) for s, e in ranges]
+            page_texts = [t for f in futures for t in f.result()]
+        else:
+            page_texts = []
+            total = 0
+            for i in range(start, stop):
+                t = doc[i].get_text()
+                page_texts.append(t)
+                total += len(t) + len(_PAGE_SEPARATOR)
+                if max_chars is not None and total >= max_chars:
+                    break
+    finally:
+        if doc is not None:
+            doc.close()
+
+    text, offsets = _join_pages(page_texts)
+    if max_chars is not None:
+        text = text[:max_chars]
+    return PdfText(text, offsets, start + 1, page_count)
+
 
-    doc = Document(file_path)
-    parts = [p.text for p in doc.paragraphs]
+# Пространство имён WordprocessingML (word/document.xml)
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_DOCX_CELL_SEPARATOR = "\t"
+
+
+def _iter_docx_blocks(file_path: str):
+    """
+    Потоково обходит word/document.xml и выдаёт блоки текста в порядке документа:
+    абзацы и строки таблиц (ячейки через табуляцию; вложенные таблицы — внутри ячейки).
+    Содержимое надписей (w:txbxContent) пропускается, как и в python-docx.
+    Разобранные элементы сразу удаляются из дерева — память не растёт с размером документа.
+    """
+    paragraphs: list[list[str]] = []  # стек абзацев (части текста)
+    tables: list[list[list[list[str]]]] = []  # стек таблиц: строки -> ячейки -> абзацы
+    textbox_depth = 0
+    body = None
+
+    with zipfile.ZipFile(file_path) as zf, zf.open("word/document.xml") as f:
+        for event, elem in iterparse(f, events=("start", "end")):
+            tag = elem.tag
+            if event == "start":
+                if tag == _W + "txbxContent":
+                    textbox_depth += 1
+                elif textbox_depth:
+                    continue
+                elif tag == _W + "p":
+                    paragraphs.append([])
+                elif tag == _W + "tbl":
+                    tables.append([])
+                elif tag == _W + "tr" and tables:
+                    tables[-1].append([])
+                elif tag == _W + "tc" and tables and tables[-1]:
+                    tables[-1][-1].append([])
+                elif tag == _W + "body":
+                    body = elem
+                continue
+
+            if tag == _W + "txbxContent":
+                textbox_depth -= 1
+                continue
+            if textbox_depth:
+                continue
+            if paragraphs and tag == _W + "t":
+                paragraphs[-1].append(elem.text or "")
+            elif paragraphs and tag == _W + "tab":
+                paragraphs[-1].append("\t")
+            elif paragraphs and tag in (_W + "br", _W + "cr"):
+                paragraphs[-1].append("\n")
+            elif tag == _W + "p" and paragraphs:
+                text = "".join(paragraphs.pop())
+                if tables and tables[-1] and tables[-1][-1]:
+                    tables[-1][-1][-1].append(text)
+                elif not tables:
+                    yield text
+            elif tag == _W + "tr" and tables and tables[-1]:
+                if len(tables) == 1:
+                    # Строка таблицы верхнего уровня — отдельный блок (для раннего останова)
+                    row = tables[-1].pop()
+                    yield _DOCX_CELL_SEPARATOR.join(" ".join(p for p in cell if p) for cell in row)
+            elif tag == _W + "tbl" and tables:
+                rows = tables.pop()
+                if tables and tables[-1] and tables[-1][-1]:
+                    # Вложенная таблица становится текстом ячейки внешней
+                    tables[-1][-1][-1].append(
+                        "\n".join(
+                            _DOCX_CELL_SEPARATOR.join(" ".join(p for p in cell if p) for cell in row)
+                            for row in rows
+                        )
+                    )
+            else:
+                continue
+            if body is not None and not paragraphs and not tables:
+                # Блок верхнего уровня разобран — освобождаем уже обработанные элементы
+                body.clear()
+
+
+def _extract_docx(file_path: str, max_chars: int | None = None) -> str:
+    """
+    Извлечение текста из DOCX без python-docx: потоковый разбор word/document.xml.
+    Абзацы и строки таблиц — по строке; с бюджетом max_chars чтение прекращается, как только он набран.
+    """
+    parts: list[str] = []
+    total = 0
+    try:
+        for block in _iter_docx_blocks(file_path):
+            parts.append(block)
+            total += len(block) + 1
+            if max_chars is not None and total >= max_chars:
+                break
+    except (zipfile.BadZipFile, KeyError, ParseError) as e:
+        raise ValueError(f"Не удалось прочитать DOCX: {e}") from e
     return "\n".join(parts)
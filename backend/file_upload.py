@@ -1,18 +1,53 @@
 """
 Сохранение загруженных файлов на диск и запись в БД.
 Шаг 3.2: каталог загрузок, сохранение файла, связь с пользователем в БД.
+Файлы хранятся по SHA-256 содержимого (uploads/blobs/) с подсчётом ссылок.
 """
 
-import re
+import asyncio
+import hashlib
+import os
+import time
 import uuid
+from collections.abc import AsyncIterator
 from pathlib import Path
 
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+
+from backend import metrics
 from backend.database import BASE_DIR
-from backend.models import Document
+from backend.models import Blob, Document
 
 # Каталог для загрузок: backend/uploads/
 UPLOADS_DIR = BASE_DIR / "uploads"
 
+# Размер блока при потоковой загрузке
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Попыток создать Document при гонке с параллельной загрузкой или удалением того же содержимого
+_CREATE_ATTEMPTS = 3
+
+
+def max_upload_bytes() -> int:
+    """Максимальный размер загружаемого файла. DOCMIND_MAX_UPLOAD_BYTES, по умолчанию 50 МБ; 0 — без ограничения."""
+    v = os.environ.get("DOCMIND_MAX_UPLOAD_BYTES")
+    if v is not None:
+        try:
+            return max(0, int(v))
+        except ValueError:
+            pass
+    return 50 * 1024 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    """Загрузка превышает DOCMIND_MAX_UPLOAD_BYTES."""
+
+    def __init__(self, max_bytes: int) -> None:
+        super().__init__(f"Файл больше допустимого размера ({max_bytes // (1024 * 1024)} МБ)")
+        self.max_bytes = max_bytes
+
 
 def ensure_uploads_dir() -> Path:
     """Создаёт каталог uploads, если его нет. Возвращает путь к каталогу."""
@@ -20,39 +55,280 @@ def ensure_uploads_dir() -> Path:
     return UPLOADS_DIR
 
 
-def _sanitize_filename(name: str) -> str:
-    """Оставляет в имени файла только безопасные символы."""
-    name = re.sub(r"[^\w\s\-\.]", "", name)
-    return name.strip() or "document"
+def _blob_relpath(content_hash: str) -> str:
+    """Относительный путь blob от backend: uploads/blobs/ab/abcdef..."""
+    return f"uploads/blobs/{content_hash[:2]}/{content_hash}"
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    """Пишет во временный файл рядом и переносит на место через os.replace."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
 
+async def _acquire_blob(content_hash: str, size: int, db, place_file) -> tuple[Blob, Path | None]:
+    """
+    Находит blob по хешу и увеличивает счётчик ссылок; если его нет — создаёт запись.
+    place_file(path) — корутина, кладущая содержимое по пути blob. Для новой записи не вызывается,
+    если по пути уже лежит файл с тем же содержимым (повтор после гонки: временный файл уже перенесён);
+    для существующей — только если файла нет. Возвращает (blob, путь файла, положенного для новой записи,
+    или None). Коммит делает вызывающий код.
+    """
+    blob = await db.scalar(select(Blob).where(Blob.content_hash == content_hash))
+    if blob is None:
+        blob = Blob(
+            content_hash=content_hash,
+            file_path=_blob_relpath(content_hash),
+            size=size,
+            ref_count=1,
+        )
+        db.add(blob)
+        path = BASE_DIR / blob.file_path
+        if path.exists() and await asyncio.to_thread(_file_sha256, path) == content_hash:
+            return blob, None
+        await place_file(path)
+        return blob, path
+    # Атомарный инкремент на стороне БД
+    blob.ref_count = Blob.ref_count + 1
+    path = BASE_DIR / blob.file_path
+    if not path.exists():
+        # Файл потерян — записываем заново
+        await place_file(path)
+    return blob, None
+
+
+async def _discard_placed(path: Path, content_hash: str, db) -> None:
+    """Удаляет файл, положенный для несохранённого blob, если записи с этим хешем так и нет."""
+    try:
+        await db.rollback()
+        if await db.scalar(select(Blob.content_hash).where(Blob.content_hash == content_hash)) is not None:
+            # Blob успела создать параллельная загрузка — файл с тем же содержимым теперь её
+            return
+    except Exception:
+        return
+    path.unlink(missing_ok=True)
 
-def save_upload(
+
+async def _create_document(content_hash: str, size: int, filename: str, user_id: int, db, place_file) -> Document:
+    """
+    Создаёт Document, ссылающийся на blob. Повторяет при гонке: параллельная загрузка создала blob
+    (IntegrityError) или параллельное удаление убрало его между выборкой и инкрементом (StaleDataError).
+    Если транзакция с новым blob не сохранена, положенный для него файл удаляется.
+    """
+    placed = None
+    try:
+        for attempt in range(_CREATE_ATTEMPTS):
+            try:
+                blob, new_file = await _acquire_blob(content_hash, size, db, place_file)
+                placed = new_file or placed
+                doc = Document(
+                    user_id=user_id,
+                    filename=filename,
+                    file_path=blob.file_path,
+                    content_hash=content_hash,
+                )
+                db.add(doc)
+                await db.commit()
+                break
+            except (IntegrityError, StaleDataError):
+                await db.rollback()
+                if attempt == _CREATE_ATTEMPTS - 1:
+                    raise
+    except BaseException:
+        if placed is not None:
+            await _discard_placed(placed, content_hash, db)
+        raise
+    await db.refresh(doc)
+    return doc
+
+
+async def save_upload(
     file_content: bytes,
     filename: str,
     user_id: int,
     db,
 ) -> Document:
     """
-    Сохраняет загруженный файл на диск и создаёт запись Document в БД.
-    Имя файла на диске: uuid_оригинальное_имя для уникальности.
-    Возвращает созданный объект Document.
+    Сохраняет загруженный файл в контентно-адресуемое хранилище и создаёт запись Document в БД.
+    Одинаковое содержимое хранится на диске один раз (uploads/blobs/<sha256>), Document ссылается на blob.
+    db — AsyncSession. Возвращает созданный объект Document.
     """
     ensure_uploads_dir()
-    safe_name = _sanitize_filename(filename)
-    unique_name = f"{uuid.uuid4().hex}_{safe_name}"
-    file_path = UPLOADS_DIR / unique_name
-    file_path.write_bytes(file_content)
-    # В БД храним относительный путь от backend: uploads/имя
-    path_for_db = f"uploads/{unique_name}"
-    doc = Document(
-        user_id=user_id,
-        filename=filename,
-        file_path=path_for_db,
-    )
-    db.add(doc)
-    db.commit()
-    db.refresh(doc)
-    return doc
+    content_hash = hashlib.sha256(file_content).hexdigest()
+
+    async def place_file(path: Path) -> None:
+        await asyncio.to_thread(_write_atomic, path, file_content)
+
+    return await _create_document(content_hash, len(file_content), filename, user_id, db, place_file)
+
+
+class MultipartFileReader:
+    """
+    Потоковый разбор тела multipart/form-data: файл из поля field отдаётся блоками по мере приёма
+    из сети, без предварительной записи всего тела во временный файл (как делает request.form()).
+    Сначала read_filename() — дочитывает заголовки части с файлом, затем chunks() — содержимое.
+    Остальные поля формы пропускаются. Некорректное тело — ValueError.
+    """
+
+    def __init__(self, stream: AsyncIterator[bytes], content_type: str | None, field: str = "file") -> None:
+        try:
+            from python_multipart.multipart import MultipartParser, parse_options_header
+        except ImportError:  # python-multipart < 0.0.13
+            from multipart.multipart import MultipartParser, parse_options_header
+
+        self._parse_options_header = parse_options_header
+        ctype, params = parse_options_header(content_type or "")
+        boundary = params.get(b"boundary")
+        if ctype != b"multipart/form-data" or not boundary:
+            raise ValueError("Ожидается тело multipart/form-data")
+        self._stream = stream.__aiter__()
+        self._field = field.encode()
+        self.filename: str | None = None
+        self._headers: dict[bytes, bytes] = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._active = False
+        self._file_done = False
+        self._pending: list[bytes] = []
+        self._parser = MultipartParser(
+            boundary,
+            {
+                "on_part_begin": self._on_part_begin,
+                "on_header_field": self._on_header_field,
+                "on_header_value": self._on_header_value,
+                "on_header_end": self._on_header_end,
+                "on_headers_finished": self._on_headers_finished,
+                "on_part_data": self._on_part_data,
+                "on_part_end": self._on_part_end,
+            },
+        )
+
+    def _on_part_begin(self) -> None:
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = self._parse_options_header(self._headers.get(b"content-disposition", b""))
+        if self.filename is None and options.get(b"name") == self._field and b"filename" in options:
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+            self._active = True
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        if self._active:
+            self._pending.append(bytes(data[start:end]))
+
+    def _on_part_end(self) -> None:
+        if self._active:
+            self._active = False
+            self._file_done = True
+
+    async def _feed(self) -> bool:
+        """Передаёт парсеру следующий блок тела. False — тело закончилось."""
+        try:
+            chunk = await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._parser.finalize()
+            return False
+        if chunk:
+            self._parser.write(chunk)
+        return True
+
+    async def read_filename(self) -> str | None:
+        """Читает тело до заголовков части с файлом. None — поля с файлом в форме нет."""
+        while self.filename is None:
+            if not await self._feed():
+                break
+        return self.filename
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """
+        Содержимое файла блоками до UPLOAD_CHUNK_SIZE по мере приёма (мелкие сетевые блоки склеиваются);
+        обрыв тела до конца части — ValueError.
+        """
+        while True:
+            if self._pending and (self._file_done or sum(map(len, self._pending)) >= UPLOAD_CHUNK_SIZE):
+                data = b"".join(self._pending)
+                self._pending.clear()
+                yield data
+            if self._file_done:
+                return
+            if not await self._feed() and not self._file_done:
+                raise ValueError("Тело запроса оборвано до конца файла")
+
+
+def _move_into_place(tmp: Path, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp, path)
+
+
+async def save_upload_stream(
+    chunks: AsyncIterator[bytes],
+    filename: str,
+    user_id: int,
+    db,
+    max_bytes: int | None = None,
+) -> Document:
+    """
+    Потоковое сохранение загрузки: блоки пишутся во временный файл (uploads/tmp/), SHA-256 и размер
+    считаются на лету. При превышении max_bytes запись прерывается (UploadTooLargeError).
+    Готовый файл атомарно переносится в blob; если такое содержимое уже есть — временный файл удаляется.
+    В памяти одновременно держится только один блок.
+    """
+    max_bytes = max_upload_bytes() if max_bytes is None else max_bytes
+    metrics.tag(file_type=metrics.file_type(filename))
+    tmp_dir = ensure_uploads_dir() / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    tmp = tmp_dir / f"{uuid.uuid4().hex}.part"
+    h = hashlib.sha256()
+    size = 0
+    try:
+        start = time.perf_counter()
+        with metrics.stage("upload_save"):
+            f = await asyncio.to_thread(open, tmp, "wb")
+            try:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes and size > max_bytes:
+                        raise UploadTooLargeError(max_bytes)
+                    h.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+        # Скорость приёма тела (сеть + запись на диск), без транзакции в БД
+        metrics.record_upload(filename, size, time.perf_counter() - start)
+
+        async def place_file(path: Path) -> None:
+            await asyncio.to_thread(_move_into_place, tmp, path)
+
+        with metrics.stage("db_commit"):
+            return await _create_document(h.hexdigest(), size, filename, user_id, db, place_file)
+    finally:
+        # Дубликат, ошибка или превышение размера — временный файл больше не нужен
+        if tmp.exists():
+            tmp.unlink()
 
 
 def get_document_file_path(document: Document) -> Path:
@@ -60,11 +336,46 @@ def get_document_file_path(document: Document) -> Path:
     return BASE_DIR / document.file_path
 
 
-def delete_document_file(document: Document) -> None:
-    """Удаляет файл документа с диска. Не выбрасывает ошибку, если файла нет."""
+async def delete_document_file(document: Document, db) -> None:
+    """
+    Освобождает файл документа. Для blob уменьшает счётчик ссылок и удаляет файл,
+    только когда ссылок не осталось. Старые загрузки (без content_hash) удаляются сразу.
+    Коммитит сессию (AsyncSession). Не выбрасывает ошибку, если файла нет.
+    Файл переименовывается в «надгробие» до коммита удаления записи и удаляется после: blob с тем же
+    хешем, созданный параллельной загрузкой после коммита, пишет свой файл и уже не пострадает.
+    """
     path = get_document_file_path(document)
-    if path.exists():
+    if document.content_hash:
+        await db.execute(
+            update(Blob)
+            .where(Blob.content_hash == document.content_hash)
+            .values(ref_count=Blob.ref_count - 1)
+        )
+        row = (
+            await db.execute(
+                select(Blob.ref_count, Blob.file_path).where(Blob.content_hash == document.content_hash)
+            )
+        ).first()
+        if row is not None and row.ref_count > 0:
+            await db.commit()
+            return
+        if row is not None:
+            path = BASE_DIR / row.file_path
+            await db.execute(delete(Blob).where(Blob.content_hash == document.content_hash))
+    tombstone = path.with_name(f".{path.name}.{uuid.uuid4().hex}.deleted")
+    try:
+        os.replace(path, tombstone)
+    except OSError:
+        tombstone = None
+    try:
+        await db.commit()
+    except BaseException:
+        # Запись не удалена — возвращаем файл на место
+        if tombstone is not None:
+            os.replace(tombstone, path)
+        raise
+    if tombstone is not None:
         try:
-            path.unlink()
+            tombstone.unlink()
         except OSError:
             pass
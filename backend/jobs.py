@@ -0,0 +1,320 @@
+"""
+Фоновые задачи: анализ и AI Magic вне HTTP-запроса.
+Очередь — таблица jobs в БД (переживает перезапуск), воркеры — asyncio-задачи в процессе приложения
+или отдельный процесс: python -m backend.jobs (тогда в web-процессе DOCMIND_JOB_WORKERS=0).
+Аренда locked_until продлевается, пока задача выполняется; зависшие задачи (аренда истекла — воркер
+умер) возвращаются в очередь, пока не исчерпаны попытки.
+"""
+
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, update
+
+from backend import metrics
+from backend.ai_magic_service import run_ai_magic
+from backend.analysis_service import run_analysis
+from backend.database import AsyncSessionLocal
+from backend.llm_limiter import LLMOverloadedError
+from backend.models import Document, Job
+from backend.prompts import ANALYSIS_TYPES
+
+logger = logging.getLogger(__name__)
+
+JOB_KINDS = ("analysis", "ai_magic")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def _env_number(name: str, default: float, cast=float):
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, cast(v))
+        except ValueError:
+            pass
+    return default
+
+
+def worker_count() -> int:
+    """Число воркеров в процессе приложения. DOCMIND_JOB_WORKERS, 0 — не запускать."""
+    return _env_number("DOCMIND_JOB_WORKERS", 4, int)
+
+
+def _max_attempts() -> int:
+    return max(1, _env_number("DOCMIND_JOB_MAX_ATTEMPTS", 3, int))
+
+
+def _lease_seconds() -> float:
+    """Сколько задача может быть в running, прежде чем её сочтут зависшей."""
+    return _env_number("DOCMIND_JOB_LEASE_SECONDS", 300.0)
+
+
+def _poll_seconds() -> float:
+    return _env_number("DOCMIND_JOB_POLL_SECONDS", 1.0)
+
+
+def _max_defer_seconds() -> float:
+    """Сколько с постановки задача откладывается при перегрузке LLM без траты попытки."""
+    return _env_number("DOCMIND_JOB_MAX_DEFER_SECONDS", 3600.0)
+
+
+# Будит воркеры этого процесса сразу после постановки задачи (без ожидания опроса).
+# Создаётся в JobWorkerPool.start() — в цикле событий воркеров; без пула в процессе — None.
+_wakeup: asyncio.Event | None = None
+
+
+def _wake() -> None:
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def submit_job(
+    db,
+    kind: str,
+    document_id: int,
+    analysis_type: str | None = None,
+    audience: str | None = None,
+) -> Job:
+    """Проверяет параметры и ставит задачу в очередь. db — AsyncSession. Возвращает Job."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Неизвестный тип задачи: {kind}. Допустимы: {list(JOB_KINDS)}")
+    if kind == "analysis" and analysis_type not in ANALYSIS_TYPES:
+        raise ValueError(
+            f"Неизвестный тип анализа: {analysis_type}. Допустимы: {list(ANALYSIS_TYPES)}"
+        )
+    if await db.get(Document, document_id) is None:
+        raise ValueError(f"Документ с id={document_id} не найден")
+    job = Job(
+        kind=kind,
+        document_id=document_id,
+        analysis_type=analysis_type if kind == "analysis" else None,
+        audience=audience,
+        status=QUEUED,
+        attempts=0,
+    )
+    db.add(job)
+    await db.commit()
+    await db.refresh(job)
+    _wake()
+    return job
+
+
+async def _requeue_stuck(session) -> None:
+    """Возвращает в очередь running-задачи с истёкшей арендой; при исчерпании попыток — failed."""
+    now = datetime.utcnow()
+    stuck = (Job.status == RUNNING) & (Job.locked_until < now)
+    await session.execute(
+        update(Job)
+        .where(stuck, Job.attempts >= _max_attempts())
+        .values(status=FAILED, error="Превышено время выполнения задачи", finished_at=now, locked_until=None)
+    )
+    await session.execute(
+        update(Job).where(stuck, Job.attempts < _max_attempts()).values(status=QUEUED, locked_until=None)
+    )
+    await session.commit()
+
+
+async def _claim_next(session) -> int | None:
+    """
+    Атомарно переводит самую старую queued-задачу в running и возвращает её id.
+    Условие status='queued' в UPDATE защищает от двойного захвата несколькими воркерами.
+    Отложенные задачи (queued с locked_until в будущем — LLM был перегружен) ждут своего времени.
+    """
+    now = datetime.utcnow()
+    ready = (Job.status == QUEUED) & (Job.locked_until.is_(None) | (Job.locked_until <= now))
+    next_id = select(Job.id).where(ready).order_by(Job.id).limit(1).scalar_subquery()
+    job_id = await session.scalar(
+        update(Job)
+        .where(Job.id == next_id, Job.status == QUEUED)
+        .values(
+            status=RUNNING,
+            attempts=Job.attempts + 1,
+            started_at=now,
+            locked_until=now + timedelta(seconds=_lease_seconds()),
+        )
+        .returning(Job.id)
+    )
+    await session.commit()
+    return job_id
+
+
+def _owned(job_id: int, attempts: int):
+    """
+    Условие «задача всё ещё наша»: running и та же попытка, что была захвачена.
+    Если аренда истекла и задачу перезахватил другой воркер, старый воркер её не перезапишет.
+    """
+    return (Job.id == job_id) & (Job.status == RUNNING) & (Job.attempts == attempts)
+
+
+async def _renew_lease(job_id: int, attempts: int) -> None:
+    """Продлевает аренду, пока задача выполняется (каждую треть DOCMIND_JOB_LEASE_SECONDS)."""
+    lease = _lease_seconds()
+    while True:
+        await asyncio.sleep(max(1.0, lease / 3))
+        try:
+            async with AsyncSessionLocal() as session:
+                renewed = await session.execute(
+                    update(Job)
+                    .where(_owned(job_id, attempts))
+                    .values(locked_until=datetime.utcnow() + timedelta(seconds=lease))
+                )
+                await session.commit()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Не удалось продлить аренду задачи %s", job_id)
+            continue
+        if not renewed.rowcount:
+            logger.warning("Задача %s больше не принадлежит воркеру (аренда потеряна)", job_id)
+            return
+
+
+async def _finish(job_id: int, attempts: int, **values) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(Job)
+            .where(_owned(job_id, attempts))
+            .values(finished_at=datetime.utcnow(), locked_until=None, **values)
+        )
+        await session.commit()
+
+
+async def _execute(job_id: int) -> None:
+    """Выполняет задачу в собственной сессии и записывает итог."""
+    async with AsyncSessionLocal() as session:
+        job = await session.get(Job, job_id)
+        if job is None:
+            return
+        kind, attempts, created_at = job.kind, job.attempts, job.created_at
+        renewal = asyncio.create_task(_renew_lease(job_id, attempts))
+        try:
+            # Метки стадий в метриках: эндпоинт job:<тип>, свои для каждой задачи
+            with metrics.context(endpoint=f"job:{kind}"):
+                if kind == "analysis":
+                    result = await run_analysis(job.document_id, job.analysis_type, session, audience=job.audience)
+                    outcome = {"status": DONE, "result_id": result.id, "error": None}
+                else:
+                    report, _ = await run_ai_magic(job.document_id, session, audience=job.audience)
+                    outcome = {"status": DONE, "result_id": report.id, "report": report.content, "error": None}
+        except LLMOverloadedError as e:
+            # Очередь к LLM переполнена или автомат разомкнут (LLMUnavailableError) — задача не виновата:
+            # откладываем на retry_after без немедленного пробуждения воркеров. Первые
+            # DOCMIND_JOB_MAX_DEFER_SECONDS с постановки попытка не тратится, дальше тратится —
+            # при затянувшейся перегрузке задача завершится failed
+            now = datetime.utcnow()
+            free = created_at is not None and now - created_at < timedelta(seconds=_max_defer_seconds())
+            if not free and attempts >= _max_attempts():
+                outcome = {"status": FAILED, "error": str(e)[:1000]}
+            else:
+                async with AsyncSessionLocal() as retry_session:
+                    await retry_session.execute(
+                        update(Job)
+                        .where(_owned(job_id, attempts))
+                        .values(
+                            status=QUEUED,
+                            attempts=Job.attempts - 1 if free else Job.attempts,
+                            locked_until=now + timedelta(seconds=max(1, e.retry_after)),
+                            error=str(e)[:1000],
+                        )
+                    )
+                    await retry_session.commit()
+                return
+        except (ValueError, FileNotFoundError) as e:
+            # Ошибка входных данных (нет документа, ключа и т.п.) — повтор не поможет
+            outcome = {"status": FAILED, "error": str(e)}
+        except Exception as e:
+            logger.exception("Ошибка фоновой задачи %s", job_id)
+            if attempts < _max_attempts():
+                async with AsyncSessionLocal() as retry_session:
+                    await retry_session.execute(
+                        update(Job)
+                        .where(_owned(job_id, attempts))
+                        .values(status=QUEUED, locked_until=None, error=str(e)[:1000])
+                    )
+                    await retry_session.commit()
+                _wake()
+                return
+            outcome = {"status": FAILED, "error": str(e)[:1000]}
+        finally:
+            renewal.cancel()
+    await _finish(job_id, attempts, **outcome)
+
+
+async def _worker_loop(n: int, wakeup: asyncio.Event) -> None:
+    while True:
+        try:
+            async with AsyncSessionLocal() as session:
+                await _requeue_stuck(session)
+                job_id = await _claim_next(session)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Воркер %s: ошибка доступа к очереди", n)
+            job_id = None
+        if job_id is None:
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=_poll_seconds())
+            except asyncio.TimeoutError:
+                pass
+            continue
+        # Своя задача asyncio — своя копия контекста: переменные контекста, выставленные задачей
+        # (пользователь лимитера, размер входа для маршрутизации, метки метрик, модель ответа),
+        # не переходят к следующей задаче этого воркера
+        await asyncio.create_task(_execute(job_id))
+
+
+class JobWorkerPool:
+    """Набор asyncio-воркеров очереди задач. Запускается и останавливается в lifespan приложения."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        global _wakeup
+        _wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(_worker_loop(i, _wakeup)) for i in range(self.size)]
+
+    async def stop(self) -> None:
+        global _wakeup
+        # Прерванные задачи остаются в running и вернутся в очередь по истечении аренды
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        _wakeup = None
+
+
+async def queue_stats(db) -> dict:
+    """Число задач по статусам (для отладки)."""
+    rows = await db.execute(select(Job.status, func.count(Job.id)).group_by(Job.status))
+    stats = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+    for status, count in rows:
+        stats[status] = count
+    return stats
+
+
+async def _main() -> None:
+    """Отдельный процесс-воркер: python -m backend.jobs."""
+    from backend.database import init_db
+
+    logging.basicConfig(level=logging.INFO)
+    await init_db()
+    pool = JobWorkerPool(max(1, worker_count()))
+    pool.start()
+    logger.info("Запущено воркеров: %s", pool.size)
+    try:
+        await asyncio.gather(*pool._tasks)
+    finally:
+        await pool.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,167 @@
+"""
+Кэш ответов LLM в SQLite (backend/cache/llm_cache.db).
+Ключ — SHA-256 от (model, max_tokens, system prompt, user content); рядом с ответом хранится модель,
+которая его дала (при маршрутизации — не обязательно первая в цепочке).
+Включается через DOCMIND_LLM_CACHE=1; поддерживает TTL и вытеснение по суммарному размеру.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from backend.database import BASE_DIR
+
+CACHE_DB_PATH = BASE_DIR / "cache" / "llm_cache.db"
+
+_lock = threading.Lock()
+_initialized = False
+_counters = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "evictions": 0}
+
+
+def enabled() -> bool:
+    """Кэш включён, если DOCMIND_LLM_CACHE=1 (true/yes)."""
+    return os.environ.get("DOCMIND_LLM_CACHE", "").strip().lower() in ("1", "true", "yes")
+
+
+def _int_env(name: str, default: int) -> int:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, int(v))
+        except ValueError:
+            pass
+    return default
+
+
+def _ttl_seconds() -> int:
+    """Время жизни записи. 0 — без ограничения."""
+    return _int_env("DOCMIND_LLM_CACHE_TTL_SECONDS", 7 * 24 * 3600)
+
+
+def _max_bytes() -> int:
+    """Лимит суммарного размера ответов в кэше."""
+    return _int_env("DOCMIND_LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024)
+
+
+def make_key(model: str, max_tokens: int, system_prompt: str, user_content: str) -> str:
+    """Ключ кэша: SHA-256 от канонического JSON параметров запроса."""
+    payload = json.dumps([model, max_tokens, system_prompt, user_content], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    global _initialized
+    conn = sqlite3.connect(str(CACHE_DB_PATH), timeout=5)
+    if not _initialized:
+        with _lock:
+            if not _initialized:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    " key TEXT PRIMARY KEY,"
+                    " response TEXT NOT NULL,"
+                    " size INTEGER NOT NULL,"
+                    " created_at REAL NOT NULL,"
+                    " accessed_at REAL NOT NULL,"
+                    " model TEXT)"
+                )
+                # Кэш, созданный до колонки model: старые записи остаются, модель у них неизвестна
+                columns = {row[1] for row in conn.execute("PRAGMA table_info(llm_cache)")}
+                if "model" not in columns:
+                    conn.execute("ALTER TABLE llm_cache ADD COLUMN model TEXT")
+                conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)")
+                conn.commit()
+                _initialized = True
+    return conn
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _lock:
+        _counters[name] += n
+
+
+def get(key: str) -> tuple[str, str | None] | None:
+    """
+    Возвращает (ответ, модель, давшая ответ) или None. Модель None — запись старше колонки model.
+    Просроченные записи удаляются.
+    """
+    try:
+        CACHE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = _connect()
+    except (OSError, sqlite3.Error):
+        _count("misses")
+        return None
+    try:
+        row = conn.execute("SELECT response, created_at, model FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            _count("misses")
+            return None
+        response, created_at, model = row
+        now = time.time()
+        ttl = _ttl_seconds()
+        if ttl and now - created_at > ttl:
+            conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            conn.commit()
+            _count("expired")
+            _count("misses")
+            return None
+        conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        _count("hits")
+        return response, model
+    except sqlite3.Error:
+        _count("misses")
+        return None
+    finally:
+        conn.close()
+
+
+def put(key: str, response: str, model: str | None = None) -> None:
+    """
+    Сохраняет ответ вместе с моделью, которая его дала, и вытесняет давно не использованные записи
+    сверх лимита по размеру.
+    """
+    size = len(response.encode("utf-8"))
+    limit = _max_bytes()
+    if size > limit:
+        return
+    try:
+        CACHE_DB_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = _connect()
+    except (OSError, sqlite3.Error):
+        return
+    try:
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, response, size, created_at, accessed_at, model)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (key, response, size, now, now, model),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        evicted = 0
+        if total > limit:
+            rows = conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at ASC").fetchall()
+            for old_key, old_size in rows:
+                if total <= limit:
+                    break
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (old_key,))
+                total -= old_size
+                evicted += 1
+        conn.commit()
+        _count("stores")
+        if evicted:
+            _count("evictions", evicted)
+    except sqlite3.Error:
+        pass
+    finally:
+        conn.close()
+
+
+def cache_stats() -> dict:
+    """Счётчики попаданий/промахов с момента старта процесса."""
+    with _lock:
+        stats = dict(_counters)
+    stats["enabled"] = enabled()
+    return stats
@@ -0,0 +1,278 @@
+"""
+Общий ограничитель запросов к LLM: не больше N одновременных запросов и (опционально) R запросов в секунду
+на процесс, ожидающие — в ограниченной очереди с честной очередностью между пользователями.
+
+Свободный слот отдаётся пользователям по кругу: один пользователь с десятком запросов (пакетный анализ,
+анализ по частям) не задерживает остальных дольше, чем на один запрос каждого.
+Если очередь заполнена (в целом или у пользователя) — сразу LLMOverloadedError, если слот не дождались
+за DOCMIND_LLM_QUEUE_TIMEOUT_SECONDS — тоже; эндпоинты отвечают 429 с Retry-After.
+Пользователь берётся из контекста (set_user() при загрузке документа), без него — общий «anonymous».
+"""
+
+import asyncio
+import math
+import os
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from backend import metrics
+
+_ANONYMOUS = "anonymous"
+
+_user: ContextVar[str] = ContextVar("docmind_llm_user", default=_ANONYMOUS)
+
+
+class LLMOverloadedError(Exception):
+    """Очередь к LLM заполнена или ожидание слота истекло. retry_after — через сколько секунд повторить."""
+
+    status_code = 429
+
+    def __init__(self, reason: str, retry_after: int) -> None:
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(f"Сервис анализа перегружен ({reason}). Повторите через {retry_after} с.")
+
+
+def _env_number(name: str, default: float, cast=float):
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, cast(v))
+        except ValueError:
+            pass
+    return default
+
+
+def limiter_options() -> dict:
+    """
+    Параметры ограничителя (переменные окружения, см. .env.example):
+    одновременных запросов, запросов в секунду (0 — без ограничения) и допустимый всплеск,
+    размер очереди общий и на пользователя, максимальное ожидание в очереди.
+    """
+    return {
+        "max_concurrency": max(1, _env_number("DOCMIND_LLM_MAX_CONCURRENCY", 16, int)),
+        "rate_per_second": _env_number("DOCMIND_LLM_RATE_PER_SECOND", 0.0),
+        "burst": max(1, _env_number("DOCMIND_LLM_RATE_BURST", 10, int)),
+        "max_queue": _env_number("DOCMIND_LLM_QUEUE_SIZE", 200, int),
+        "max_user_queue": _env_number("DOCMIND_LLM_USER_QUEUE_SIZE", 40, int),
+        "queue_timeout": _env_number("DOCMIND_LLM_QUEUE_TIMEOUT_SECONDS", 60.0),
+    }
+
+
+def set_user(user_id) -> None:
+    """Запоминает пользователя текущего запроса/задачи для честного распределения слотов."""
+    _user.set(str(user_id) if user_id is not None else _ANONYMOUS)
+
+
+class _FairLimiter:
+    """Слоты и очередь одного event loop. Все методы вызываются из потока этого loop."""
+
+    def __init__(self, options: dict) -> None:
+        self.options = options
+        self.active = 0
+        self.queued = 0
+        self._queues: dict[str, deque] = {}
+        self._order: deque[str] = deque()  # пользователи с ожидающими, по кругу
+        self._tokens = float(options["burst"])
+        self._refilled_at = time.monotonic()
+        self._timer: asyncio.TimerHandle | None = None
+        # Средняя длительность запроса к LLM (EWMA) — для оценки Retry-After
+        self._call_seconds = 5.0
+        self.stats = {
+            "admitted": 0,
+            "rejected_queue_full": 0,
+            "rejected_user_queue_full": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    # --- ограничение частоты (token bucket) ---
+
+    def _take_token(self) -> bool:
+        rate = self.options["rate_per_second"]
+        if not rate:
+            return True
+        now = time.monotonic()
+        self._tokens = min(float(self.options["burst"]), self._tokens + (now - self._refilled_at) * rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        if self._timer is None:
+            delay = (1 - self._tokens) / rate
+            self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+        return False
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    # --- очередь ---
+
+    def retry_after(self) -> int:
+        """Оценка, через сколько секунд освободится место: очередь / пропускная способность."""
+        per_second = self.options["max_concurrency"] / max(self._call_seconds, 0.1)
+        if self.options["rate_per_second"]:
+            per_second = min(per_second, self.options["rate_per_second"])
+        return max(1, min(60, math.ceil((self.queued + 1) / per_second)))
+
+    def check_admission(self, user: str) -> None:
+        """Бросает LLMOverloadedError, если новый запрос этого пользователя не поместится в очередь."""
+        if self.active < self.options["max_concurrency"] and not self.queued:
+            return
+        if self.queued >= self.options["max_queue"]:
+            self.stats["rejected_queue_full"] += 1
+            raise LLMOverloadedError("очередь запросов заполнена", self.retry_after())
+        if len(self._queues.get(user, ())) >= self.options["max_user_queue"]:
+            self.stats["rejected_user_queue_full"] += 1
+            raise LLMOverloadedError("слишком много запросов пользователя в очереди", self.retry_after())
+
+    def _dispatch(self) -> None:
+        while self._order and self.active < self.options["max_concurrency"]:
+            if not self._take_token():
+                return
+            user = self._order.popleft()
+            queue = self._queues[user]
+            future = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self._order.append(user)
+            else:
+                del self._queues[user]
+            if future.done():
+                # Ожидающий отменён — жетон не потрачен
+                self._tokens += 1
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def _forget(self, user: str, future) -> None:
+        queue = self._queues.get(user)
+        if queue is None or future not in queue:
+            return
+        queue.remove(future)
+        self.queued -= 1
+        if not queue:
+            del self._queues[user]
+            self._order.remove(user)
+
+    def _observe_wait(self, seconds: float) -> None:
+        self.stats["admitted"] += 1
+        self.stats["wait_seconds_total"] += seconds
+        self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], seconds)
+
+    async def acquire(self, user: str) -> None:
+        if self.active < self.options["max_concurrency"] and not self.queued and self._take_token():
+            self.active += 1
+            self._observe_wait(0.0)
+            return
+        self.check_admission(user)
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user, deque()).append(future)
+        if len(self._queues[user]) == 1:
+            self._order.append(user)
+        self.queued += 1
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            with metrics.stage("llm_queue"):
+                # wait, а не wait_for: future не отменяется, если слот выдан одновременно с таймаутом
+                await asyncio.wait({future}, timeout=self.options["queue_timeout"] or None)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(None)
+            else:
+                future.cancel()
+                self._forget(user, future)
+            raise
+        if not future.done():
+            future.cancel()
+            self._forget(user, future)
+            self.stats["timeouts"] += 1
+            raise LLMOverloadedError("истекло ожидание в очереди", self.retry_after())
+        self._observe_wait(time.monotonic() - start)
+
+    def try_acquire(self) -> bool:
+        """Слот без ожидания: только если он свободен и никто не ждёт в очереди."""
+        if self.active < self.options["max_concurrency"] and not self.queued and self._take_token():
+            self.active += 1
+            return True
+        return False
+
+    def release(self, call_seconds: float | None) -> None:
+        self.active -= 1
+        if call_seconds is not None:
+            self._call_seconds = 0.8 * self._call_seconds + 0.2 * call_seconds
+        self._dispatch()
+
+    def snapshot(self) -> dict:
+        admitted = self.stats["admitted"]
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "users_waiting": len(self._order),
+            **self.stats,
+            "wait_seconds_avg": round(self.stats["wait_seconds_total"] / admitted, 6) if admitted else 0.0,
+            "call_seconds_ewma": round(self._call_seconds, 3),
+            **self.options,
+        }
+
+
+# Свой ограничитель на каждый event loop (приложение, отдельный процесс воркеров, тесты)
+_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _FairLimiter]" = weakref.WeakKeyDictionary()
+
+
+def _get_limiter() -> _FairLimiter:
+    loop = asyncio.get_running_loop()
+    limiter = _limiters.get(loop)
+    if limiter is None:
+        limiter = _limiters[loop] = _FairLimiter(limiter_options())
+    return limiter
+
+
+def check_admission() -> None:
+    """
+    Проверка до начала потокового ответа: если запрос к LLM сейчас не поместится в очередь —
+    LLMOverloadedError (эндпоинт успевает ответить 429 вместо SSE-события error).
+    """
+    _get_limiter().check_admission(_user.get())
+
+
+@asynccontextmanager
+async def limit():
+    """Слот для одного запроса к LLM (на всё время запроса, для потока — до его конца)."""
+    limiter = _get_limiter()
+    await limiter.acquire(_user.get())
+    start = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        limiter.release(None)
+        raise
+    else:
+        limiter.release(time.monotonic() - start)
+
+
+@asynccontextmanager
+async def try_limit():
+    """
+    Дополнительный слот без ожидания (дублирующий запрос, backend/llm_resilience.py): отдаёт True,
+    если слот был свободен, иначе False — очередь ради необязательного запроса не занимается.
+    """
+    limiter = _get_limiter()
+    acquired = limiter.try_acquire()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            limiter.release(None)
+
+
+def limiter_stats() -> dict:
+    """Состояние ограничителя текущего event loop: слоты, очередь, отказы и ожидание."""
+    return _get_limiter().snapshot()
@@ -0,0 +1,376 @@
+"""
+Устойчивость запросов к LLM: повторы при временных ошибках, дублирующий (hedged) запрос против
+«хвоста» задержек и автомат отключения (circuit breaker) модели, которая постоянно отвечает ошибками.
+
+Повторы: 429, 5xx, таймауты и ошибки соединения повторяются до DOCMIND_LLM_RETRIES раз с паузой
+«полный джиттер» — случайно от 0 до base·2^попытка (не больше DOCMIND_LLM_RETRY_MAX_SECONDS);
+Retry-After из ответа 429 соблюдается, слишком долгий — запрос не повторяется. Ошибки запроса
+(400, 401, 402 …) не повторяются. Повторы SDK openai отключены, чтобы попытки не умножались.
+Хедж: при DOCMIND_LLM_HEDGE_PERCENTILE (например, 95) запрос, не получивший ответа за этот перцентиль
+недавних задержек модели, дублируется — если у ограничителя есть свободный слот; берётся первый
+успешный ответ, второй запрос отменяется. Только для непотоковых запросов.
+Автомат: после DOCMIND_LLM_BREAKER_FAILURES временных ошибок подряд модель отключается на
+DOCMIND_LLM_BREAKER_RESET_SECONDS — запросы сразу получают LLMUnavailableError (эндпоинты отвечают 503),
+затем один пробный запрос решает, включать ли модель снова.
+"""
+
+import asyncio
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from backend import llm_limiter, metrics
+from backend.llm_limiter import LLMOverloadedError
+
+# Состояния автомата (значения gauge docmind_llm_breaker_state)
+CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+_STATE_NAMES = {CLOSED: "closed", OPEN: "open", HALF_OPEN: "half_open"}
+
+# Сколько последних задержек модели хранить для перцентиля хеджа
+_LATENCY_WINDOW = 200
+
+
+class LLMUnavailableError(LLMOverloadedError):
+    """Модель отключена автоматом после серии ошибок. retry_after — когда будет пробный запрос."""
+
+    status_code = 503
+
+    def __init__(self, model: str, retry_after: int) -> None:
+        super().__init__("модель временно отключена", retry_after)
+        self.model = model
+        self.args = (f"Модель {model} временно недоступна (серия ошибок). Повторите через {retry_after} с.",)
+
+
+def _env_number(name: str, default: float, cast=float):
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, cast(v))
+        except ValueError:
+            pass
+    return default
+
+
+def resilience_options() -> dict:
+    """
+    Параметры (переменные окружения, см. .env.example): число повторов и границы паузы между ними,
+    перцентиль задержки для хеджа (0 — выключен) и минимум замеров до его включения,
+    порог ошибок подряд для автомата (0 — выключен) и время до пробного запроса.
+    """
+    return {
+        "max_retries": _env_number("DOCMIND_LLM_RETRIES", 2, int),
+        "retry_base_seconds": _env_number("DOCMIND_LLM_RETRY_BASE_SECONDS", 0.5),
+        "retry_max_seconds": _env_number("DOCMIND_LLM_RETRY_MAX_SECONDS", 8.0),
+        "hedge_percentile": min(99.9, _env_number("DOCMIND_LLM_HEDGE_PERCENTILE", 0.0)),
+        "hedge_min_samples": max(1, _env_number("DOCMIND_LLM_HEDGE_MIN_SAMPLES", 20, int)),
+        "breaker_failures": _env_number("DOCMIND_LLM_BREAKER_FAILURES", 5, int),
+        "breaker_reset_seconds": _env_number("DOCMIND_LLM_BREAKER_RESET_SECONDS", 30.0),
+    }
+
+
+def failure_reason(exc: BaseException) -> str | None:
+    """Причина временной ошибки (429, 5xx, timeout, connection) или None — ошибку повторять не нужно."""
+    import openai
+
+    if isinstance(exc, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(exc, openai.APIConnectionError):
+        return "connection"
+    if isinstance(exc, openai.APIStatusError):
+        if exc.status_code == 429:
+            return "429"
+        if exc.status_code == 408:
+            return "timeout"
+        if exc.status_code >= 500:
+            return "5xx"
+    return None
+
+
+def _retry_after(exc: BaseException) -> float | None:
+    response = getattr(exc, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+
+def _retry_delay(exc: BaseException, reason: str | None, attempt: int, options: dict) -> float | None:
+    """Пауза перед повтором номер attempt+1 или None — не повторять."""
+    if reason is None or attempt >= options["max_retries"]:
+        return None
+    cap = options["retry_max_seconds"]
+    delay = random.uniform(0, min(cap, options["retry_base_seconds"] * 2 ** attempt))
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        if retry_after > cap:
+            # Провайдер просит подождать дольше, чем мы готовы держать запрос
+            return None
+        delay = max(delay, retry_after)
+    return delay
+
+
+# --- Состояние по моделям (общее для потоков и event loop'ов процесса) ---
+
+
+class _ModelState:
+    def __init__(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+
+
+_lock = threading.Lock()
+_models: dict[str, _ModelState] = {}
+_stats = {
+    "retries": 0,
+    "hedges_started": 0,
+    "hedges_won": 0,
+    "hedges_skipped": 0,
+    "breaker_opened": 0,
+    "short_circuits": 0,
+}
+
+
+def _model(model: str) -> _ModelState:
+    state = _models.get(model)
+    if state is None:
+        state = _models[model] = _ModelState()
+    return state
+
+
+def _set_state(model: str, entry: _ModelState, state: int) -> None:
+    entry.state = state
+    metrics.LLM_BREAKER_STATE.set(state, model=model)
+
+
+def _unavailable(model: str, entry: _ModelState, options: dict) -> LLMUnavailableError:
+    remaining = options["breaker_reset_seconds"] - (time.monotonic() - entry.opened_at)
+    return LLMUnavailableError(model, max(1, math.ceil(remaining)))
+
+
+def _before_call(model: str, options: dict) -> None:
+    """Пропускает запрос через автомат: открыт — LLMUnavailableError, полуоткрыт — один пробный запрос."""
+    if not options["breaker_failures"]:
+        return
+    with _lock:
+        entry = _model(model)
+        if entry.state == OPEN and time.monotonic() - entry.opened_at >= options["breaker_reset_seconds"]:
+            _set_state(model, entry, HALF_OPEN)
+            entry.probing = False
+        if entry.state == OPEN or (entry.state == HALF_OPEN and entry.probing):
+            _stats["short_circuits"] += 1
+            metrics.LLM_REQUESTS.inc(model=model, outcome="circuit_open")
+            raise _unavailable(model, entry, options)
+        if entry.state == HALF_OPEN:
+            entry.probing = True
+
+
+def _after_call(model: str, reason: str | None, ok: bool, options: dict) -> None:
+    """Итог запроса для автомата: успех, временная ошибка (reason) или прочее (не влияет на счётчик)."""
+    if not options["breaker_failures"]:
+        return
+    with _lock:
+        entry = _model(model)
+        entry.probing = False
+        if ok:
+            entry.failures = 0
+            if entry.state != CLOSED:
+                _set_state(model, entry, CLOSED)
+            return
+        if reason is None:
+            return
+        entry.failures += 1
+        if entry.state == HALF_OPEN or entry.failures >= options["breaker_failures"]:
+            if entry.state != OPEN:
+                _stats["breaker_opened"] += 1
+            entry.opened_at = time.monotonic()
+            _set_state(model, entry, OPEN)
+
+
+def circuit_open(model: str) -> bool:
+    """Отключена ли модель автоматом сейчас (до пробного запроса)."""
+    options = resilience_options()
+    if not options["breaker_failures"]:
+        return False
+    with _lock:
+        entry = _models.get(model)
+        return (
+            entry is not None
+            and entry.state == OPEN
+            and time.monotonic() - entry.opened_at < options["breaker_reset_seconds"]
+        )
+
+
+def check_circuit(models: list[str]) -> None:
+    """
+    Проверка до начала потокового ответа: если все модели цепочки отключены автоматом — LLMUnavailableError
+    (эндпоинт успевает ответить 503 вместо SSE-события error). Пробный запрос не занимает.
+    """
+    if not models or not all(circuit_open(model) for model in models):
+        return
+    options = resilience_options()
+    with _lock:
+        model = min(models, key=lambda m: _models[m].opened_at)
+        raise _unavailable(model, _models[model], options)
+
+
+def _count_retry(model: str, reason: str) -> None:
+    metrics.LLM_RETRIES.inc(model=model, reason=reason)
+    with _lock:
+        _stats["retries"] += 1
+
+
+# --- Хедж ---
+
+
+def _record_latency(model: str, seconds: float) -> None:
+    with _lock:
+        _model(model).latencies.append(seconds)
+
+
+def recent_latency(model: str, percentile: float = 50, min_samples: int = 5) -> float | None:
+    """Перцентиль недавних задержек успешных непотоковых запросов к модели; None — замеров мало."""
+    with _lock:
+        entry = _models.get(model)
+        samples = sorted(entry.latencies) if entry is not None else []
+    if not samples or len(samples) < min_samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * percentile / 100))]
+
+
+def _hedge_delay(model: str, options: dict) -> float | None:
+    """Перцентиль недавних задержек модели или None — хедж выключен или замеров мало."""
+    percentile = options["hedge_percentile"]
+    if not percentile:
+        return None
+    return recent_latency(model, percentile, options["hedge_min_samples"])
+
+
+def _hedge_count(model: str, outcome: str) -> None:
+    metrics.LLM_HEDGES.inc(model=model, outcome=outcome)
+    key = f"hedges_{outcome}"
+    if key in _stats:
+        with _lock:
+            _stats[key] += 1
+
+
+async def _drain(tasks) -> None:
+    """Отменяет незавершённые попытки и дожидается их (слоты и метрики освобождаются сразу)."""
+    pending = [t for t in tasks if not t.done()]
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+    for task in tasks:
+        if not task.cancelled():
+            task.exception()  # ошибка проигравшей попытки не нужна, но должна быть прочитана
+
+
+async def _hedged(model: str, attempt, options: dict):
+    start = time.monotonic()
+    delay = _hedge_delay(model, options)
+    if delay is None:
+        result = await attempt()
+        _record_latency(model, time.monotonic() - start)
+        return result
+
+    primary = asyncio.ensure_future(attempt())
+    tasks = [primary]
+    try:
+        await asyncio.wait(tasks, timeout=delay)
+        if primary.done():
+            result = primary.result()
+        else:
+            async with llm_limiter.try_limit() as acquired:
+                if not acquired:
+                    _hedge_count(model, "skipped")
+                    result = await primary
+                else:
+                    _hedge_count(model, "started")
+                    tasks.append(asyncio.ensure_future(attempt()))
+                    pending, error = set(tasks), None
+                    winner = None
+                    while pending and winner is None:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            if task.exception() is None:
+                                winner = task
+                                break
+                            error = task.exception()
+                    if winner is None:
+                        raise error
+                    _hedge_count(model, "won" if winner is not primary else "lost")
+                    result = winner.result()
+    finally:
+        await _drain(tasks)
+    _record_latency(model, time.monotonic() - start)
+    return result
+
+
+# --- Вызов ---
+
+
+async def acall(model: str, attempt, hedge: bool = True):
+    """
+    Выполняет запрос к LLM с повторами, хеджем и автоматом отключения.
+    attempt — функция без аргументов, возвращающая корутину одной попытки (новую при каждом вызове).
+    hedge=False — для открытия потока: без хеджа и без замера задержки (это не время ответа).
+    """
+    options = resilience_options()
+    for retry in range(options["max_retries"] + 1):
+        _before_call(model, options)
+        try:
+            result = await (_hedged(model, attempt, options) if hedge else attempt())
+        except BaseException as e:
+            reason = failure_reason(e) if isinstance(e, Exception) else None
+            _after_call(model, reason, False, options)
+            delay = _retry_delay(e, reason, retry, options)
+            if delay is None:
+                raise
+            _count_retry(model, reason)
+            await asyncio.sleep(delay)
+        else:
+            _after_call(model, None, True, options)
+            return result
+
+
+def call(model: str, attempt):
+    """Синхронный вариант acall() (без хеджа): паузы между повторами — time.sleep."""
+    options = resilience_options()
+    for retry in range(options["max_retries"] + 1):
+        _before_call(model, options)
+        try:
+            result = attempt()
+        except BaseException as e:
+            reason = failure_reason(e) if isinstance(e, Exception) else None
+            _after_call(model, reason, False, options)
+            delay = _retry_delay(e, reason, retry, options)
+            if delay is None:
+                raise
+            _count_retry(model, reason)
+            time.sleep(delay)
+        else:
+            _after_call(model, None, True, options)
+            return result
+
+
+def resilience_stats() -> dict:
+    """Повторы, хеджи, срабатывания автомата и состояние автомата по моделям."""
+    options = resilience_options()
+    with _lock:
+        stats = dict(_stats)
+        breakers = {
+            model: {"state": _STATE_NAMES[e.state], "failures": e.failures}
+            for model, e in _models.items()
+            if e.state != CLOSED or e.failures
+        }
+    stats["breakers_open"] = sum(1 for b in breakers.values() if b["state"] != "closed")
+    stats["breakers"] = breakers
+    stats.update(options)
+    return stats
@@ -0,0 +1,254 @@
+"""
+Выбор модели для запроса к LLM: по оценке входных токенов, типу анализа и текущей задержке модели,
+с цепочкой запасных моделей на случай ошибок.
+
+Маршруты — DOCMIND_LLM_ROUTES: ярусы через запятую «<входных токенов не больше>:<модель>|<запасная>|…»,
+ярус «*» — без ограничения. Запрос идёт в первый ярус, куда помещается: короткие документы — быстрым
+и дешёвым моделям, длинные — моделям с большим контекстом. Пример:
+    DOCMIND_LLM_ROUTES=2000:openai/gpt-4o-mini|deepseek/deepseek-chat,*:deepseek/deepseek-chat|google/gemini-2.0-flash-001
+Свои маршруты для типа анализа — DOCMIND_LLM_ROUTES_<ТИП> (DOCMIND_LLM_ROUTES_AI_MAGIC, DOCMIND_LLM_ROUTES_RISKS).
+Без настройки все запросы идут в DEFAULT_MODEL, как раньше.
+
+Ярус выбирается по полному размеру входа: анализ сообщает размер исходного документа (set_input_chars),
+и итоговый запрос по обрезанному или сведённому по частям тексту уходит в тот же ярус. Бюджет обрезки
+и анализа по частям — input_budget(): контекстное окно моделей яруса (DOCMIND_LLM_CONTEXT_TOKENS,
+«<модель>=<токенов>» через запятую) за вычетом ответа, иначе предел яруса.
+
+Цепочка яруса — порядок отката. Модель, у которой медиана недавних задержек выше DOCMIND_LLM_SLOW_SECONDS,
+и модель, отключённая автоматом (backend/llm_resilience.py), уходят в конец цепочки. Ответ 402, 404,
+5xx, 429 и таймаут после повторов — переход к следующей модели; с DOCMIND_LLM_FALLBACK_TIMEOUT_SECONDS
+не последняя модель цепочки, не ответившая за это время, тоже уступает следующей.
+"""
+
+import logging
+import math
+import os
+import threading
+from contextvars import ContextVar
+from functools import lru_cache
+
+from backend import llm_resilience, metrics
+
+logger = logging.getLogger(__name__)
+
+# Модель по умолчанию (единственная, если маршруты не заданы)
+DEFAULT_MODEL = "deepseek/deepseek-chat"
+
+_lock = threading.Lock()
+_stats = {"routed": 0, "fallbacks": 0, "demoted": 0}
+
+# Размер user-сообщения до обрезки/сведения по частям (символов) для маршрутизации запросов текущей задачи
+_input_chars: ContextVar[int | None] = ContextVar("docmind_llm_input_chars", default=None)
+
+
+def _env_number(name: str, default: float, cast=float):
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, cast(v))
+        except ValueError:
+            pass
+    return default
+
+
+def router_options() -> dict:
+    """
+    Параметры (переменные окружения, см. .env.example): символов на токен для оценки входа,
+    порог медианной задержки «медленной» модели и время ответа до перехода к запасной (0 — выключено).
+    """
+    return {
+        "chars_per_token": max(1.0, _env_number("DOCMIND_LLM_CHARS_PER_TOKEN", 3.0)),
+        "slow_seconds": _env_number("DOCMIND_LLM_SLOW_SECONDS", 30.0),
+        "fallback_timeout_seconds": _env_number("DOCMIND_LLM_FALLBACK_TIMEOUT_SECONDS", 0.0),
+    }
+
+
+@lru_cache(maxsize=32)
+def parse_routes(spec: str) -> tuple[tuple[int | None, tuple[str, ...]], ...]:
+    """
+    Разбирает описание маршрутов в ярусы ((предел токенов или None, (модели…)), …), по возрастанию предела.
+    Некорректное описание — ValueError.
+    """
+    tiers = []
+    for raw in spec.split(","):
+        raw = raw.strip()
+        if not raw:
+            continue
+        limit, sep, chain = raw.partition(":")
+        models = tuple(m.strip() for m in chain.split("|") if m.strip())
+        if not sep or not models:
+            raise ValueError(f"Некорректный ярус маршрута: {raw}")
+        limit = limit.strip()
+        if limit == "*":
+            tiers.append((None, models))
+            continue
+        try:
+            tiers.append((int(limit), models))
+        except ValueError as e:
+            raise ValueError(f"Некорректный предел токенов в маршруте: {raw}") from e
+    if not tiers:
+        raise ValueError("Маршруты LLM не заданы")
+    return tuple(sorted(tiers, key=lambda t: math.inf if t[0] is None else t[0]))
+
+
+def routes(analysis_type: str | None = None) -> tuple[tuple[int | None, tuple[str, ...]], ...]:
+    """
+    Ярусы для типа анализа: DOCMIND_LLM_ROUTES_<ТИП>, иначе DOCMIND_LLM_ROUTES, иначе DEFAULT_MODEL.
+    Ошибка в описании маршрутов не ломает запросы: пишется в лог, используется DEFAULT_MODEL.
+    """
+    spec = ""
+    if analysis_type:
+        spec = os.environ.get(f"DOCMIND_LLM_ROUTES_{analysis_type.upper()}", "").strip()
+    spec = spec or os.environ.get("DOCMIND_LLM_ROUTES", "").strip()
+    if spec:
+        try:
+            return parse_routes(spec)
+        except ValueError as e:
+            logger.warning("Маршруты LLM не разобраны (%s), используется %s", e, DEFAULT_MODEL)
+    return ((None, (DEFAULT_MODEL,)),)
+
+
+@lru_cache(maxsize=8)
+def parse_context_windows(spec: str) -> dict[str, int]:
+    """Разбирает «<модель>=<токенов>,…» в {модель: окно}. Некорректная запись — ValueError."""
+    windows = {}
+    for raw in spec.split(","):
+        raw = raw.strip()
+        if not raw:
+            continue
+        model, sep, tokens = raw.rpartition("=")
+        if not sep or not model.strip():
+            raise ValueError(f"Некорректное контекстное окно модели: {raw}")
+        try:
+            windows[model.strip()] = int(tokens)
+        except ValueError as e:
+            raise ValueError(f"Некорректное контекстное окно модели: {raw}") from e
+    return windows
+
+
+def context_windows() -> dict[str, int]:
+    """Контекстные окна моделей из DOCMIND_LLM_CONTEXT_TOKENS; ошибка в описании — в лог, окна неизвестны."""
+    spec = os.environ.get("DOCMIND_LLM_CONTEXT_TOKENS", "").strip()
+    if not spec:
+        return {}
+    try:
+        return parse_context_windows(spec)
+    except ValueError as e:
+        logger.warning("Контекстные окна моделей не разобраны (%s)", e)
+        return {}
+
+
+def set_input_chars(chars: int | None) -> None:
+    """
+    Полный размер user-сообщения (до обрезки и сведения по частям) для следующих запросов в текущем
+    контексте (видно в этой задаче и вызванных из неё). None — маршрутизировать по фактическому запросу.
+    """
+    _input_chars.set(chars)
+
+
+def _tier(tokens: int, analysis_type: str | None) -> tuple[int | None, tuple[str, ...]]:
+    tiers = routes(analysis_type)
+    # Больше самого большого предела — последний ярус
+    return next((t for t in tiers if t[0] is None or tokens <= t[0]), tiers[-1])
+
+
+def _tier_budget(limit: int | None, models: tuple[str, ...]) -> int | None:
+    """Бюджет входа яруса в символах: наименьшее известное окно его моделей за вычетом ответа, иначе предел."""
+    from backend.openai_client import _max_tokens
+
+    windows = context_windows()
+    known = [windows[m] for m in models if m in windows]
+    tokens = min(known) - _max_tokens() if known else limit
+    if tokens is None:
+        return None
+    return max(1, int(tokens * router_options()["chars_per_token"]))
+
+
+def input_budget(input_chars: int, analysis_type: str | None = None) -> int | None:
+    """
+    Сколько символов входа (system + user) помещается в запрос к модели яруса, выбранного по полному
+    размеру входа input_chars. None — ярус без предела и окна его моделей неизвестны (действуют прежние лимиты).
+    """
+    if analysis_type is None:
+        analysis_type = metrics.current_labels()["analysis_type"]
+    limit, models = _tier(math.ceil(input_chars / router_options()["chars_per_token"]), analysis_type)
+    return _tier_budget(limit, models)
+
+
+def max_input_budget(analysis_type: str | None = None) -> int | None:
+    """Наибольший бюджет среди ярусов (сколько текста вообще может понадобиться); None — неизвестен у всех."""
+    if analysis_type is None:
+        analysis_type = metrics.current_labels()["analysis_type"]
+    budgets = [b for b in (_tier_budget(limit, models) for limit, models in routes(analysis_type)) if b]
+    return max(budgets) if budgets else None
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Грубая оценка числа токенов: символы / DOCMIND_LLM_CHARS_PER_TOKEN (для русского текста ~3)."""
+    return math.ceil(sum(len(t or "") for t in texts) / router_options()["chars_per_token"])
+
+
+def route(
+    system_prompt: str, user_content: str, analysis_type: str | None = None, record: bool = True
+) -> list[str]:
+    """
+    Цепочка моделей для запроса: ярус по оценке входных токенов, затем здоровые модели в порядке
+    конфигурации, за ними медленные, в конце — отключённые автоматом. Если задан полный размер
+    user-сообщения (set_input_chars) и он больше фактического — ярус выбирается по нему.
+    Тип анализа по умолчанию — из меток текущего запроса (metrics.tag). record=False — проверка
+    без учёта в статистике (эндпоинт до начала потока).
+    """
+    if analysis_type is None:
+        analysis_type = metrics.current_labels()["analysis_type"]
+    user_chars = max(len(user_content or ""), _input_chars.get() or 0)
+    tokens = math.ceil((len(system_prompt or "") + user_chars) / router_options()["chars_per_token"])
+    _, models = _tier(tokens, analysis_type)
+
+    slow_seconds = router_options()["slow_seconds"]
+
+    def rank(model: str) -> int:
+        if llm_resilience.circuit_open(model):
+            return 2
+        latency = llm_resilience.recent_latency(model) if slow_seconds else None
+        return 1 if latency is not None and latency > slow_seconds else 0
+
+    chain = sorted(models, key=rank)  # сортировка устойчивая: внутри группы — порядок конфигурации
+    if not record:
+        return chain
+    with _lock:
+        _stats["routed"] += 1
+        if chain[0] != models[0]:
+            _stats["demoted"] += 1
+    return chain
+
+
+def fallback_reason(exc: BaseException) -> str | None:
+    """Причина перейти к следующей модели цепочки или None — ошибка не зависит от модели."""
+    if isinstance(exc, llm_resilience.LLMUnavailableError):
+        return "circuit_open"
+    if isinstance(exc, TimeoutError):
+        return "slow"
+    reason = llm_resilience.failure_reason(exc)
+    if reason is not None:
+        return reason
+    import openai
+
+    # 402 — у провайдера модели кончились кредиты, 404 — модель недоступна по этому id
+    if isinstance(exc, openai.APIStatusError) and exc.status_code in (402, 404):
+        return str(exc.status_code)
+    return None
+
+
+def record_fallback(model: str, reason: str) -> None:
+    metrics.LLM_FALLBACKS.inc(model=model, reason=reason)
+    with _lock:
+        _stats["fallbacks"] += 1
+
+
+def router_stats() -> dict:
+    """Выбор маршрутов, переходы к запасным моделям и параметры."""
+    with _lock:
+        stats = dict(_stats)
+    stats.update(router_options())
+    stats["routes"] = [{"max_input_tokens": limit, "models": list(models)} for limit, models in routes()]
+    return stats
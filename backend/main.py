@@ -3,28 +3,63 @@ DocMind — минимальный FastAPI backend.
 Фаза 1–2: health-check, БД. Фаза 5: API. Фаза 8: CORS и статика.
 """
 
+import asyncio
+import json
 import logging
+import re
 from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
 
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
-from fastapi import Depends, File, FastAPI, HTTPException, UploadFile
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
 from starlette.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse, Response
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from sqlalchemy.orm import Session
-
-from backend.ai_magic_service import run_ai_magic
-from backend.analysis_service import run_analysis
+from sqlalchemy import delete, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from backend.ai_magic_service import (
+    AI_MAGIC_TYPE,
+    build_ai_magic_prompt,
+    find_ai_magic_report,
+    run_ai_magic,
+    save_ai_magic_report,
+)
+from backend.analysis_service import prepare_analysis, run_analyses, run_analysis, save_result
 from backend.demo_document import DEMO_FILENAME, get_demo_pdf_bytes
-from backend.database import Base, SessionLocal, engine, get_db
-from backend import models  # регистрация моделей у Base
-from backend.file_upload import delete_document_file, ensure_uploads_dir, save_upload
-from backend.report_pdf import report_text_to_pdf
+from backend.document_parser import shutdown_extract_pool
+from backend.database import AsyncSessionLocal, async_engine, get_db, init_db, pool_stats
+from backend import llm_cache, metrics, models, text_cache, tracing  # models — регистрация моделей у Base
+from backend.file_upload import (
+    MultipartFileReader,
+    UploadTooLargeError,
+    delete_document_file,
+    ensure_uploads_dir,
+    get_document_file_path,
+    max_upload_bytes,
+    save_upload,
+    save_upload_stream,
+)
+from backend.jobs import JobWorkerPool, queue_stats, submit_job, worker_count
+from backend.llm_limiter import LLMOverloadedError, check_admission, limiter_stats
+from backend.llm_resilience import check_circuit, resilience_stats
+from backend.llm_router import route, router_stats, routes
+from backend.openai_client import aclose_clients, astream_complete, client_stats, served_model
+from backend.pagination import (
+    DEFAULT_PAGE_SIZE,
+    NEXT_CURSOR_HEADER,
+    PREVIEW_CHARS,
+    after_cursor,
+    check_page_size,
+    split_page,
+)
+from backend.prompts import ANALYSIS_TYPES
+from backend.report_pdf import render_report_pdf, report_etag, shutdown_render_pool
 
 
 # --- Схемы запросов/ответов ---
@@ -74,15 +109,85 @@ class AnalyzeResponse(BaseModel):
 
     result_id: int
     content: str
+    model: str | None = Field(None, description="Модель, ответившая на запрос")
+
+
+class BatchAnalyzeRequest(BaseModel):
+    """Тело POST /api/analyze/batch."""
+
+    document_id: int
+    analysis_types: list[str] = Field(
+        default_factory=lambda: list(ANALYSIS_TYPES),
+        description="Список типов; по умолчанию все: summary, action_items, risks, explain_simple",
+    )
+    user_id: int | None = None
+    audience: str | None = Field(None, description="business | legal | manager | student")
+    max_concurrency: int | None = Field(None, ge=1, description="Не больше DOCMIND_BATCH_CONCURRENCY")
+
+
+class BatchAnalyzeItem(BaseModel):
+    """Итог по одному типу анализа в пакете."""
+
+    analysis_type: str
+    status: str  # ok | error
+    result_id: int | None = None
+    content: str | None = None
+    model: str | None = None
+    error: str | None = None
+
+
+class BatchAnalyzeResponse(BaseModel):
+    """Ответ пакетного анализа: результат по каждому типу."""
+
+    results: list[BatchAnalyzeItem]
+
+
+class JobSubmitRequest(BaseModel):
+    """Тело POST /api/jobs — постановка анализа или AI Magic в фоновую очередь."""
+
+    kind: str = Field("analysis", description="analysis | ai_magic")
+    document_id: int
+    analysis_type: str | None = Field(None, description="Для kind=analysis: summary | action_items | risks | explain_simple")
+    user_id: int | None = None
+    audience: str | None = Field(None, description="business | legal | manager | student")
+
+
+class JobStatusResponse(BaseModel):
+    """Состояние фоновой задачи."""
+
+    job_id: int
+    kind: str
+    status: str  # queued | running | done | failed
+    attempts: int
+    document_id: int
+    analysis_type: str | None = None
+    result_id: int | None = None
+    report: str | None = None
+    error: str | None = None
+    created_at: datetime
+    finished_at: datetime | None = None
 
 
 class ResultListItem(BaseModel):
-    """Элемент списка результатов по документу."""
+    """Элемент списка результатов по документу с полным содержимым (GET /api/documents/{id}/results)."""
 
     id: int
     document_id: int
     analysis_type: str
     content: str
+    model: str | None = None
+    created_at: datetime
+
+
+class ResultSummaryItem(BaseModel):
+    """Элемент постраничного списка результатов: метаданные и превью (GET /api/v2/documents/{id}/results)."""
+
+    id: int
+    document_id: int
+    analysis_type: str
+    preview: str = Field(..., description=f"Начало содержимого (до {PREVIEW_CHARS} символов)")
+    content_length: int
+    model: str | None = None
     created_at: datetime
 
 
@@ -93,6 +198,7 @@ class ResultDetailResponse(BaseModel):
     document_id: int
     analysis_type: str
     content: str
+    model: str | None = Field(None, description="Модель, ответившая на запрос (NULL — результаты до маршрутизации)")
     created_at: datetime
 
 
@@ -104,15 +210,19 @@ class AIMagicRequest(BaseModel):
 
 
 class AIMagicResponse(BaseModel):
-    """Ответ AI Magic — консалтинговый отчёт."""
+    """Ответ AI Magic — консалтинговый отчёт (сохраняется в results)."""
 
     report: str
+    result_id: int
+    cached: bool = Field(False, description="Отчёт взят из сохранённых: документ, анализы и промпт не менялись")
+    model: str | None = Field(None, description="Модель, ответившая на запрос")
 
 
 class ExportReportRequest(BaseModel):
-    """Тело POST /api/export-report — текст отчёта для экспорта в PDF."""
+    """Тело POST /api/export-report — сохранённый отчёт (result_id) или текст отчёта для экспорта в PDF."""
 
-    report_text: str = Field(..., description="Текст AI Magic отчёта")
+    result_id: int | None = Field(None, description="id сохранённого результата (отчёт AI Magic или анализ)")
+    report_text: str | None = Field(None, description="Текст отчёта, если result_id не передан")
 
 
 class DemoRunRequest(BaseModel):
@@ -131,11 +241,18 @@ class DemoRunResponse(BaseModel):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """При старте приложения создаём таблицы в БД и каталог для загрузок."""
-    Base.metadata.create_all(bind=engine)
+    """При старте приложения создаём таблицы в БД, каталог для загрузок и запускаем воркеры задач."""
+    await init_db()
     ensure_uploads_dir()
+    job_pool = JobWorkerPool(worker_count())
+    job_pool.start()
     yield
-    # при завершении ничего не делаем
+    # при завершении останавливаем воркеры, закрываем пул соединений к LLM и async engine
+    await job_pool.stop()
+    await aclose_clients()
+    await async_engine.dispose()
+    shutdown_render_pool()
+    shutdown_extract_pool()
 
 
 app = FastAPI(title="DocMind", version="0.1.0", lifespan=lifespan)
@@ -152,9 +269,47 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 
+_UPLOAD_PATH = re.compile(r"^/api/users/\d+/documents$")
+# Запас на заголовки multipart поверх размера файла
+_MULTIPART_OVERHEAD = 64 * 1024
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Отклоняет загрузку документа с Content-Length больше лимита (413) до разбора multipart,
+    чтобы не принимать тело целиком. Загрузки без Content-Length ограничиваются при приёме в save_upload_stream.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and _UPLOAD_PATH.match(scope["path"]):
+            limit = max_upload_bytes()
+            length = dict(scope["headers"]).get(b"content-length")
+            if limit and length and length.isdigit() and int(length) > limit + _MULTIPART_OVERHEAD:
+                response = JSONResponse(
+                    {"detail": str(UploadTooLargeError(limit))},
+                    status_code=413,
+                    headers={"Connection": "close"},
+                )
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+app.add_middleware(UploadSizeLimitMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+# Последним — внешний слой: корневой спан трассы охватывает остальные middleware
+app.add_middleware(tracing.TracingMiddleware)
+# Спаны SQL-запросов в трассах
+tracing.instrument_engine(async_engine.sync_engine)
+
+
 @app.get("/health")
 def health():
     """Проверка доступности сервера."""
@@ -162,7 +317,7 @@ def health():
 
 
 @app.post("/api/login", response_model=LoginResponse)
-def login(body: LoginRequest, db: Session = Depends(get_db)):
+async def login(body: LoginRequest, db: AsyncSession = Depends(get_db)):
     """
     Простой «логин» без пароля: по имени пользователя вернуть user_id и username.
     Если пользователь с таким именем есть — возвращаем его; иначе создаём нового.
@@ -172,12 +327,12 @@ def login(body: LoginRequest, db: Session = Depends(get_db)):
     username = body.username.strip()
     if not username:
         raise HTTPException(status_code=400, detail="Имя пользователя не может быть пустым")
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.scalar(select(User).where(User.username == username))
     if not user:
         user = User(username=username)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
     return LoginResponse(user_id=user.id, username=user.username)
 
 
@@ -186,55 +341,115 @@ ALLOWED_EXTENSIONS = {".txt", ".pdf", ".docx"}
 
 
 @app.get("/api/users/{user_id}/documents", response_model=list[DocumentListItem])
-def list_documents(user_id: int, db: Session = Depends(get_db)):
-    """Список документов пользователя: id, filename, uploaded_at."""
+async def list_documents(
+    user_id: int,
+    response: Response,
+    cursor: str | None = None,
+    limit: int | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Список документов пользователя (id, filename, uploaded_at), новые первыми.
+    С limit или cursor — постранично (limit по умолчанию DEFAULT_PAGE_SIZE), курсор следующей страницы —
+    в заголовке X-Next-Cursor. Без обоих параметров — весь список, как у клиентов до пагинации.
+    """
     from backend.models import Document, User
 
-    user = db.query(User).filter(User.id == user_id).first()
+    paged = limit is not None or cursor is not None
+    limit = limit or DEFAULT_PAGE_SIZE
+    try:
+        check_page_size(limit)
+        after = after_cursor(Document.uploaded_at, Document.id, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    docs = db.query(Document).filter(Document.user_id == user_id).order_by(Document.uploaded_at.desc()).all()
+    query = (
+        select(Document.id, Document.filename, Document.uploaded_at)
+        .where(Document.user_id == user_id)
+        .order_by(Document.uploaded_at.desc(), Document.id.desc())
+    )
+    if not paged:
+        docs = (await db.execute(query)).all()
+        return [DocumentListItem(id=d.id, filename=d.filename, uploaded_at=d.uploaded_at) for d in docs]
+    query = query.limit(limit + 1)
+    if after is not None:
+        query = query.where(after)
+    docs, next_cursor = split_page((await db.execute(query)).all(), limit, "uploaded_at")
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
     return [DocumentListItem(id=d.id, filename=d.filename, uploaded_at=d.uploaded_at) for d in docs]
 
 
 @app.get("/api/users/{user_id}/documents/{document_id}", response_model=DocumentListItem)
-def get_document(user_id: int, document_id: int, db: Session = Depends(get_db)):
+async def get_document(user_id: int, document_id: int, db: AsyncSession = Depends(get_db)):
     """Один документ пользователя (для страницы анализа)."""
     from backend.models import Document, User
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    doc = db.query(Document).filter(Document.id == document_id, Document.user_id == user_id).first()
+    doc = await db.scalar(select(Document).where(Document.id == document_id, Document.user_id == user_id))
     if not doc:
         raise HTTPException(status_code=404, detail="Документ не найден")
     return DocumentListItem(id=doc.id, filename=doc.filename, uploaded_at=doc.uploaded_at)
 
 
-@app.post("/api/users/{user_id}/documents", response_model=DocumentUploadResponse)
-def upload_document(
-    user_id: int,
-    file: UploadFile = File(...),
-    db: Session = Depends(get_db),
-):
-    """Загрузка файла (PDF, TXT, DOCX): сохранение на диск, запись в БД, возврат document_id."""
+# Тело разбирается вручную (MultipartFileReader), схему формы для OpenAPI описываем явно
+_UPLOAD_REQUEST_BODY = {
+    "required": True,
+    "content": {
+        "multipart/form-data": {
+            "schema": {
+                "type": "object",
+                "required": ["file"],
+                "properties": {"file": {"type": "string", "format": "binary"}},
+            }
+        }
+    },
+}
+
+
+@app.post(
+    "/api/users/{user_id}/documents",
+    response_model=DocumentUploadResponse,
+    openapi_extra={"requestBody": _UPLOAD_REQUEST_BODY},
+)
+async def upload_document(user_id: int, request: Request, db: AsyncSession = Depends(get_db)):
+    """
+    Загрузка файла (PDF, TXT, DOCX): multipart разбирается потоково, файл пишется на диск блоками
+    по мере приёма из сети, затем запись в БД, возврат document_id.
+    Файл больше DOCMIND_MAX_UPLOAD_BYTES отклоняется с 413, как только приём превысит лимит.
+    """
     from backend.models import User
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    if not file.filename:
+    try:
+        reader = MultipartFileReader(request.stream(), request.headers.get("content-type"))
+        filename = await reader.read_filename()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if filename is None:
+        raise HTTPException(status_code=400, detail="Файл не передан (поле file)")
+    if not filename:
         raise HTTPException(status_code=400, detail="Имя файла отсутствует")
-    ext = "." + file.filename.rsplit(".", 1)[-1].lower() if "." in file.filename else ""
+    ext = "." + filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
     if ext not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=400,
             detail=f"Недопустимый формат. Разрешены: {', '.join(ALLOWED_EXTENSIONS)}",
         )
+
     try:
-        content = file.file.read()
-        doc = save_upload(content, file.filename, user_id, db)
+        doc = await save_upload_stream(reader.chunks(), filename, user_id, db)
         return DocumentUploadResponse(document_id=doc.id)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except OSError as e:
         logger.exception("Ошибка записи файла при загрузке")
         raise HTTPException(
@@ -250,30 +465,37 @@ def upload_document(
 
 
 @app.post("/api/users/{user_id}/documents/{document_id}/delete")
-def delete_document(user_id: int, document_id: int, db: Session = Depends(get_db)):
+async def delete_document(user_id: int, document_id: int, db: AsyncSession = Depends(get_db)):
     """Удаление документа: файл с диска, результаты и запись в БД. POST для совместимости."""
     from backend.models import Document, Result, User
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
-    doc = db.query(Document).filter(Document.id == document_id, Document.user_id == user_id).first()
+    doc = await db.scalar(select(Document).where(Document.id == document_id, Document.user_id == user_id))
     if not doc:
         raise HTTPException(status_code=404, detail="Документ не найден")
     try:
-        db.query(Result).filter(Result.document_id == document_id).delete()
-        db.delete(doc)
-        db.commit()
-        delete_document_file(doc)
+        await db.execute(delete(Result).where(Result.document_id == document_id))
+        await db.delete(doc)
+        await delete_document_file(doc, db)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.exception("Ошибка при удалении документа")
         raise HTTPException(status_code=500, detail="Не удалось удалить документ.")
     return {"status": "ok"}
 
 
+def _overloaded(e: LLMOverloadedError) -> HTTPException:
+    """
+    Ответ с Retry-After: 429 — запрос к LLM не поместился в очередь ограничителя,
+    503 — модель отключена автоматом после серии ошибок (LLMUnavailableError).
+    """
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
 @app.post("/api/analyze", response_model=AnalyzeResponse)
-def analyze(body: AnalyzeRequest, db: Session = Depends(get_db)):
+async def analyze(body: AnalyzeRequest, db: AsyncSession = Depends(get_db)):
     """
     Запуск анализа документа: извлечение текста, вызов OpenAI, сохранение в results.
     Возвращает result_id и content. Если передан user_id — проверяется владение документом.
@@ -281,15 +503,19 @@ def analyze(body: AnalyzeRequest, db: Session = Depends(get_db)):
     if body.user_id is not None:
         from backend.models import Document
 
-        doc = db.query(Document).filter(
-            Document.id == body.document_id,
-            Document.user_id == body.user_id,
-        ).first()
+        doc = await db.scalar(
+            select(Document).where(
+                Document.id == body.document_id,
+                Document.user_id == body.user_id,
+            )
+        )
         if not doc:
             raise HTTPException(status_code=404, detail="Документ не найден")
     try:
-        result = run_analysis(body.document_id, body.analysis_type, db, audience=body.audience)
-        return AnalyzeResponse(result_id=result.id, content=result.content)
+        result = await run_analysis(body.document_id, body.analysis_type, db, audience=body.audience)
+        return AnalyzeResponse(result_id=result.id, content=result.content, model=result.model)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
     except ValueError as e:
         msg = str(e)
         if "не найден" in msg:
@@ -308,21 +534,334 @@ def analyze(body: AnalyzeRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=502, detail=msg or "Ошибка при анализе документа. Попробуйте позже.")
 
 
+def _llm_error_message(e: BaseException) -> str:
+    """Краткое сообщение об ошибке LLM для пакетного ответа и SSE-события error."""
+    msg = str(e).strip()
+    if "OPENROUTER_API_KEY" in msg or "ключ" in msg.lower():
+        return "Сервис анализа недоступен: не задан OPENROUTER_API_KEY в .env"
+    if len(msg) > 300:
+        msg = msg[:297] + "..."
+    return msg or "Ошибка при анализе документа."
+
+
+@app.post("/api/analyze/batch", response_model=BatchAnalyzeResponse)
+async def analyze_batch(body: BatchAnalyzeRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Пакетный анализ документа по нескольким типам: текст извлекается один раз,
+    запросы к LLM идут параллельно, результаты сохраняются одной транзакцией.
+    Ошибки отдельных типов возвращаются в status/error, остальные результаты сохраняются.
+    """
+    if body.user_id is not None:
+        from backend.models import Document
+
+        doc = await db.scalar(
+            select(Document).where(
+                Document.id == body.document_id,
+                Document.user_id == body.user_id,
+            )
+        )
+        if not doc:
+            raise HTTPException(status_code=404, detail="Документ не найден")
+    try:
+        outcome = await run_analyses(
+            body.document_id,
+            body.analysis_types,
+            db,
+            audience=body.audience,
+            max_concurrency=body.max_concurrency,
+        )
+    except ValueError as e:
+        msg = str(e)
+        if "не найден" in msg:
+            raise HTTPException(status_code=404, detail=msg)
+        raise HTTPException(status_code=400, detail=msg)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    values = list(outcome.values())
+    if values and all(isinstance(v, LLMOverloadedError) for v in values):
+        # Ни один тип не дождался слота — повтор всего пакета позже
+        raise _overloaded(values[0])
+    items = []
+    for analysis_type, value in outcome.items():
+        if isinstance(value, BaseException):
+            logger.warning("Ошибка пакетного анализа (%s): %s", analysis_type, value)
+            items.append(
+                BatchAnalyzeItem(analysis_type=analysis_type, status="error", error=_llm_error_message(value))
+            )
+        else:
+            items.append(
+                BatchAnalyzeItem(
+                    analysis_type=analysis_type,
+                    status="ok",
+                    result_id=value.id,
+                    content=value.content,
+                    model=value.model,
+                )
+            )
+    return BatchAnalyzeResponse(results=items)
+
+
+def _sse(event: str, data: dict) -> str:
+    """Одно событие Server-Sent Events (данные — JSON в одной строке)."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+_SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+async def _stream_llm_events(system_prompt: str, user_content: str, on_done):
+    """
+    Генератор SSE: event token — фрагменты ответа, затем done (данные от on_done(полный текст)) или error.
+    При разрыве соединения Starlette отменяет генератор: поток к LLM закрывается, результат не сохраняется.
+    """
+    parts = []
+    try:
+        async for delta in astream_complete(system_prompt, user_content):
+            parts.append(delta)
+            yield _sse("token", {"text": delta})
+        yield _sse("done", await on_done("".join(parts).strip()))
+    except asyncio.CancelledError:
+        logger.info("Клиент отключился во время потоковой генерации")
+        raise
+    except Exception as e:
+        logger.exception("Ошибка потоковой генерации")
+        yield _sse("error", {"detail": _llm_error_message(e)})
+
+
+def _check_any_model_available(analysis_type: str | None) -> None:
+    """
+    Проверка до начала потока, когда цепочка ещё неизвестна (её выбирают по размеру документа):
+    503, только если отключены автоматом все модели маршрутов этого типа.
+    """
+    check_circuit([m for _, models in routes(analysis_type) for m in models])
+
+
+async def _prepared_stream_events(prepare, stream_events):
+    """
+    Генератор SSE, в котором подготовка запроса (извлечение текста, анализ длинного документа по частям)
+    идёт уже после начала ответа: клиент сразу получает заголовки и события progress
+    {stage: prepare|map|reduce|generate, done, total}, а не ждёт молча всю подготовку.
+    prepare(on_progress) → (system_prompt, user_content); stream_events(system_prompt, user_content) — события ответа.
+    Подготовка и генерация идут в одной задаче (общий контекст: метки метрик, пользователь очереди LLM,
+    размер документа для маршрута), события передаются через очередь. При разрыве соединения задача отменяется.
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    def on_progress(stage: str, done: int, total: int) -> None:
+        queue.put_nowait(_sse("progress", {"stage": stage, "done": done, "total": total}))
+
+    async def run() -> None:
+        try:
+            try:
+                system_prompt, user_content = await prepare(on_progress)
+                check_circuit(route(system_prompt, user_content, record=False))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not isinstance(e, (ValueError, FileNotFoundError, LLMOverloadedError)):
+                    logger.exception("Ошибка подготовки потоковой генерации")
+                queue.put_nowait(_sse("error", {"detail": _llm_error_message(e)}))
+                return
+            queue.put_nowait(_sse("progress", {"stage": "generate"}))
+            async for event in stream_events(system_prompt, user_content):
+                queue.put_nowait(event)
+        finally:
+            queue.put_nowait(finished)
+
+    task = asyncio.create_task(run())
+    try:
+        yield _sse("progress", {"stage": "prepare"})
+        while (event := await queue.get()) is not finished:
+            yield event
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+@app.post("/api/analyze/stream")
+async def analyze_stream(body: AnalyzeRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Потоковый анализ (text/event-stream): поток начинается сразу, подготовка (извлечение текста,
+    анализ длинного документа по частям) идёт внутри него, токены ответа приходят по мере генерации.
+    События: progress {stage, done, total}, token {text}, done {result_id, model}, error {detail}.
+    Итоговый текст сохраняется в results. Нет документа — 404, неизвестный тип — 400,
+    очередь к LLM заполнена или все модели отключены — 429/503 до начала потока.
+    """
+    from backend.models import Document
+
+    if body.analysis_type not in ANALYSIS_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Неизвестный тип анализа: {body.analysis_type}. Допустимы: {list(ANALYSIS_TYPES)}",
+        )
+    query = select(Document).where(Document.id == body.document_id)
+    if body.user_id is not None:
+        query = query.where(Document.user_id == body.user_id)
+    doc = await db.scalar(query)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Документ не найден")
+    if not get_document_file_path(doc).exists():
+        raise HTTPException(status_code=404, detail="Файл документа не найден")
+    try:
+        # Очередь к LLM заполнена или модели отключены — 429/503 до начала потока, а не SSE-событие error
+        check_admission()
+        _check_any_model_available(body.analysis_type)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+
+    async def prepare(on_progress):
+        # Отдельная сессия: зависимость get_db может быть закрыта к началу потока
+        async with AsyncSessionLocal() as session:
+            return await prepare_analysis(
+                body.document_id, body.analysis_type, session, audience=body.audience, on_progress=on_progress
+            )
+
+    async def on_done(content: str) -> dict:
+        async with AsyncSessionLocal() as session:
+            result = await save_result(body.document_id, body.analysis_type, content, session, model=served_model())
+        return {"result_id": result.id, "model": result.model}
+
+    return StreamingResponse(
+        _prepared_stream_events(prepare, partial(_stream_llm_events, on_done=on_done)),
+        media_type="text/event-stream",
+        headers=_SSE_HEADERS,
+    )
+
+
+def _job_status(job) -> JobStatusResponse:
+    return JobStatusResponse(
+        job_id=job.id,
+        kind=job.kind,
+        status=job.status,
+        attempts=job.attempts,
+        document_id=job.document_id,
+        analysis_type=job.analysis_type,
+        result_id=job.result_id,
+        report=job.report,
+        error=job.error,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+    )
+
+
+@app.post("/api/jobs", response_model=JobStatusResponse, status_code=202)
+async def create_job(body: JobSubmitRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Ставит анализ (kind=analysis) или AI Magic (kind=ai_magic) в фоновую очередь и сразу возвращает job_id.
+    Состояние и результат — GET /api/jobs/{job_id}.
+    """
+    if body.user_id is not None:
+        from backend.models import Document
+
+        doc = await db.scalar(
+            select(Document).where(
+                Document.id == body.document_id,
+                Document.user_id == body.user_id,
+            )
+        )
+        if not doc:
+            raise HTTPException(status_code=404, detail="Документ не найден")
+    try:
+        job = await submit_job(db, body.kind, body.document_id, body.analysis_type, body.audience)
+    except ValueError as e:
+        msg = str(e)
+        if "не найден" in msg:
+            raise HTTPException(status_code=404, detail=msg)
+        raise HTTPException(status_code=400, detail=msg)
+    return _job_status(job)
+
+
+@app.get("/api/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: int, db: AsyncSession = Depends(get_db)):
+    """Состояние фоновой задачи: queued | running | done | failed, result_id или report по готовности."""
+    from backend.models import Job
+
+    job = await db.get(Job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return _job_status(job)
+
+
 @app.get("/api/documents/{document_id}/results", response_model=list[ResultListItem])
-def list_document_results(document_id: int, db: Session = Depends(get_db)):
-    """Список результатов анализа по документу (id, document_id, analysis_type, content, created_at)."""
+async def list_document_results(document_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Все результаты анализа по документу с полным содержимым, новые первыми (прежний формат ответа).
+    Для больших историй — GET /api/v2/documents/{id}/results: постранично и с превью.
+    """
     from backend.models import Document, Result
 
-    doc = db.query(Document).filter(Document.id == document_id).first()
+    doc = await db.get(Document, document_id)
     if not doc:
         raise HTTPException(status_code=404, detail="Документ не найден")
-    results = db.query(Result).filter(Result.document_id == document_id).order_by(Result.created_at.desc()).all()
+    results = await db.scalars(
+        select(Result)
+        .where(Result.document_id == document_id)
+        .order_by(Result.created_at.desc(), Result.id.desc())
+    )
     return [
         ResultListItem(
             id=r.id,
             document_id=r.document_id,
             analysis_type=r.analysis_type,
             content=r.content,
+            model=r.model,
+            created_at=r.created_at,
+        )
+        for r in results
+    ]
+
+
+@app.get("/api/v2/documents/{document_id}/results", response_model=list[ResultSummaryItem])
+async def list_document_result_summaries(
+    document_id: int,
+    response: Response,
+    cursor: str | None = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Список результатов анализа по документу, новые первыми: метаданные и превью содержимого
+    (полный текст — GET /api/results/{id}). Постранично, курсор — в заголовке X-Next-Cursor.
+    """
+    from backend.models import Document, Result
+
+    try:
+        check_page_size(limit)
+        after = after_cursor(Result.created_at, Result.id, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    doc = await db.get(Document, document_id)
+    if not doc:
+        raise HTTPException(status_code=404, detail="Документ не найден")
+    # Превью и длина считаются в БД — полный content не читается
+    query = (
+        select(
+            Result.id,
+            Result.document_id,
+            Result.analysis_type,
+            func.substr(Result.content, 1, PREVIEW_CHARS).label("preview"),
+            func.length(Result.content).label("content_length"),
+            Result.model,
+            Result.created_at,
+        )
+        .where(Result.document_id == document_id)
+        .order_by(Result.created_at.desc(), Result.id.desc())
+        .limit(limit + 1)
+    )
+    if after is not None:
+        query = query.where(after)
+    results, next_cursor = split_page((await db.execute(query)).all(), limit, "created_at")
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return [
+        ResultSummaryItem(
+            id=r.id,
+            document_id=r.document_id,
+            analysis_type=r.analysis_type,
+            preview=r.preview or "",
+            content_length=r.content_length or 0,
+            model=r.model,
             created_at=r.created_at,
         )
         for r in results
@@ -330,11 +869,11 @@ def list_document_results(document_id: int, db: Session = Depends(get_db)):
 
 
 @app.get("/api/results/{result_id}", response_model=ResultDetailResponse)
-def get_result(result_id: int, db: Session = Depends(get_db)):
+async def get_result(result_id: int, db: AsyncSession = Depends(get_db)):
     """Полный результат анализа по id (для страницы результата)."""
     from backend.models import Result
 
-    result = db.query(Result).filter(Result.id == result_id).first()
+    result = await db.get(Result, result_id)
     if not result:
         raise HTTPException(status_code=404, detail="Результат не найден")
     return ResultDetailResponse(
@@ -342,6 +881,7 @@ def get_result(result_id: int, db: Session = Depends(get_db)):
         document_id=result.document_id,
         analysis_type=result.analysis_type,
         content=result.content,
+        model=result.model,
         created_at=result.created_at,
     )
 
@@ -364,7 +904,7 @@ def demo_document():
 
 
 @app.post("/api/demo/run", response_model=DemoRunResponse)
-def demo_run(body: DemoRunRequest, db: Session = Depends(get_db)):
+async def demo_run(body: DemoRunRequest, db: AsyncSession = Depends(get_db)):
     """
     Загружает демо-документ из backend/demo/demo_report.pdf для пользователя,
     сохраняет как обычную загрузку, запускает анализ (summary), возвращает result_id.
@@ -372,14 +912,16 @@ def demo_run(body: DemoRunRequest, db: Session = Depends(get_db)):
     """
     from backend.models import User
 
-    user = db.query(User).filter(User.id == body.user_id).first()
+    user = await db.get(User, body.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     try:
-        content = get_demo_pdf_bytes()
-        doc = save_upload(content, DEMO_FILENAME, body.user_id, db)
-        result = run_analysis(doc.id, "summary", db, audience=body.audience)
+        content = await asyncio.to_thread(get_demo_pdf_bytes)
+        doc = await save_upload(content, DEMO_FILENAME, body.user_id, db)
+        result = await run_analysis(doc.id, "summary", db, audience=body.audience)
         return DemoRunResponse(document_id=doc.id, result_id=result.id)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
     except FileNotFoundError as e:
         logger.warning("Демо-файл не найден: %s", e)
         raise HTTPException(
@@ -392,14 +934,17 @@ def demo_run(body: DemoRunRequest, db: Session = Depends(get_db)):
 
 
 @app.post("/api/ai-magic", response_model=AIMagicResponse)
-def ai_magic(body: AIMagicRequest, db: Session = Depends(get_db)):
+async def ai_magic(body: AIMagicRequest, db: AsyncSession = Depends(get_db)):
     """
     Генерирует AI Magic отчёт: документ + готовые анализы → один запрос к LLM.
-    Промпт загружается из docs/AI_MAGIC_PROMPT.md.
+    Промпт загружается из docs/AI_MAGIC_PROMPT.md. Если документ, анализы, аудитория и промпт
+    не менялись, сохранённый отчёт возвращается без запроса к LLM.
     """
     try:
-        report = run_ai_magic(body.document_id, db, audience=body.audience)
-        return AIMagicResponse(report=report)
+        report, cached = await run_ai_magic(body.document_id, db, audience=body.audience)
+        return AIMagicResponse(report=report.content, result_id=report.id, cached=cached, model=report.model)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
     except FileNotFoundError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except ValueError as e:
@@ -420,42 +965,136 @@ def ai_magic(body: AIMagicRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=502, detail=msg or "Ошибка при генерации отчёта.")
 
 
-@app.post("/api/export-report")
-def export_report(body: ExportReportRequest):
+@app.post("/api/ai-magic/stream")
+async def ai_magic_stream(body: AIMagicRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Потоковая генерация AI Magic отчёта (text/event-stream).
+    События: progress {stage, done, total}, token {text}, done {report, result_id, cached}, error {detail}.
+    Сохранённый отчёт для тех же входных данных отдаётся одним событием token. Сборка входа нового отчёта
+    (со сжатием длинного документа по частям) идёт уже внутри потока.
+    """
+    try:
+        stored, _ = await find_ai_magic_report(body.document_id, db, audience=body.audience)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        msg = str(e)
+        if "не найден" in msg:
+            raise HTTPException(status_code=404, detail=msg)
+        raise HTTPException(status_code=400, detail=msg)
+
+    if stored is not None:
+
+        async def stored_events():
+            yield _sse("token", {"text": stored.content})
+            yield _sse("done", {"report": stored.content, "result_id": stored.id, "cached": True})
+
+        return StreamingResponse(stored_events(), media_type="text/event-stream", headers=_SSE_HEADERS)
+    try:
+        check_admission()
+        _check_any_model_available(AI_MAGIC_TYPE)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+    input_key = None
+
+    async def prepare(on_progress):
+        nonlocal input_key
+        # Отдельная сессия: зависимость get_db может быть закрыта к началу потока
+        async with AsyncSessionLocal() as session:
+            system_prompt, user_content, input_key = await build_ai_magic_prompt(
+                body.document_id, session, audience=body.audience, on_progress=on_progress
+            )
+        return system_prompt, user_content
+
+    async def on_done(report: str) -> dict:
+        async with AsyncSessionLocal() as session:
+            result = await save_ai_magic_report(body.document_id, input_key, report, session, model=served_model())
+        return {"report": report, "result_id": result.id, "cached": False}
+
+    return StreamingResponse(
+        _prepared_stream_events(prepare, partial(_stream_llm_events, on_done=on_done)),
+        media_type="text/event-stream",
+        headers=_SSE_HEADERS,
+    )
+
+
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in if_none_match.split(",")}
+    return "*" in tags or f'"{etag}"' in tags
+
+
+async def _report_pdf_response(text: str, if_none_match: str | None) -> Response:
     """
-    Генерирует PDF из текста AI Magic отчёта и возвращает файл для скачивания.
+    PDF отчёта с ETag (хеш содержимого): из кэша или после рендера в пуле процессов.
+    При совпадении If-None-Match — 304 без тела: ETag считается по тексту, без чтения кэша и рендера.
     """
+    text = text.strip() or " "
+    etag = report_etag(text)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
     try:
-        text = (body.report_text or "").strip()
-        if not text:
-            text = " "
-        pdf_bytes = report_text_to_pdf(text)
+        pdf_bytes, _ = await render_report_pdf(text)
     except Exception as e:
         logger.exception("Ошибка генерации PDF отчёта: %s", e)
         raise HTTPException(status_code=500, detail="Не удалось сформировать PDF.")
-    return Response(
-        content=pdf_bytes,
-        media_type="application/pdf",
-        headers={"Content-Disposition": 'attachment; filename="DocMind_Report.pdf"'},
-    )
+    headers["Content-Disposition"] = 'attachment; filename="DocMind_Report.pdf"'
+    return Response(content=pdf_bytes, media_type="application/pdf", headers=headers)
+
+
+@app.post("/api/export-report")
+async def export_report(
+    body: ExportReportRequest,
+    db: AsyncSession = Depends(get_db),
+    if_none_match: str | None = Header(None),
+):
+    """
+    Генерирует PDF из отчёта и возвращает файл для скачивания.
+    Отчёт берётся из results по result_id (текст не пересылается клиентом) или из report_text.
+    """
+    text = body.report_text or ""
+    if body.result_id is not None:
+        from backend.models import Result
+
+        result = await db.get(Result, body.result_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Результат не найден")
+        text = result.content
+    return await _report_pdf_response(text, if_none_match)
+
+
+@app.get("/api/results/{result_id}/report.pdf")
+async def result_report_pdf(
+    result_id: int,
+    db: AsyncSession = Depends(get_db),
+    if_none_match: str | None = Header(None),
+):
+    """PDF сохранённого результата (отчёт AI Magic или анализ) с поддержкой условного GET (ETag)."""
+    from backend.models import Result
+
+    result = await db.get(Result, result_id)
+    if not result:
+        raise HTTPException(status_code=404, detail="Результат не найден")
+    return await _report_pdf_response(result.content, if_none_match)
 
 
 @app.get("/debug/db")
-def debug_db():
+async def debug_db(db: AsyncSession = Depends(get_db)):
     """
     Временный эндпоинт: создаёт тестового пользователя (или возвращает существующего) и проверяет БД.
     Удалить или отключить в продакшене.
     """
-    db = SessionLocal()
     try:
         from backend.models import User
 
-        user = db.query(User).filter(User.username == "test_user_debug").first()
+        user = await db.scalar(select(User).where(User.username == "test_user_debug"))
         if not user:
             user = User(username="test_user_debug")
             db.add(user)
-            db.commit()
-            db.refresh(user)
+            await db.commit()
+            await db.refresh(user)
             message = "Тестовый пользователь создан"
         else:
             message = "Тестовый пользователь уже существует"
@@ -466,10 +1105,45 @@ def debug_db():
             "username": user.username,
         }
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         return {"status": "error", "message": str(e)}
-    finally:
-        db.close()
+
+
+@app.get("/debug/stats")
+async def debug_stats(db: AsyncSession = Depends(get_db)):
+    """
+    Счётчики кэшей (извлечённый текст, ответы LLM), клиента, ограничителя и повторов LLM,
+    пула соединений БД и очереди задач.
+    """
+    return {
+        "db_pool": pool_stats(),
+        "text_cache": text_cache.cache_stats(),
+        "llm_cache": llm_cache.cache_stats(),
+        "llm_client": client_stats(),
+        "llm_limiter": limiter_stats(),
+        "llm_resilience": resilience_stats(),
+        "llm_router": router_stats(),
+        "jobs": await queue_stats(db),
+    }
+
+
+@app.get("/metrics")
+async def prometheus_metrics(db: AsyncSession = Depends(get_db)):
+    """
+    Метрики в формате Prometheus: длительность стадий (extract, prompt, llm, db_commit, …) по эндпоинту,
+    типу анализа и файла, HTTP-запросы, токены LLM, скорость загрузок; плюс счётчики из /debug/stats.
+    """
+    body = metrics.render({
+        "docmind_db_pool": pool_stats(),
+        "docmind_text_cache": text_cache.cache_stats(),
+        "docmind_llm_cache": llm_cache.cache_stats(),
+        "docmind_llm_client": client_stats(),
+        "docmind_llm_limiter": limiter_stats(),
+        "docmind_llm_resilience": resilience_stats(),
+        "docmind_llm_router": router_stats(),
+        "docmind_jobs": await queue_stats(db),
+    })
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 # Раздача фронтенда: каталог frontend/ в корне проекта
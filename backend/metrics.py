@@ -0,0 +1,332 @@
+"""
+Метрики DocMind в формате Prometheus (GET /metrics): длительность стадий обработки, HTTP-запросы,
+токены LLM, скорость загрузок и запросы в работе.
+
+Стадии (extract, prompt, llm, llm_first_token, db_commit, upload_save, pdf_render) размечаются
+эндпоинтом, типом анализа и типом файла. Метки берутся из контекста запроса (contextvars):
+эндпоинт — из маршрута, тип анализа и файла сервисы добавляют через tag(), поэтому их не нужно
+передавать через все вызовы. Запись — блокировка и bisect по границам корзин, без зависимостей.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from backend import tracing
+
+# Границы корзин гистограмм длительности, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# Скорость загрузки, байт/с: от 100 КБ/с до 1 ГБ/с
+RATE_BUCKETS = (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9)
+
+STAGE_LABELS = ("stage", "endpoint", "analysis_type", "file_type")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(n) or "") for n in self.labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...] = (), buckets=DURATION_BUCKETS) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        # метки -> [счётчики по корзинам (последняя — +Inf), сумма]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        self.observe_key(value, self._key(labels))
+
+    def observe_key(self, value: float, key: tuple[str, ...]) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(v[0]), v[1]) for k, v in self._values.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "docmind_stage_duration_seconds", "Длительность стадии обработки", STAGE_LABELS
+)
+HTTP_SECONDS = Histogram(
+    "docmind_http_request_duration_seconds", "Длительность HTTP-запроса", ("endpoint", "method", "status")
+)
+HTTP_IN_FLIGHT = Gauge("docmind_http_requests_in_flight", "HTTP-запросы в обработке")
+LLM_IN_FLIGHT = Gauge("docmind_llm_requests_in_flight", "Запросы к LLM в ожидании ответа", ("model",))
+LLM_REQUESTS = Counter(
+    "docmind_llm_requests_total", "Запросы к LLM по исходу (ok, error, cancelled, cache_hit, circuit_open)",
+    ("model", "outcome"),
+)
+LLM_RETRIES = Counter(
+    "docmind_llm_retries_total", "Повторы запросов к LLM по причине (429, 5xx, timeout, connection)", ("model", "reason")
+)
+LLM_HEDGES = Counter(
+    "docmind_llm_hedges_total", "Дублирующие запросы к LLM (started, won, lost, skipped)", ("model", "outcome")
+)
+LLM_FALLBACKS = Counter(
+    "docmind_llm_fallbacks_total", "Переходы к запасной модели цепочки: модель, которая не ответила, и причина",
+    ("model", "reason"),
+)
+LLM_BREAKER_STATE = Gauge(
+    "docmind_llm_breaker_state", "Автомат отключения модели: 0 — закрыт, 1 — открыт, 2 — пробный запрос", ("model",)
+)
+LLM_TOKENS = Counter(
+    "docmind_llm_tokens_total", "Токены из поля usage ответа LLM (prompt, completion)", ("model", "kind")
+)
+UPLOAD_BYTES = Counter("docmind_upload_bytes_total", "Байт принято в загрузках документов", ("file_type",))
+UPLOAD_RATE = Histogram(
+    "docmind_upload_bytes_per_second", "Скорость приёма загрузки", ("file_type",), buckets=RATE_BUCKETS
+)
+PDF_CACHE = Counter("docmind_pdf_cache_requests_total", "Экспорт PDF: кэш (hit) или рендер (miss)", ("outcome",))
+
+_REGISTRY: list[_Metric] = [
+    STAGE_SECONDS,
+    HTTP_SECONDS,
+    HTTP_IN_FLIGHT,
+    LLM_IN_FLIGHT,
+    LLM_REQUESTS,
+    LLM_TOKENS,
+    LLM_RETRIES,
+    LLM_HEDGES,
+    LLM_FALLBACKS,
+    LLM_BREAKER_STATE,
+    UPLOAD_BYTES,
+    UPLOAD_RATE,
+    PDF_CACHE,
+]
+
+
+# --- Контекст запроса: метки стадий ---
+
+# {"scope": ASGI scope, "endpoint"/"analysis_type"/"file_type": ...}; словарь не меняется на месте —
+# tag() создаёт копию, чтобы параллельные задачи (asyncio.gather) не перетирали метки друг друга
+_context: ContextVar[dict | None] = ContextVar("docmind_metrics_context", default=None)
+
+
+def tag(**labels) -> None:
+    """Добавляет метки стадий в текущий контекст (видны в этой задаче и вызванных из неё)."""
+    _context.set({**(_context.get() or {}), **labels})
+
+
+@contextmanager
+def context(**labels):
+    """Новый контекст меток на время блока (например, фоновая задача вне HTTP-запроса)."""
+    token = _context.set(labels)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def file_type(filename: str | None) -> str:
+    """Тип файла для метки: расширение без точки (pdf, docx, txt)."""
+    if not filename or "." not in filename:
+        return ""
+    return filename.rsplit(".", 1)[-1].lower()
+
+
+def _route_path(scope: dict | None) -> str:
+    route = scope.get("route") if scope else None
+    path = getattr(route, "path", None)
+    # Шаблон маршрута (/api/results/{result_id}), а не сам путь — иначе метка на каждый id
+    return path if path else "other"
+
+
+def current_labels() -> dict:
+    ctx = _context.get() or {}
+    return {
+        "endpoint": ctx.get("endpoint") or (_route_path(ctx.get("scope")) if ctx.get("scope") else ""),
+        "analysis_type": ctx.get("analysis_type", ""),
+        "file_type": ctx.get("file_type", ""),
+    }
+
+
+@contextmanager
+def stage(name: str, **labels):
+    """
+    Замеряет блок как стадию name с метками контекста (labels дополняют/переопределяют их).
+    Если запрос трассируется, стадия становится спаном трассы (backend/tracing.py).
+    """
+    span = tracing.begin(name, **labels)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        values = {**current_labels(), **labels, "stage": name}
+        STAGE_SECONDS.observe(elapsed, **values)
+        if span is not None:
+            tracing.finish(span)
+
+
+def observe_stage(name: str, seconds: float, **labels) -> None:
+    """Записывает уже измеренную длительность стадии (например, время до первого токена)."""
+    STAGE_SECONDS.observe(seconds, **{**current_labels(), **labels, "stage": name})
+
+
+def record_llm_usage(model: str, usage) -> None:
+    """Токены из usage ответа OpenAI-совместимого API (объект SDK или dict); без usage — ничего."""
+    if usage is None:
+        return
+    get = usage.get if isinstance(usage, dict) else lambda k: getattr(usage, k, None)
+    for kind in ("prompt", "completion"):
+        value = get(f"{kind}_tokens")
+        if value:
+            LLM_TOKENS.inc(value, model=model, kind=kind)
+
+
+def record_upload(filename: str, size: int, seconds: float) -> None:
+    ft = file_type(filename)
+    UPLOAD_BYTES.inc(size, file_type=ft)
+    if seconds > 0 and size:
+        UPLOAD_RATE.observe(size / seconds, file_type=ft)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: длительность HTTP-запросов по шаблону маршрута и статусу, запросы в обработке.
+    Для потоковых ответов (SSE) время считается до конца тела ответа. /metrics не учитывается.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] == "/metrics":
+            await self.app(scope, receive, send)
+            return
+        token = _context.set({"scope": scope})
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            HTTP_SECONDS.observe(
+                time.perf_counter() - start,
+                endpoint=_route_path(scope),
+                method=scope["method"],
+                status=status,
+            )
+            _context.reset(token)
+
+
+# --- Вывод ---
+
+
+def _stats_lines(prefix: str, stats: dict) -> list[str]:
+    """Числовые поля словаря статистики (pool_stats(), cache_stats() …) как gauge prefix_<поле>."""
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{key}"
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_format_value(value)}")
+    return lines
+
+
+def render(stats: dict[str, dict] | None = None) -> str:
+    """
+    Текст для GET /metrics (Prometheus text format 0.0.4).
+    stats — снимки счётчиков других модулей {префикс: словарь}, выводятся как gauge.
+    """
+    lines: list[str] = []
+    for metric in _REGISTRY:
+        lines.extend(metric.render())
+    for prefix, values in (stats or {}).items():
+        lines.extend(_stats_lines(prefix, values))
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,10 @@
 """
-Модели SQLAlchemy: User, Document, Result.
+Модели SQLAlchemy: User, Document, Result, Blob, Job.
 """
 
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text
 from sqlalchemy.orm import relationship
 
 from backend.database import Base
@@ -22,11 +22,14 @@ class User(Base):
 
 class Document(Base):
     __tablename__ = "documents"
+    # Список документов пользователя: WHERE user_id = ? ORDER BY uploaded_at DESC
+    __table_args__ = (Index("ix_documents_user_id_uploaded_at", "user_id", "uploaded_at"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     filename = Column(String(255), nullable=False)
     file_path = Column(String(512), nullable=False)  # путь к файлу на диске
+    content_hash = Column(String(64), index=True)  # SHA-256 содержимого (blobs.content_hash); NULL у старых загрузок
     uploaded_at = Column(DateTime, default=datetime.utcnow)
 
     user = relationship("User", back_populates="documents")
@@ -35,11 +38,51 @@ class Document(Base):
 
 class Result(Base):
     __tablename__ = "results"
+    # Результаты документа: WHERE document_id = ? ORDER BY created_at DESC
+    __table_args__ = (Index("ix_results_document_id_created_at", "document_id", "created_at"),)
 
     id = Column(Integer, primary_key=True, index=True)
     document_id = Column(Integer, ForeignKey("documents.id"), nullable=False)
-    analysis_type = Column(String(64), nullable=False)  # summary, action_items, risks, explain_simple
+    analysis_type = Column(String(64), nullable=False)  # summary, action_items, risks, explain_simple, ai_magic
     content = Column(Text, nullable=False)
+    # Для ai_magic: хеш входных данных (аудитория, версия промпта, id анализов) — для повторного использования
+    input_key = Column(String(64), index=True)
+    # Модель, ответившая на итоговый запрос (после маршрутизации и запасных моделей); NULL — до появления колонки
+    model = Column(String(128))
     created_at = Column(DateTime, default=datetime.utcnow)
 
     document = relationship("Document", back_populates="results")
+
+
+class Blob(Base):
+    """Файл в контентно-адресуемом хранилище: одно содержимое хранится один раз, Document ссылаются по хешу."""
+
+    __tablename__ = "blobs"
+
+    content_hash = Column(String(64), primary_key=True)  # SHA-256 содержимого
+    file_path = Column(String(512), nullable=False)  # uploads/blobs/ab/abcdef...
+    size = Column(Integer, nullable=False)
+    ref_count = Column(Integer, nullable=False, default=0)  # число Document, ссылающихся на blob
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Job(Base):
+    """Фоновая задача (анализ или AI Magic). Таблица служит очередью: воркеры забирают queued-задачи."""
+
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(32), nullable=False)  # analysis | ai_magic
+    # Без внешних ключей: удаление документа не должно блокироваться историей задач
+    document_id = Column(Integer, nullable=False)
+    analysis_type = Column(String(64))  # для kind=analysis
+    audience = Column(String(32))
+    status = Column(String(16), nullable=False, default="queued", index=True)  # queued | running | done | failed
+    attempts = Column(Integer, nullable=False, default=0)
+    result_id = Column(Integer)  # сохранённый результат (для ai_magic — отчёт в results)
+    report = Column(Text)  # для kind=ai_magic
+    error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    locked_until = Column(DateTime)  # аренда running-задачи; после истечения задача считается зависшей
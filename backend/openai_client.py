@@ -1,19 +1,28 @@
 """
 Клиент LLM через OpenRouter: чтение ключа из окружения, вызов chat completions.
 OpenRouter — единый API для разных моделей (OpenAI, Anthropic и др.).
+Один клиент на процесс с пулом keep-alive соединений (пересоздаётся при смене ключа).
+Модель выбирается по размеру запроса с цепочкой запасных — backend/llm_router.py;
+повторы, дублирующие запросы и отключение сбойной модели — backend/llm_resilience.py.
 """
 
+import asyncio
 import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
 
 from dotenv import load_dotenv
 
-load_dotenv()
+from backend import llm_cache, llm_limiter, llm_resilience, llm_router, metrics
+from backend.llm_router import DEFAULT_MODEL
 
-# Base URL OpenRouter (OpenAI-совместимый API)
-OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+load_dotenv()
 
-# Модель: только DeepSeek через OpenRouter
-DEFAULT_MODEL = "deepseek/deepseek-chat"
+# Base URL OpenRouter (OpenAI-совместимый API). OPENROUTER_BASE_URL в .env — другой совместимый сервер,
+# например локальная заглушка для нагрузочных тестов (benchmarks/mock_openrouter.py)
+OPENROUTER_BASE_URL = os.environ.get("OPENROUTER_BASE_URL", "").strip() or "https://openrouter.ai/api/v1"
 
 # Лимит токенов ответа. При 402 (недостаточно кредитов) уменьшите или задайте OPENROUTER_MAX_TOKENS в .env
 def _max_tokens() -> int:
@@ -26,36 +35,393 @@ def _max_tokens() -> int:
     return 1200  # при пополненном балансе — более полные ответы; при 402 задайте OPENROUTER_MAX_TOKENS меньше
 
 
+def _env_number(name: str, default: float, cast=float):
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0, cast(v))
+        except ValueError:
+            pass
+    return default
+
+
+def _http_client_options() -> dict:
+    """
+    Настройки пула и таймаутов HTTP-клиента (переменные окружения, см. .env.example).
+    """
+    return {
+        "max_connections": _env_number("OPENROUTER_POOL_MAX_CONNECTIONS", 100, int),
+        "max_keepalive_connections": _env_number("OPENROUTER_POOL_MAX_KEEPALIVE", 20, int),
+        "keepalive_expiry": _env_number("OPENROUTER_KEEPALIVE_EXPIRY_SECONDS", 60.0),
+        "connect_timeout": _env_number("OPENROUTER_CONNECT_TIMEOUT_SECONDS", 10.0),
+        "timeout": _env_number("OPENROUTER_TIMEOUT_SECONDS", 120.0),
+    }
+
+
+class _ClientManager:
+    """
+    Держит по одному OpenAI-клиенту на процесс (sync и async) поверх httpx с keep-alive.
+    Пересоздаёт клиенты, если изменился API-ключ. Считает создание клиентов и новые TCP-соединения.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._api_key: str | None = None
+        self._async_api_key: str | None = None
+        self._stats = {
+            "clients_created": 0,
+            "requests": 0,
+            "connections_opened": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self._stats[name] += 1
+
+    def _trace(self, event_name: str, info: dict) -> None:
+        # Трассировка httpcore: новое TCP-соединение = пул не смог переиспользовать существующее
+        if event_name == "connection.connect_tcp.complete":
+            self._count("connections_opened")
+
+    async def _atrace(self, event_name: str, info: dict) -> None:
+        self._trace(event_name, info)
+
+    def _on_request(self, request) -> None:
+        request.extensions["trace"] = self._trace
+        self._count("requests")
+
+    async def _on_request_async(self, request) -> None:
+        request.extensions["trace"] = self._atrace
+        self._count("requests")
+
+    @staticmethod
+    def _http_kwargs() -> dict:
+        import httpx
+
+        opts = _http_client_options()
+        return {
+            "limits": httpx.Limits(
+                max_connections=opts["max_connections"],
+                max_keepalive_connections=opts["max_keepalive_connections"],
+                keepalive_expiry=opts["keepalive_expiry"],
+            ),
+            "timeout": httpx.Timeout(opts["timeout"], connect=opts["connect_timeout"]),
+        }
+
+    def _build(self, api_key: str):
+        import httpx
+        from openai import OpenAI
+
+        http_client = httpx.Client(event_hooks={"request": [self._on_request]}, **self._http_kwargs())
+        # max_retries=0: повторами управляет llm_resilience (джиттер, Retry-After, автомат отключения)
+        return OpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key, http_client=http_client, max_retries=0)
+
+    def _build_async(self, api_key: str):
+        import httpx
+        from openai import AsyncOpenAI
+
+        http_client = httpx.AsyncClient(event_hooks={"request": [self._on_request_async]}, **self._http_kwargs())
+        return AsyncOpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key, http_client=http_client, max_retries=0)
+
+    def get(self, api_key: str):
+        """Возвращает общий клиент; при смене ключа создаёт новый."""
+        with self._lock:
+            if self._client is None or self._api_key != api_key:
+                # Старый клиент не закрываем: на нём могут выполняться запросы в других потоках
+                self._client = self._build(api_key)
+                self._api_key = api_key
+                self._stats["clients_created"] += 1
+            return self._client
+
+    def get_async(self, api_key: str):
+        """Возвращает общий async-клиент (для event loop приложения); при смене ключа создаёт новый."""
+        with self._lock:
+            if self._async_client is None or self._async_api_key != api_key:
+                self._async_client = self._build_async(api_key)
+                self._async_api_key = api_key
+                self._stats["clients_created"] += 1
+            return self._async_client
+
+    async def aclose(self) -> None:
+        """Закрывает async-клиент (при остановке приложения)."""
+        with self._lock:
+            client, self._async_client = self._async_client, None
+            self._async_api_key = None
+        if client is not None:
+            await client.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["connections_reused"] = max(0, stats["requests"] - stats["connections_opened"])
+        stats.update(_http_client_options())
+        return stats
+
+
+_clients = _ClientManager()
+
+
+def client_stats() -> dict:
+    """Статистика общего клиента: создания клиента, запросы, открытые и переиспользованные соединения."""
+    return _clients.stats()
+
+
+async def aclose_clients() -> None:
+    """Закрывает пул соединений async-клиента. Вызывается в lifespan при остановке."""
+    await _clients.aclose()
+
+
 def get_api_key() -> str | None:
     """Возвращает OPENROUTER_API_KEY из переменных окружения."""
     return os.environ.get("OPENROUTER_API_KEY")
 
 
-def complete(system_prompt: str, user_content: str, model: str | None = None) -> str:
-    """
-    Вызов Chat Completions через OpenRouter (OpenAI-совместимый API).
-    system_prompt — инструкция для модели, user_content — текст документа.
-    Возвращает текст ответа ассистента.
-    Выбрасывает ValueError, если ключ не задан; пробрасывает ошибки API.
-    """
+def _require_api_key() -> str:
     api_key = get_api_key()
     if not api_key or not api_key.strip():
         raise ValueError(
             "OPENROUTER_API_KEY не задан. Создайте файл .env с OPENROUTER_API_KEY=ваш_ключ"
         )
-    from openai import OpenAI
-
-    client = OpenAI(base_url=OPENROUTER_BASE_URL, api_key=api_key)
-    model = model or DEFAULT_MODEL
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_content},
-        ],
-        max_tokens=_max_tokens(),
-    )
+    return api_key
+
+
+def _messages(system_prompt: str, user_content: str) -> list[dict]:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def _response_text(response) -> str:
     message = response.choices[0].message
     if not message or not message.content:
         return ""
     return message.content.strip()
+
+
+# Модель, ответившая на последний запрос к LLM в текущей задаче (для Result.model)
+_served_model: ContextVar[str | None] = ContextVar("docmind_served_model", default=None)
+
+
+def served_model() -> str | None:
+    """
+    Модель, ответившая на последний запрос complete()/acomplete()/astream_complete() в текущем контексте.
+    При ответе из кэша — модель, сохранённая вместе с ответом.
+    """
+    return _served_model.get()
+
+
+def _chain(system_prompt: str, user_content: str, model: str | None) -> list[str]:
+    """Явно заданная модель — без маршрутизации, иначе цепочка llm_router."""
+    return [model] if model else llm_router.route(system_prompt, user_content)
+
+
+def _cache_key(chain: list[str], max_tokens: int, system_prompt: str, user_content: str) -> str:
+    # Ключ не зависит от порядка цепочки: понижение медленной модели не сбрасывает кэш
+    return llm_cache.make_key("|".join(sorted(chain)), max_tokens, system_prompt, user_content)
+
+
+def _cache_hit(cached: tuple[str, str | None], chain: list[str]) -> str:
+    """Ответ из кэша: модель — та, что дала ответ (у старых записей без модели — первая в цепочке)."""
+    content, model = cached
+    model = model or chain[0]
+    metrics.LLM_REQUESTS.inc(model=model, outcome="cache_hit")
+    _served_model.set(model)
+    return content
+
+
+def _fall_back(chain: list[str], index: int, error: BaseException) -> bool:
+    """Переходить ли к следующей модели цепочки после ошибки chain[index]; считает переход."""
+    reason = llm_router.fallback_reason(error) if isinstance(error, Exception) else None
+    if reason is None or index == len(chain) - 1:
+        return False
+    llm_router.record_fallback(chain[index], reason)
+    return True
+
+
+def _fallback_timeout(chain: list[str], index: int) -> float | None:
+    """Сколько ждать ответа модели, прежде чем отдать запрос следующей (у последней — без ограничения)."""
+    timeout = llm_router.router_options()["fallback_timeout_seconds"]
+    return timeout if timeout and index < len(chain) - 1 else None
+
+
+@contextmanager
+def _llm_call(model: str):
+    """Стадия llm в метриках: время запроса, запросы в ожидании, исход (ok/error/cancelled)."""
+    metrics.LLM_IN_FLIGHT.inc(model=model)
+    try:
+        with metrics.stage("llm"):
+            yield
+    except (asyncio.CancelledError, GeneratorExit):
+        # Клиент отключился или поток закрыт до конца
+        metrics.LLM_REQUESTS.inc(model=model, outcome="cancelled")
+        raise
+    except BaseException:
+        metrics.LLM_REQUESTS.inc(model=model, outcome="error")
+        raise
+    else:
+        metrics.LLM_REQUESTS.inc(model=model, outcome="ok")
+    finally:
+        metrics.LLM_IN_FLIGHT.dec(model=model)
+
+
+def complete(system_prompt: str, user_content: str, model: str | None = None) -> str:
+    """
+    Вызов Chat Completions через OpenRouter (OpenAI-совместимый API).
+    system_prompt — инструкция для модели, user_content — текст документа.
+    Возвращает текст ответа ассистента.
+    Без model модель выбирает llm_router; при ошибке модели запрос переходит к следующей в цепочке.
+    Выбрасывает ValueError, если ключ не задан; пробрасывает ошибки API.
+    При DOCMIND_LLM_CACHE=1 одинаковые запросы отдаются из кэша (backend/llm_cache.py).
+    """
+    api_key = _require_api_key()
+    chain = _chain(system_prompt, user_content, model)
+    max_tokens = _max_tokens()
+    cache_key = None
+    if llm_cache.enabled():
+        cache_key = _cache_key(chain, max_tokens, system_prompt, user_content)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return _cache_hit(cached, chain)
+
+    client = _clients.get(api_key)
+
+    def attempt_for(model: str):
+        def attempt():
+            with _llm_call(model):
+                return client.chat.completions.create(
+                    model=model,
+                    messages=_messages(system_prompt, user_content),
+                    max_tokens=max_tokens,
+                )
+
+        return attempt
+
+    for index, model in enumerate(chain):
+        try:
+            response = llm_resilience.call(model, attempt_for(model))
+            break
+        except Exception as e:
+            if not _fall_back(chain, index, e):
+                raise
+    _served_model.set(model)
+    metrics.record_llm_usage(model, getattr(response, "usage", None))
+    content = _response_text(response)
+    if cache_key and content:
+        llm_cache.put(cache_key, content, model)
+    return content
+
+
+async def acomplete(system_prompt: str, user_content: str, model: str | None = None) -> str:
+    """
+    Асинхронный вариант complete(): не занимает поток на время запроса к OpenRouter.
+    Обращения к SQLite-кэшу ответов выполняются в пуле потоков.
+    """
+    api_key = _require_api_key()
+    chain = _chain(system_prompt, user_content, model)
+    max_tokens = _max_tokens()
+    cache_key = None
+    if llm_cache.enabled():
+        cache_key = _cache_key(chain, max_tokens, system_prompt, user_content)
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            return _cache_hit(cached, chain)
+
+    client = _clients.get_async(api_key)
+
+    def attempt_for(model: str):
+        async def attempt():
+            with _llm_call(model):
+                return await client.chat.completions.create(
+                    model=model,
+                    messages=_messages(system_prompt, user_content),
+                    max_tokens=max_tokens,
+                )
+
+        return attempt
+
+    # Слот общего ограничителя (очередь при перегрузке) держится на все попытки и запасные модели;
+    # хедж берёт второй слот
+    async with llm_limiter.limit():
+        for index, model in enumerate(chain):
+            try:
+                response = await asyncio.wait_for(
+                    llm_resilience.acall(model, attempt_for(model)), _fallback_timeout(chain, index)
+                )
+                break
+            except Exception as e:
+                if not _fall_back(chain, index, e):
+                    raise
+    _served_model.set(model)
+    metrics.record_llm_usage(model, getattr(response, "usage", None))
+    content = _response_text(response)
+    if cache_key and content:
+        await asyncio.to_thread(llm_cache.put, cache_key, content, model)
+    return content
+
+
+async def astream_complete(system_prompt: str, user_content: str, model: str | None = None):
+    """
+    Потоковый вариант acomplete(): асинхронный генератор фрагментов ответа по мере генерации.
+    При попадании в кэш ответ отдаётся одним фрагментом. Полный ответ сохраняется в кэш,
+    только если поток дочитан до конца. При отмене (разрыв соединения клиента) поток к OpenRouter закрывается.
+    К запасной модели запрос переходит, только пока клиенту не отдано ни одного фрагмента.
+    """
+    api_key = _require_api_key()
+    chain = _chain(system_prompt, user_content, model)
+    max_tokens = _max_tokens()
+    cache_key = None
+    if llm_cache.enabled():
+        cache_key = _cache_key(chain, max_tokens, system_prompt, user_content)
+        cached = await asyncio.to_thread(llm_cache.get, cache_key)
+        if cached is not None:
+            yield _cache_hit(cached, chain)
+            return
+
+    client = _clients.get_async(api_key)
+
+    def open_stream(model: str):
+        return lambda: client.chat.completions.create(
+            model=model,
+            messages=_messages(system_prompt, user_content),
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+    parts = []
+    # Слот ограничителя занят до конца потока. Стадия llm — весь поток; llm_first_token — ожидание первого фрагмента
+    async with llm_limiter.limit():
+        for index, model in enumerate(chain):
+            try:
+                with _llm_call(model):
+                    start = time.perf_counter()
+                    # Повторяется только открытие потока: после первых фрагментов ответ уже ушёл клиенту
+                    stream = await asyncio.wait_for(
+                        llm_resilience.acall(model, open_stream(model), hedge=False),
+                        _fallback_timeout(chain, index),
+                    )
+                    _served_model.set(model)
+                    try:
+                        async for chunk in stream:
+                            # Последний фрагмент (include_usage) — без choices, с usage
+                            metrics.record_llm_usage(model, getattr(chunk, "usage", None))
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                if not parts:
+                                    metrics.observe_stage("llm_first_token", time.perf_counter() - start)
+                                parts.append(delta)
+                                yield delta
+                    finally:
+                        await stream.close()
+                break
+            except Exception as e:
+                if parts or not _fall_back(chain, index, e):
+                    raise
+    content = "".join(parts).strip()
+    if cache_key and content:
+        await asyncio.to_thread(llm_cache.put, cache_key, content, model)
@@ -0,0 +1,65 @@
+"""
+Keyset-пагинация списков (документы пользователя, результаты документа).
+Страница задаётся курсором — позицией последней выданной строки (время, id), а не OFFSET:
+запрос идёт по составному индексу и не замедляется с ростом истории.
+Курсор непрозрачен для клиента: base64url от JSON, следующий курсор — в заголовке X-Next-Cursor.
+"""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Длина превью содержимого результата в списке (полный текст — GET /api/results/{id})
+PREVIEW_CHARS = 200
+
+
+def encode_cursor(created: datetime, row_id: int) -> str:
+    raw = json.dumps([created.isoformat(), row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """Разбирает курсор; при неверном формате — ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created, row_id = json.loads(raw)
+        return datetime.fromisoformat(created), int(row_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as e:
+        raise ValueError("Некорректный курсор пагинации") from e
+
+
+def check_page_size(limit: int) -> int:
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit должен быть от 1 до {MAX_PAGE_SIZE}")
+    return limit
+
+
+def after_cursor(time_column, id_column, cursor: str | None):
+    """
+    Условие WHERE для строк после курсора при сортировке (time DESC, id DESC).
+    Без курсора — None (первая страница).
+    """
+    if not cursor:
+        return None
+    created, row_id = decode_cursor(cursor)
+    return or_(time_column < created, and_(time_column == created, id_column < row_id))
+
+
+def split_page(rows: list, limit: int, time_attr: str) -> tuple[list, str | None]:
+    """
+    Запрос выбирает limit + 1 строк: лишняя строка означает, что есть следующая страница.
+    Возвращает (строки страницы, курсор следующей страницы или None).
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, time_attr), last.id)
@@ -12,6 +12,9 @@ EXPLAIN_SIMPLE = "explain_simple"
 ANALYSIS_TYPES = (SUMMARY, ACTION_ITEMS, RISKS, EXPLAIN_SIMPLE)
 
 
+# Лимит входа OpenRouter (prompt tokens). ~6000 символов ≈ 2000–2500 токенов, укладываемся в 7093
+MAX_USER_CONTENT_CHARS = 6_000
+
 # Роли аудитории (для персональности тона)
 AUDIENCE_OPTIONS = ("business", "legal", "manager", "student")
 
@@ -61,15 +64,62 @@ def get_system_prompt(analysis_type: str, audience: str | None = None) -> str:
     raise ValueError(f"Неизвестный тип анализа: {analysis_type}")
 
 
-def get_user_content(document_text: str) -> str:
+def get_user_content(document_text: str, max_chars: int | None = None) -> str:
     """
-    Текст документа для user-сообщения. Можно обрезать по длине, если нужно уложиться в лимиты.
+    Текст документа для user-сообщения, обрезанный до max_chars (по умолчанию MAX_USER_CONTENT_CHARS),
+    чтобы уложиться в контекст модели.
     """
     if not document_text or not document_text.strip():
         return "[Документ пуст или текст не извлечён.]"
-    # Лимит входа OpenRouter (prompt tokens). ~6000 символов ≈ 2000–2500 токенов, укладываемся в 7093
-    max_chars = 6_000
+    max_chars = max_chars or MAX_USER_CONTENT_CHARS
     text = document_text.strip()
     if len(text) > max_chars:
         text = text[:max_chars] + "\n\n[... документ обрезан из-за лимита длины ...]"
     return text
+
+
+# --- Анализ длинных документов по частям (backend/chunking.py) ---
+
+
+def get_chunk_system_prompt(analysis_type: str, audience: str | None = None) -> str:
+    """Системный промпт для одного фрагмента: та же задача, но только по своей части документа."""
+    return (
+        get_system_prompt(analysis_type, audience)
+        + "\n\nСейчас тебе передан только фрагмент большого документа. "
+        "Выполни задачу только по этому фрагменту, кратко, без вступлений. "
+        "Если во фрагменте нет ничего относящегося к задаче — ответь «Нет данных»."
+    )
+
+
+def get_reduce_system_prompt(analysis_type: str, audience: str | None = None) -> str:
+    """Системный промпт для сведения частичных результатов в один ответ."""
+    return (
+        get_system_prompt(analysis_type, audience)
+        + "\n\nНиже — результаты выполнения этой задачи по отдельным фрагментам одного документа. "
+        "Объедини их в единый ответ по всему документу: убери повторы, сохрани всё существенное, "
+        "не упоминай фрагменты."
+    )
+
+
+def get_notes_system_prompt() -> str:
+    """Системный промпт для сжатия фрагментов документа в заметки (вход AI Magic для длинных документов)."""
+    return (
+        "Ты — помощник по анализу документов. "
+        "Сожми переданный текст в плотные заметки: ключевые факты, цифры, сроки, стороны, обязательства, риски. "
+        "Без вступлений, списком. Язык — как в исходном тексте."
+    )
+
+
+def get_chunk_user_content(chunk: str, index: int, total: int, truncated: bool = False) -> str:
+    """User-сообщение для фрагмента: номер фрагмента и его текст."""
+    header = f"Фрагмент {index} из {total}"
+    if truncated:
+        header += " (документ слишком большой, анализируется только его начало)"
+    return f"{header}:\n\n{chunk.strip()}"
+
+
+def get_partials_user_content(partials: list[str]) -> str:
+    """User-сообщение для сведения: частичные результаты по порядку фрагментов."""
+    if not partials:
+        return "[Документ пуст или текст не извлечён.]"
+    return "\n\n".join(f"--- Часть {i} ---\n{p}" for i, p in enumerate(partials, 1))
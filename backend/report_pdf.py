@@ -1,15 +1,67 @@
 """
 Генерация PDF из текста AI Magic отчёта для экспорта.
 Поддерживает кириллицу через Unicode-шрифт (Arial/DejaVu или системный).
+Шрифт ищется и разбирается один раз на процесс (процессы пула — при старте), документ получает
+свежую копию из этого шаблона; готовые PDF кэшируются на диске по хешу содержимого
+(backend/cache/pdf/), рендер из async-кода выполняется в пуле процессов.
 """
 
+import asyncio
+import copy
+import hashlib
 import os
+import re
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from io import BytesIO
+from multiprocessing import get_context
 from pathlib import Path
 
+from backend import metrics, tracing
 
+# Версия вёрстки. Увеличивайте при изменении рендера — от неё зависит ключ кэша PDF.
+RENDER_VERSION = "3"
+
+# backend/cache/pdf/<etag>.pdf (путь без импорта backend.database: модуль загружается и в процессах пула)
+PDF_CACHE_DIR = Path(__file__).resolve().parent / "cache" / "pdf"
+
+_FONT_FAMILY = "UnicodeFont"
+_FONT_SIZE = 11
+_LINE_HEIGHT = 6
+_PARAGRAPH_GAP = 4
+
+# Управляющие символы (0–31, 127), кроме табуляции и перевода строки, — удаляются одним translate
+_CONTROL_CHARS = dict.fromkeys([*range(0, 9), *range(11, 32), 127])
+
+# Слова и промежутки между ними: пробелы внутри строки (выравнивание, отступы) сохраняются при переносе
+_TOKENS = re.compile(r"\S+|\s+")
+
+
+def _env_int(name: str, default: int, minimum: int = 0) -> int:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(minimum, int(v))
+        except ValueError:
+            pass
+    return default
+
+
+def _render_workers() -> int:
+    """Процессов для рендера PDF. DOCMIND_PDF_RENDER_WORKERS (0 — рендер в потоке)."""
+    return _env_int("DOCMIND_PDF_RENDER_WORKERS", 2)
+
+
+def _cache_max_bytes() -> int:
+    """Предел размера кэша PDF на диске. DOCMIND_PDF_CACHE_MAX_BYTES (0 — не кэшировать)."""
+    return _env_int("DOCMIND_PDF_CACHE_MAX_BYTES", 200 * 1024 * 1024)
+
+
+@lru_cache(maxsize=1)
 def _find_unicode_font() -> str | None:
-    """Возвращает путь к TTF-шрифту с поддержкой кириллицы или None."""
+    """Возвращает путь к TTF-шрифту с поддержкой кириллицы или None (поиск — один раз на процесс)."""
     root = Path(__file__).resolve().parent.parent
     backend_dir = Path(__file__).resolve().parent
     candidates = [
@@ -30,19 +82,104 @@ def _find_unicode_font() -> str | None:
     return None
 
 
-def _sanitize_ascii(text: str) -> str:
-    """Оставляет только ASCII (0–127), остальное заменяет на '?'. Гарантированно работает с Helvetica на любом сервере."""
-    return "".join(c if ord(c) < 128 else "?" for c in text)
+@lru_cache(maxsize=1)
+def _unicode_font_template():
+    """
+    Разобранный Unicode-шрифт (fpdf TTFFont: таблица символов, ширины, метрики) и байты TTF-файла
+    или None — шрифта нет или он не читается. Готовится один раз на процесс.
+    """
+    from fpdf import FPDF
+
+    font_path = _find_unicode_font()
+    if not font_path:
+        return None
+    try:
+        data = Path(font_path).read_bytes()
+        pdf = FPDF()
+        pdf.add_font(_FONT_FAMILY, "", font_path)
+    except Exception:
+        return None
+    return pdf.fonts[_FONT_FAMILY.lower()], data
+
 
+def _attach_unicode_font(pdf) -> bool:
+    """
+    Подключает Unicode-шрифт к документу копией разобранного шаблона (_unicode_font_template).
+    Своё у документа только то, что меняется при выводе: набор использованных глифов и шрифт fontTools,
+    который fpdf урезает до них на месте, — он открывается из байт в памяти (таблицы читаются лениво).
+    """
+    template = _unicode_font_template()
+    if template is None:
+        return False
+    from fontTools import ttLib
+    from fpdf.font_type_3 import get_color_font_object
+    from fpdf.fonts import SubsetMap
 
-def _safe_line(s: str) -> str:
-    """Убирает управляющие и непечатаемые символы (только ASCII)."""
-    return "".join(c for c in s if 32 <= ord(c) <= 126 or c in "\n\t")
+    base, data = template
+    font = copy.copy(base)
+    font.i = len(pdf.fonts) + 1
+    font.ttfont = ttLib.TTFont(BytesIO(data), recalcTimestamp=False, lazy=True)
+    font._hbfont = None
+    font.cw = base.cw.copy()  # defaultdict: чтение отсутствующего символа добавляет ключ
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font.subset = SubsetMap(font)
+    font.color_font = get_color_font_object(pdf, font, font.palette_index) if base.color_font else None
+    pdf.fonts[font.fontkey] = font
+    pdf.set_font(_FONT_FAMILY, size=_FONT_SIZE)
+    return True
 
 
-def _strip_control_chars(s: str) -> str:
-    """Убирает только управляющие символы (0–31, 127), сохраняет кириллицу."""
-    return "".join(c for c in s if ord(c) >= 32 and ord(c) != 127 or c in "\n\t")
+def _sanitize(text: str, unicode_font: bool) -> str:
+    """Убирает управляющие символы; без Unicode-шрифта оставляет только ASCII (остальное — '?')."""
+    text = text.replace("\r", "").translate(_CONTROL_CHARS)
+    if not unicode_font:
+        text = text.encode("ascii", "replace").decode("ascii")
+    return text
+
+
+def _wrap(line: str, max_width: float, width_of) -> list[str]:
+    """
+    Переносит строку по словам в пределах max_width, сохраняя пробелы между словами и отступ в начале
+    (пробелы на месте переноса отбрасываются). Ширина слов считается один раз (width_of кэширует),
+    слово длиннее строки режется по символам.
+    """
+    out: list[str] = []
+    current = ""
+    current_width = 0.0
+    for token in _TOKENS.findall(line):
+        w = width_of(token)
+        if token.isspace():
+            # Продолжение перенесённой строки не начинается с пробелов
+            if out and not current:
+                continue
+            if current_width + w > max_width:
+                out.append(current.rstrip())
+                current, current_width = "", 0.0
+            else:
+                current += token
+                current_width += w
+            continue
+        if w > max_width:
+            if current.strip():
+                out.append(current.rstrip())
+            piece = ""
+            for ch in token:
+                if piece and width_of(piece + ch) > max_width:
+                    out.append(piece)
+                    piece = ""
+                piece += ch
+            current, current_width = piece, width_of(piece)
+            continue
+        if current.strip() and current_width + w > max_width:
+            out.append(current.rstrip())
+            current, current_width = token, w
+        else:
+            current += token
+            current_width += w
+    if current.strip():
+        out.append(current.rstrip())
+    return out
 
 
 def report_text_to_pdf(report_text: str) -> bytes:
@@ -54,53 +191,134 @@ def report_text_to_pdf(report_text: str) -> bytes:
     pdf.set_auto_page_break(auto=True, margin=20)
     pdf.set_margins(20, 20, 20)
 
-    use_unicode = False
-    font_path = _find_unicode_font()
-    if font_path:
-        try:
-            pdf.add_font("UnicodeFont", "", font_path)
-            pdf.set_font("UnicodeFont", size=11)
-            use_unicode = True
-        except Exception:
-            pdf.set_font("Helvetica", size=11)
-    else:
-        pdf.set_font("Helvetica", size=11)
-
-    # Явная ширина ячейки, чтобы избежать "Not enough horizontal space" (epw = usable width)
+    use_unicode = _attach_unicode_font(pdf)
+    if not use_unicode:
+        pdf.set_font("Helvetica", size=_FONT_SIZE)
+
+    # Явная ширина строки (epw = usable width)
     cell_w = getattr(pdf, "epw", None) or (pdf.w - pdf.l_margin - pdf.r_margin)
     if cell_w <= 0:
         cell_w = 170  # A4: 210 - 20*2 mm
 
-    def write_line(s: str) -> None:
-        t = (s or "").strip()
-        if not t:
-            pdf.ln(4)
-            return
-        pdf.set_x(pdf.l_margin)
-        pdf.multi_cell(cell_w, 6, t)
+    widths: dict[str, float] = {}
+
+    def width_of(s: str) -> float:
+        w = widths.get(s)
+        if w is None:
+            w = widths[s] = pdf.get_string_width(s)
+        return w
 
-    text = (report_text or "").strip()
+    text = _sanitize((report_text or "").strip(), use_unicode)
     if not text:
-        write_line("No content.")
-    else:
-        for raw_line in text.replace("\r", "").split("\n"):
-            line = raw_line.strip()
-            if not line:
-                pdf.ln(4)
-                continue
-            if use_unicode:
-                line = _strip_control_chars(line)
-            else:
-                line = _sanitize_ascii(_safe_line(line))
-            if not line:
-                pdf.ln(4)
-                continue
-            try:
-                write_line(line)
-            except Exception:
-                fallback = _sanitize_ascii(_safe_line(raw_line))[:200].strip() or " "
-                write_line(fallback)
+        text = "No content."
+    for raw_line in text.split("\n"):
+        line = raw_line.expandtabs(4).rstrip()
+        if not line:
+            pdf.ln(_PARAGRAPH_GAP)
+            continue
+        for wrapped in _wrap(line, cell_w, width_of):
+            pdf.set_x(pdf.l_margin)
+            pdf.cell(cell_w, _LINE_HEIGHT, wrapped, new_x="LMARGIN", new_y="NEXT")
     buf = BytesIO()
     pdf.output(buf)
-    buf.seek(0)
     return buf.getvalue()
+
+
+def report_etag(report_text: str) -> str:
+    """Ключ кэша и ETag отчёта: хеш текста, версии вёрстки и выбранного шрифта."""
+    h = hashlib.sha256()
+    h.update(f"{RENDER_VERSION}\0{_find_unicode_font() or ''}\0".encode("utf-8"))
+    h.update((report_text or "").encode("utf-8"))
+    return h.hexdigest()
+
+
+def _cache_path(etag: str) -> Path:
+    return PDF_CACHE_DIR / f"{etag}.pdf"
+
+
+def _read_cached(etag: str) -> bytes | None:
+    path = _cache_path(etag)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return None
+    try:
+        os.utime(path)  # время доступа для вытеснения давно не используемых
+    except OSError:
+        pass
+    return data
+
+
+def _write_cached(etag: str, data: bytes) -> None:
+    """Атомарная запись в кэш и вытеснение старых файлов сверх лимита."""
+    limit = _cache_max_bytes()
+    if not limit or len(data) > limit:
+        return
+    try:
+        PDF_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = PDF_CACHE_DIR / f".{etag}.{uuid.uuid4().hex}.tmp"
+        tmp.write_bytes(data)
+        os.replace(tmp, _cache_path(etag))
+        files = sorted(
+            ((p.stat().st_mtime, p.stat().st_size, p) for p in PDF_CACHE_DIR.glob("*.pdf")),
+            key=lambda item: item[0],
+        )
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= limit:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+    except OSError:
+        # Кэш — оптимизация: ошибка записи не должна ломать экспорт
+        pass
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor | None:
+    """
+    Пул процессов рендера создаётся при первом экспорте (spawn — безопасно при потоках);
+    каждый процесс при старте разбирает шрифт.
+    """
+    global _pool
+    workers = _render_workers()
+    if not workers:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context("spawn"), initializer=_unicode_font_template
+            )
+        return _pool
+
+
+def shutdown_render_pool() -> None:
+    """Останавливает пул процессов рендера (при остановке приложения)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def render_report_pdf(report_text: str) -> tuple[bytes, str]:
+    """
+    PDF отчёта для async-кода: из кэша на диске или рендер в пуле процессов (с сохранением в кэш).
+    Возвращает (байты PDF, etag).
+    """
+    etag = report_etag(report_text)
+    with tracing.span("pdf_cache_read"):
+        data = await asyncio.to_thread(_read_cached, etag)
+    if data is not None:
+        metrics.PDF_CACHE.inc(outcome="hit")
+        return data, etag
+    metrics.PDF_CACHE.inc(outcome="miss")
+    loop = asyncio.get_running_loop()
+    with metrics.stage("pdf_render"):
+        data = await loop.run_in_executor(_get_pool(), report_text_to_pdf, report_text)
+    with tracing.span("pdf_cache_write"):
+        await asyncio.to_thread(_write_cached, etag, data)
+    return data, etag
@@ -0,0 +1,281 @@
+"""
+Кэш извлечённого текста документов.
+Ключ — SHA-256 содержимого файла + версия парсера (PARSER_VERSION) + диапазон страниц, если задан.
+Два уровня: LRU в памяти (ограничен по байтам) и постоянное хранилище на диске (backend/cache/text/).
+Текст PDF со смещениями страниц (PdfText) хранится отдельно от простого текста.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from backend import metrics
+from backend.database import BASE_DIR
+from backend.document_parser import PARSER_VERSION, PdfText, check_pages, extract_pdf, extract_text
+
+# Постоянное хранилище: backend/cache/text/<sha256>-v<версия>[-p<первая>-<последняя>].txt,
+# PdfText — …-pdf.json
+TEXT_CACHE_DIR = BASE_DIR / "cache" / "text"
+
+# Размер блока при хешировании файла
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _extract_workers() -> int:
+    """Число потоков для извлечения текста из async-кода. DOCMIND_EXTRACT_WORKERS, по умолчанию 4."""
+    v = os.environ.get("DOCMIND_EXTRACT_WORKERS")
+    if v is not None:
+        try:
+            return max(1, int(v))
+        except ValueError:
+            pass
+    return 4
+
+
+# Отдельный пул, чтобы тяжёлый парсинг не занимал общий threadpool Starlette
+_executor = ThreadPoolExecutor(max_workers=_extract_workers(), thread_name_prefix="docmind-extract")
+
+
+def _memory_limit_bytes() -> int:
+    """Лимит LRU в памяти. Задаётся DOCMIND_TEXT_CACHE_MEMORY_BYTES (0 — отключить)."""
+    v = os.environ.get("DOCMIND_TEXT_CACHE_MEMORY_BYTES")
+    if v is not None:
+        try:
+            return max(0, int(v))
+        except ValueError:
+            pass
+    return 64 * 1024 * 1024
+
+
+def _value_size(value: str | PdfText) -> int:
+    if isinstance(value, PdfText):
+        return sys.getsizeof(value.text) + sys.getsizeof(value.page_offsets) + 8 * len(value.page_offsets)
+    return sys.getsizeof(value)
+
+
+class _ByteLRU:
+    """Потокобезопасный LRU-кэш текстов (строк и PdfText) с ограничением по суммарному размеру в байтах."""
+
+    def __init__(self) -> None:
+        self._items: OrderedDict[str, str | PdfText] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._total = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, count_miss: bool = True) -> str | PdfText | None:
+        with self._lock:
+            text = self._items.get(key)
+            if text is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return text
+
+    def put(self, key: str, text: str | PdfText) -> None:
+        limit = _memory_limit_bytes()
+        size = _value_size(text)
+        if size > limit:
+            return
+        with self._lock:
+            if key in self._items:
+                self._total -= self._sizes[key]
+                del self._items[key]
+            self._items[key] = text
+            self._sizes[key] = size
+            self._total += size
+            while self._total > limit and self._items:
+                old_key, _ = self._items.popitem(last=False)
+                self._total -= self._sizes.pop(old_key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._items),
+                "bytes": self._total,
+                "limit_bytes": _memory_limit_bytes(),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+_memory = _ByteLRU()
+
+
+def file_sha256(file_path: str | Path) -> str:
+    """SHA-256 содержимого файла (чтение блоками, без загрузки файла целиком)."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _cache_key(content_hash: str, pages: tuple[int, int] | None = None) -> str:
+    key = f"{content_hash}-v{PARSER_VERSION}"
+    return key if pages is None else f"{key}-p{pages[0]}-{pages[1]}"
+
+
+def _pdf_key(content_hash: str, pages: tuple[int, int] | None = None) -> str:
+    return f"{_cache_key(content_hash, pages)}-pdf"
+
+
+def _disk_path(key: str) -> Path:
+    return TEXT_CACHE_DIR / f"{key}.txt"
+
+
+def _pdf_disk_path(key: str) -> Path:
+    return TEXT_CACHE_DIR / f"{key}.json"
+
+
+def _read_disk(key: str) -> str | None:
+    path = _disk_path(key)
+    try:
+        return path.read_text(encoding="utf-8")
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def _read_pdf_disk(key: str) -> PdfText | None:
+    try:
+        return PdfText(**json.loads(_pdf_disk_path(key).read_text(encoding="utf-8")))
+    except (FileNotFoundError, OSError, ValueError, TypeError):
+        return None
+
+
+def _write_disk(key: str, text: str, path: Path | None = None) -> None:
+    """Атомарная запись: сначала во временный файл, затем os.replace."""
+    try:
+        TEXT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = TEXT_CACHE_DIR / f".{key}.{uuid.uuid4().hex}.tmp"
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path or _disk_path(key))
+    except OSError:
+        # Кэш — оптимизация: ошибка записи не должна ломать анализ
+        pass
+
+
+def _existing(file_path: str | Path) -> Path:
+    path = Path(file_path)
+    if not path.exists():
+        raise FileNotFoundError(f"Файл не найден: {file_path}")
+    return path
+
+
+def get_text(
+    file_path: str | Path,
+    filename: str,
+    content_hash: str | None = None,
+    max_chars: int | None = None,
+    pages: tuple[int, int] | None = None,
+) -> str:
+    """
+    Возвращает текст документа: из памяти, с диска или через extract_text (с заполнением кэша).
+    content_hash — SHA-256 файла, если уже известен (иначе считается по файлу).
+    max_chars — если нужен только начальный фрагмент: при промахе кэша файл читается
+    лишь до бюджета (без сохранения в кэш, там хранится только полный текст).
+    pages — диапазон страниц PDF (document_parser.check_pages); текст берётся из get_pdf_text.
+    """
+    check_pages(filename, pages)
+    if pages is not None:
+        text = get_pdf_text(file_path, filename, content_hash, pages).text
+        return text if max_chars is None else text[:max_chars]
+    path = _existing(file_path)
+    key = _cache_key(content_hash or file_sha256(path))
+
+    text = _memory.get(key)
+    if text is None:
+        text = _read_disk(key)
+        if text is None:
+            if max_chars is not None:
+                return extract_text(str(path), filename, max_chars=max_chars)
+            text = extract_text(str(path), filename)
+            _write_disk(key, text)
+        _memory.put(key, text)
+    return text if max_chars is None else text[:max_chars]
+
+
+def get_pdf_text(
+    file_path: str | Path,
+    filename: str,
+    content_hash: str | None = None,
+    pages: tuple[int, int] | None = None,
+) -> PdfText:
+    """
+    Текст PDF со смещениями страниц (document_parser.PdfText): из памяти, с диска или через extract_pdf.
+    pages — диапазон страниц (первая, последняя) с 1 включительно, входит в ключ кэша.
+    Не PDF или некорректный диапазон — ValueError.
+    """
+    if Path(filename).suffix.lower() != ".pdf":
+        raise ValueError("Смещения страниц есть только у PDF")
+    check_pages(filename, pages)
+    path = _existing(file_path)
+    key = _pdf_key(content_hash or file_sha256(path), pages)
+
+    result = _memory.get(key)
+    if result is None:
+        result = _read_pdf_disk(key)
+        if result is None:
+            result = extract_pdf(str(path), pages=pages)
+            _write_disk(key, json.dumps(result._asdict(), ensure_ascii=False), _pdf_disk_path(key))
+        _memory.put(key, result)
+    return result
+
+
+async def aget_text(
+    file_path: str | Path,
+    filename: str,
+    content_hash: str | None = None,
+    max_chars: int | None = None,
+    pages: tuple[int, int] | None = None,
+) -> str:
+    """get_text() для async-кода: при попадании в память — сразу, иначе в пуле извлечения."""
+    metrics.tag(file_type=metrics.file_type(filename))
+    check_pages(filename, pages)
+    if content_hash:
+        # Промах не считаем: его учтёт get_text в пуле
+        if pages is None:
+            text = _memory.get(_cache_key(content_hash), count_miss=False)
+        else:
+            cached = _memory.get(_pdf_key(content_hash, pages), count_miss=False)
+            text = cached.text if cached is not None else None
+        if text is not None:
+            return text if max_chars is None else text[:max_chars]
+    loop = asyncio.get_running_loop()
+    with metrics.stage("extract"):
+        return await loop.run_in_executor(
+            _executor, get_text, file_path, filename, content_hash, max_chars, pages
+        )
+
+
+async def aget_pdf_text(
+    file_path: str | Path,
+    filename: str,
+    content_hash: str | None = None,
+    pages: tuple[int, int] | None = None,
+) -> PdfText:
+    """get_pdf_text() для async-кода: при попадании в память — сразу, иначе в пуле извлечения."""
+    metrics.tag(file_type=metrics.file_type(filename))
+    if content_hash and Path(filename).suffix.lower() == ".pdf":
+        check_pages(filename, pages)
+        result = _memory.get(_pdf_key(content_hash, pages), count_miss=False)
+        if result is not None:
+            return result
+    loop = asyncio.get_running_loop()
+    with metrics.stage("extract"):
+        return await loop.run_in_executor(_executor, get_pdf_text, file_path, filename, content_hash, pages)
+
+
+def cache_stats() -> dict:
+    """Статистика LRU в памяти (для отладки)."""
+    return _memory.stats()
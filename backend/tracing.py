@@ -0,0 +1,379 @@
+"""
+Трассировка и профилирование запросов по требованию.
+
+Трасса — дерево спанов одного HTTP-запроса: корневой (весь запрос), стадии из metrics.stage()
+(extract, prompt, llm, db_commit, pdf_render …), SQL-запросы (db) и произвольные tracing.span().
+Включается для запроса, если:
+- заголовок X-DocMind-Trace: 1 (трасса) или profile (трасса и сэмплирующий профайлер) — только при
+  DOCMIND_TRACE_HEADER=1: по умолчанию клиент не может включить себе профайлер и запись трасс на диск;
+- запрос попал в долю DOCMIND_TRACE_SAMPLE_RATE / DOCMIND_PROFILE_SAMPLE_RATE;
+- задан порог DOCMIND_TRACE_SLOW_MS — тогда спаны пишутся для всех запросов (это дёшево),
+  а на диск попадают только запросы медленнее порога.
+Трассы сохраняются в JSON (backend/cache/traces/), id трассы — в заголовке ответа X-DocMind-Trace-Id.
+Выключенная трассировка стоит одного ContextVar.get() на стадию и проверки заголовков на запрос.
+
+Профайлер — поток, который каждые DOCMIND_PROFILE_INTERVAL_MS снимает стеки всех потоков процесса
+(sys._current_frames) и копит их в формате folded stacks (flamegraph.pl, speedscope).
+Event loop общий, поэтому в профиль попадают и соседние запросы, выполнявшиеся в то же время.
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+
+TRACE_HEADER = "X-DocMind-Trace"
+TRACE_ID_HEADER = "X-DocMind-Trace-Id"
+
+_HEADER_KEY = TRACE_HEADER.lower().encode("latin-1")
+_MAX_STATEMENT_CHARS = 300
+
+
+def _env_float(name: str, default: float) -> float:
+    v = os.environ.get(name)
+    if v is not None:
+        try:
+            return max(0.0, float(v))
+        except ValueError:
+            pass
+    return default
+
+
+def header_enabled() -> bool:
+    """Разрешено ли включать трассировку заголовком. DOCMIND_TRACE_HEADER=1 — разрешить (по умолчанию выключено)."""
+    return os.environ.get("DOCMIND_TRACE_HEADER", "0").strip().lower() in ("1", "true", "yes")
+
+
+def sample_rate() -> float:
+    """Доля запросов с трассой. DOCMIND_TRACE_SAMPLE_RATE, 0…1, по умолчанию 0."""
+    return min(1.0, _env_float("DOCMIND_TRACE_SAMPLE_RATE", 0.0))
+
+
+def profile_sample_rate() -> float:
+    """Доля запросов с трассой и профайлером. DOCMIND_PROFILE_SAMPLE_RATE, 0…1, по умолчанию 0."""
+    return min(1.0, _env_float("DOCMIND_PROFILE_SAMPLE_RATE", 0.0))
+
+
+def slow_threshold_seconds() -> float:
+    """Порог медленного запроса. DOCMIND_TRACE_SLOW_MS (0 — не отслеживать)."""
+    return _env_float("DOCMIND_TRACE_SLOW_MS", 0.0) / 1000
+
+
+def profile_interval_seconds() -> float:
+    """Период снятия стеков профайлером. DOCMIND_PROFILE_INTERVAL_MS, по умолчанию 5 мс."""
+    return max(0.001, _env_float("DOCMIND_PROFILE_INTERVAL_MS", 5.0) / 1000)
+
+
+def trace_dir() -> Path:
+    """Каталог трасс. DOCMIND_TRACE_DIR, по умолчанию backend/cache/traces."""
+    custom = os.environ.get("DOCMIND_TRACE_DIR", "").strip()
+    return Path(custom) if custom else Path(__file__).resolve().parent / "cache" / "traces"
+
+
+def max_trace_files() -> int:
+    """Сколько последних трасс хранить на диске. DOCMIND_TRACE_MAX_FILES, по умолчанию 200."""
+    return int(_env_float("DOCMIND_TRACE_MAX_FILES", 200))
+
+
+class Span:
+    __slots__ = ("id", "parent_id", "name", "start", "end", "attrs")
+
+    def __init__(self, span_id: int, parent_id: int | None, name: str, attrs: dict) -> None:
+        self.id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.attrs = attrs
+
+
+class Trace:
+    """Спаны и профиль одного запроса."""
+
+    def __init__(self, reason: str, profile: bool) -> None:
+        self.id = uuid.uuid4().hex[:16]
+        self.reason = reason
+        self.profile = profile
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self.samples: dict[str, int] = {}
+        self._next_id = 0
+
+    def new_span(self, parent: Span | None, name: str, attrs: dict) -> Span:
+        self._next_id += 1
+        span = Span(self._next_id, parent.id if parent else None, name, attrs)
+        self.spans.append(span)
+        return span
+
+    def to_dict(self, duration: float, **request) -> dict:
+        def ms(t: float | None) -> float | None:
+            return None if t is None else round((t - self.start) * 1000, 3)
+
+        return {
+            "trace_id": self.id,
+            "reason": self.reason,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration * 1000, 3),
+            **request,
+            "spans": [
+                {
+                    "id": s.id,
+                    "parent_id": s.parent_id,
+                    "name": s.name,
+                    "start_ms": ms(s.start),
+                    "duration_ms": None if s.end is None else round((s.end - s.start) * 1000, 3),
+                    **({"attrs": s.attrs} if s.attrs else {}),
+                }
+                for s in self.spans
+            ],
+            **(
+                {
+                    "profile": {
+                        "interval_ms": profile_interval_seconds() * 1000,
+                        "format": "folded",
+                        "samples": sum(self.samples.values()),
+                        "stacks": dict(sorted(self.samples.items(), key=lambda item: -item[1])),
+                    }
+                }
+                if self.profile
+                else {}
+            ),
+        }
+
+
+_trace: ContextVar[Trace | None] = ContextVar("docmind_trace", default=None)
+_span: ContextVar[Span | None] = ContextVar("docmind_trace_span", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _trace.get()
+
+
+def begin(name: str, **attrs):
+    """Открывает спан в текущей трассе. Без трассы — None (ничего не пишется)."""
+    trace = _trace.get()
+    if trace is None:
+        return None
+    span = trace.new_span(_span.get(), name, attrs)
+    return span, _span.set(span)
+
+
+def finish(handle) -> None:
+    """Закрывает спан, открытый begin()."""
+    span, token = handle
+    span.end = time.perf_counter()
+    try:
+        _span.reset(token)
+    except ValueError:
+        # Спан закрыт в другом контексте (например, генератор дочитан из другой задачи)
+        pass
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Спан вокруг блока кода (если для запроса включена трассировка)."""
+    handle = begin(name, **attrs)
+    try:
+        yield
+    finally:
+        if handle is not None:
+            finish(handle)
+
+
+# --- Сэмплирующий профайлер ---
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class _Sampler:
+    """Общий поток сэмплирования: работает, пока есть хотя бы одна профилируемая трасса."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._active: set[Trace] = set()
+        self._thread: threading.Thread | None = None
+
+    def add(self, trace: Trace) -> None:
+        with self._lock:
+            self._active.add(trace)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="docmind-profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, trace: Trace) -> None:
+        with self._lock:
+            self._active.discard(trace)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        interval = profile_interval_seconds()
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                traces = list(self._active)
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                labels.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(labels)))
+            with self._lock:
+                for trace in traces:
+                    if trace not in self._active:
+                        continue  # запрос завершился, пока снимались стеки
+                    for stack in stacks:
+                        trace.samples[stack] = trace.samples.get(stack, 0) + 1
+
+
+_sampler = _Sampler()
+
+
+# --- Сохранение ---
+
+
+def _write_trace(data: dict) -> None:
+    directory = trace_dir()
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+        path = directory / f"{stamp}-{data['trace_id']}.json"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False, indent=1), encoding="utf-8")
+        os.replace(tmp, path)
+        # Имена начинаются с времени — старые отсекаются сортировкой по имени
+        files = sorted(directory.glob("*.json"))
+        for old in files[: max(0, len(files) - max_trace_files())]:
+            old.unlink(missing_ok=True)
+    except OSError:
+        # Трассировка не должна ломать запрос
+        pass
+
+
+# --- Подключение ---
+
+
+def _decide(scope) -> tuple[str, bool] | None:
+    """Причина трассировки запроса и нужен ли профайлер; None — запрос не трассируется."""
+    if header_enabled():
+        for key, value in scope["headers"]:
+            if key == _HEADER_KEY:
+                value = value.decode("latin-1").strip().lower()
+                if value == "profile":
+                    return "header", True
+                if value in ("1", "true", "yes", "on"):
+                    return "header", False
+                break
+    rate = profile_sample_rate()
+    if rate and random.random() < rate:
+        return "sampled", True
+    rate = sample_rate()
+    if rate and random.random() < rate:
+        return "sampled", False
+    if slow_threshold_seconds():
+        return "slow", False
+    return None
+
+
+def instrument_engine(sync_engine) -> None:
+    """Спаны db для SQL-запросов движка SQLAlchemy (для async engine — его sync_engine)."""
+    from sqlalchemy import event
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        handle = begin("db", statement=" ".join(statement.split())[:_MAX_STATEMENT_CHARS])
+        if handle is not None:
+            conn.info.setdefault("docmind_spans", []).append(handle)
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        handles = conn.info.get("docmind_spans")
+        if handles:
+            finish(handles.pop())
+
+    def on_error(exception_context):
+        conn = exception_context.connection
+        handles = conn.info.get("docmind_spans") if conn is not None else None
+        if handles:
+            span_obj, _ = handles[-1]
+            span_obj.attrs["error"] = type(exception_context.original_exception).__name__
+            finish(handles.pop())
+
+    event.listen(sync_engine, "before_cursor_execute", before)
+    event.listen(sync_engine, "after_cursor_execute", after)
+    event.listen(sync_engine, "handle_error", on_error)
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware: решает, трассировать ли запрос, открывает корневой спан,
+    запускает профайлер и сохраняет трассу (по заголовку и выборке — всегда, иначе — если запрос медленный).
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        decision = _decide(scope)
+        if decision is None:
+            await self.app(scope, receive, send)
+            return
+
+        reason, profile = decision
+        trace = Trace(reason, profile)
+        trace_token = _trace.set(trace)
+        root = begin(f"{scope['method']} {scope['path']}")
+        status = 500
+        keep = reason != "slow"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if keep:
+                    message = {
+                        **message,
+                        "headers": [*message.get("headers", []), (TRACE_ID_HEADER.lower().encode(), trace.id.encode())],
+                    }
+            await send(message)
+
+        if profile:
+            _sampler.add(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            if profile:
+                _sampler.remove(trace)
+            finish(root)
+            _trace.reset(trace_token)
+            duration = time.perf_counter() - trace.start
+            if keep or duration >= slow_threshold_seconds():
+                route = getattr(scope.get("route"), "path", None)
+                data = trace.to_dict(
+                    duration,
+                    method=scope["method"],
+                    path=scope["path"],
+                    endpoint=route,
+                    status=status,
+                )
+                await asyncio.to_thread(_write_trace, data)
@@ -0,0 +1,6 @@
+"""
+Бенчмарки DocMind. Запуск из корня репозитория:
+    python -m benchmarks.run            — набор стадий и эндпоинтов, результат в JSON
+    python -m benchmarks.bench_docx     — извлечение DOCX: python-docx против потокового разбора
+    python -m benchmarks.bench_sqlite   — SQLite до и после профиля производительности
+"""
@@ -0,0 +1,82 @@
+"""
+Сравнение извлечения текста из DOCX: python-docx (прежняя реализация) и потоковый разбор
+word/document.xml (backend.document_parser._extract_docx).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_docx --paragraphs 20000 --tables 200
+
+Документ генерируется во временной папке через python-docx. Для каждой реализации
+выводятся медиана времени, пиковая память (tracemalloc) и длина текста.
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from backend.document_parser import _extract_docx
+
+
+def _extract_docx_python_docx(file_path: str, max_chars: int | None = None) -> str:
+    """Прежняя реализация: весь документ в объектной модели python-docx, только абзацы."""
+    from docx import Document
+
+    doc = Document(file_path)
+    return "\n".join(p.text for p in doc.paragraphs)
+
+
+def _make_docx(path: Path, paragraphs: int, tables: int) -> None:
+    from docx import Document
+
+    doc = Document()
+    every = max(1, paragraphs // max(1, tables)) if tables else 0
+    for i in range(paragraphs):
+        doc.add_paragraph(f"Абзац {i}. " + "Текст договора с условиями и сроками. " * 8)
+        if every and i % every == 0 and i // every < tables:
+            table = doc.add_table(rows=5, cols=4)
+            for r, row in enumerate(table.rows):
+                for c, cell in enumerate(row.cells):
+                    cell.text = f"R{r}C{c} значение"
+    doc.save(str(path))
+
+
+def _measure(func, path: str, max_chars: int | None, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        text = func(path, max_chars=max_chars)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func(path, max_chars=max_chars)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"median_s": statistics.median(times), "peak_mib": peak / 2**20, "chars": len(text)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paragraphs", type=int, default=20_000)
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-chars", type=int, default=6_001, help="бюджет для режима раннего останова")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "bench.docx"
+        _make_docx(path, args.paragraphs, args.tables)
+        print(f"DOCX: {path.stat().st_size / 2**20:.1f} MiB, абзацев {args.paragraphs}, таблиц {args.tables}")
+        cases = [
+            ("python-docx", _extract_docx_python_docx, None),
+            ("stream", _extract_docx, None),
+            (f"stream max_chars={args.max_chars}", _extract_docx, args.max_chars),
+        ]
+        print(f"{'реализация':<28}{'время, с':>10}{'пик, MiB':>11}{'символов':>12}")
+        for name, func, max_chars in cases:
+            r = _measure(func, str(path), max_chars, args.repeat)
+            print(f"{name:<28}{r['median_s']:>10.3f}{r['peak_mib']:>11.1f}{r['chars']:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Пропускная способность SQLite до и после профиля производительности (backend.database.sqlite_pragmas).
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_sqlite --writers 4 --readers 4 --seconds 5
+
+Для каждого профиля создаётся временная БД со схемой из backend.models:
+- default — настройки SQLite по умолчанию (rollback journal, synchronous=FULL), без составных индексов;
+- tuned — WAL, busy_timeout, synchronous=NORMAL, cache_size и составные индексы.
+Писатели параллельно добавляют документы с результатами (отдельная транзакция на документ),
+читатели запрашивают список документов пользователя и результаты документа.
+Выводятся операции в секунду и число ошибок «database is locked».
+"""
+
+import argparse
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from backend.database import Base, apply_sqlite_pragmas
+from backend.models import Document, Result, User
+
+COMPOSITE_INDEXES = ("ix_documents_user_id_uploaded_at", "ix_results_document_id_created_at")
+USERS = 20
+
+
+def _make_engine(path: Path, tuned: bool):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    if tuned:
+        event.listen(engine, "connect", apply_sqlite_pragmas)
+    Base.metadata.create_all(bind=engine)
+    if not tuned:
+        with engine.begin() as conn:
+            for name in COMPOSITE_INDEXES:
+                conn.exec_driver_sql(f"DROP INDEX IF EXISTS {name}")
+    return engine
+
+
+def _seed(Session, documents: int) -> None:
+    now = datetime.utcnow()
+    with Session() as db:
+        db.add_all(User(id=i + 1, username=f"user{i}") for i in range(USERS))
+        db.flush()
+        for i in range(documents):
+            doc = Document(
+                user_id=i % USERS + 1,
+                filename=f"doc{i}.txt",
+                file_path=f"uploads/doc{i}.txt",
+                uploaded_at=now - timedelta(seconds=i),
+            )
+            doc.results = [
+                Result(analysis_type=t, content="x" * 500, created_at=now - timedelta(seconds=i))
+                for t in ("summary", "risks")
+            ]
+            db.add(doc)
+        db.commit()
+
+
+def _run(engine, writers: int, readers: int, seconds: float) -> dict:
+    Session = sessionmaker(bind=engine)
+    stop = time.monotonic() + seconds
+    counts = {"inserts": 0, "lists": 0, "locked": 0}
+    lock = threading.Lock()
+
+    def add(name: str) -> None:
+        with lock:
+            counts[name] += 1
+
+    def writer() -> None:
+        rnd = random.Random()
+        while time.monotonic() < stop:
+            try:
+                with Session() as db:
+                    doc = Document(user_id=rnd.randint(1, USERS), filename="new.txt", file_path="uploads/new.txt")
+                    doc.results = [Result(analysis_type="summary", content="y" * 500)]
+                    db.add(doc)
+                    db.commit()
+                add("inserts")
+            except OperationalError:
+                add("locked")
+
+    def reader() -> None:
+        rnd = random.Random()
+        while time.monotonic() < stop:
+            try:
+                with Session() as db:
+                    user_id = rnd.randint(1, USERS)
+                    docs = db.scalars(
+                        select(Document).where(Document.user_id == user_id).order_by(Document.uploaded_at.desc())
+                    ).all()
+                    if docs:
+                        db.scalars(
+                            select(Result)
+                            .where(Result.document_id == docs[0].id)
+                            .order_by(Result.created_at.desc())
+                        ).all()
+                add("lists")
+            except OperationalError:
+                add("locked")
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    threads += [threading.Thread(target=reader) for _ in range(readers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {
+        "inserts_per_s": counts["inserts"] / seconds,
+        "lists_per_s": counts["lists"] / seconds,
+        "locked": counts["locked"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--documents", type=int, default=20_000, help="документов в БД перед замером")
+    args = parser.parse_args()
+
+    print(f"{'профиль':<10}{'вставок/с':>12}{'списков/с':>12}{'locked':>9}")
+    for name, tuned in (("default", False), ("tuned", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = _make_engine(Path(tmp) / "bench.db", tuned)
+            _seed(sessionmaker(bind=engine), args.documents)
+            r = _run(engine, args.writers, args.readers, args.seconds)
+            engine.dispose()
+        print(f"{name:<10}{r['inserts_per_s']:>12.0f}{r['lists_per_s']:>12.0f}{r['locked']:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Детерминированные документы для бенчмарков: TXT, PDF и DOCX нескольких размеров.
+Текст генерируется из фиксированного словаря с фиксированным seed — при одинаковых параметрах
+файлы побайтово совпадают между запусками и коммитами (кроме метаданных PDF).
+"""
+
+import random
+import textwrap
+import zipfile
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+# Размеры документов: имя -> примерное число символов текста
+SIZES = {
+    "small": 5_000,
+    "medium": 50_000,
+    "large": 500_000,
+}
+
+_WORDS = (
+    "договор аренда сторона арендатор арендодатель оплата срок штраф неустойка обязательство "
+    "уведомление расторжение имущество помещение акт приёмка передача ответственность ущерб "
+    "страхование платёж счёт реквизиты подпись приложение условие пункт порядок согласие "
+    "the agreement party shall payment term notice liability"
+).split()
+
+_LINES_PER_PAGE = 45
+
+
+def make_text(chars: int, seed: int = 42) -> str:
+    """Текст из предложений и абзацев длиной около chars символов."""
+    rnd = random.Random(seed)
+    parts: list[str] = []
+    total = 0
+    while total < chars:
+        sentences = []
+        for _ in range(rnd.randint(2, 6)):
+            words = [rnd.choice(_WORDS) for _ in range(rnd.randint(6, 18))]
+            sentences.append(" ".join(words).capitalize() + ".")
+        paragraph = " ".join(sentences)
+        parts.append(paragraph)
+        total += len(paragraph) + 2
+    return "\n\n".join(parts)[:chars]
+
+
+def write_txt(path: Path, text: str) -> Path:
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+def write_pdf(path: Path, text: str) -> Path:
+    """
+    PDF через PyMuPDF: текст переносится по ширине страницы, ~45 строк на страницу.
+    Кириллица — шрифтом DejaVu из репозитория (как в экспорте отчёта), без него — Helvetica.
+    """
+    import fitz  # PyMuPDF
+
+    from backend.report_pdf import _find_unicode_font
+
+    font_path = _find_unicode_font()
+    font = {"fontname": "dejavu", "fontfile": font_path} if font_path else {"fontname": "helv"}
+    lines = []
+    for paragraph in text.split("\n"):
+        lines.extend(textwrap.wrap(paragraph, 90) or [""])
+    doc = fitz.open()
+    try:
+        for start in range(0, len(lines), _LINES_PER_PAGE):
+            page = doc.new_page()
+            page.insert_text(
+                (50, 60),
+                "\n".join(lines[start:start + _LINES_PER_PAGE]),
+                fontsize=9,
+                **font,
+            )
+        if doc.page_count == 0:
+            doc.new_page()
+        doc.save(str(path), no_new_id=True)
+    finally:
+        doc.close()
+    return path
+
+
+_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    "</Types>"
+)
+_DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    "</Relationships>"
+)
+
+
+def write_docx(path: Path, text: str) -> Path:
+    """Минимальный DOCX (только word/document.xml): абзацы и таблица после каждого десятого абзаца."""
+    body = []
+    for i, paragraph in enumerate(text.split("\n\n")):
+        body.append(f'<w:p><w:r><w:t xml:space="preserve">{escape(paragraph)}</w:t></w:r></w:p>')
+        if i % 10 == 9:
+            rows = "".join(
+                "<w:tr>"
+                + "".join(f"<w:tc><w:p><w:r><w:t>R{r}C{c}</w:t></w:r></w:p></w:tc>" for c in range(3))
+                + "</w:tr>"
+                for r in range(3)
+            )
+            body.append(f"<w:tbl>{rows}</w:tbl>")
+    document = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+        f"<w:body>{''.join(body)}</w:body></w:document>"
+    )
+    # Фиксированная дата в zip — одинаковые байты между запусками
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in (
+            ("[Content_Types].xml", _DOCX_CONTENT_TYPES),
+            ("_rels/.rels", _DOCX_RELS),
+            ("word/document.xml", document),
+        ):
+            zf.writestr(zipfile.ZipInfo(name, date_time=(2024, 1, 1, 0, 0, 0)), data)
+    return path
+
+
+_WRITERS = {".txt": write_txt, ".pdf": write_pdf, ".docx": write_docx}
+
+
+def generate(directory: Path, sizes: dict[str, int] | None = None) -> dict[str, Path]:
+    """Создаёт документы всех форматов и размеров. Возвращает {"<размер>.<формат>": путь}."""
+    directory.mkdir(parents=True, exist_ok=True)
+    documents = {}
+    for size_name, chars in (sizes or SIZES).items():
+        text = make_text(chars)
+        for ext, writer in _WRITERS.items():
+            documents[f"{size_name}{ext}"] = writer(directory / f"{size_name}{ext}", text)
+    return documents
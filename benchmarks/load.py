@@ -0,0 +1,222 @@
+"""
+Нагрузочный тест DocMind: сценарий загрузка → анализ → AI Magic → экспорт PDF с заданной частотой.
+
+Запуск (сервер DocMind уже работает, LLM — заглушка benchmarks/mock_openrouter.py):
+    python -m benchmarks.mock_openrouter --port 8100 --latency lognormal:0.8,0.5
+    OPENROUTER_BASE_URL=http://127.0.0.1:8100/api/v1 OPENROUTER_API_KEY=mock uvicorn backend.main:app
+    python -m benchmarks.load --url http://127.0.0.1:8000 --rate 2 --duration 60
+
+Нагрузка открытая: новый сценарий стартует каждые 1/rate секунд (--arrival poisson — со случайными
+интервалами) независимо от того, успели ли завершиться предыдущие; --max-in-flight ограничивает
+одновременные сценарии (сверх лимита старт пропускается и считается в dropped).
+Каждый сценарий загружает свой документ (уникальный текст — без дедупликации загрузок и кэша анализов).
+Итог: пропускная способность (сценарии и запросы в секунду), коды ошибок и p50/p95/p99 по шагам.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from pathlib import Path
+
+from benchmarks import fixtures
+
+STEPS = ("upload", "analyze", "ai_magic", "export")
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """Перцентиль по ближайшему рангу (sorted_values отсортирован по возрастанию)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-q * len(sorted_values) // 100)))  # ceil(q/100 * n)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _summary(values: list[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50_s": percentile(values, 50),
+        "p95_s": percentile(values, 95),
+        "p99_s": percentile(values, 99),
+        "max_s": values[-1] if values else 0.0,
+    }
+
+
+class LoadStats:
+    """Задержки по шагам, ошибки и счётчики сценариев."""
+
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {step: [] for step in (*STEPS, "flow")}
+        self.errors: dict[str, int] = {}
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.requests = 0
+
+    def error(self, step: str, reason: str) -> None:
+        key = f"{step}:{reason}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            "elapsed_s": elapsed,
+            "flows": {
+                "started": self.started,
+                "completed": self.completed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            },
+            "throughput": {
+                "flows_per_s": self.completed / elapsed if elapsed else 0.0,
+                "requests_per_s": self.requests / elapsed if elapsed else 0.0,
+            },
+            "errors": self.errors,
+            "latency": {name: _summary(values) for name, values in self.latencies.items()},
+        }
+
+
+class _StepFailed(Exception):
+    pass
+
+
+async def _step(stats: LoadStats, name: str, request):
+    """Выполняет запрос шага, записывает задержку; при ошибке — _StepFailed."""
+    import httpx
+
+    start = time.perf_counter()
+    stats.requests += 1
+    try:
+        response = await request
+    except httpx.HTTPError as e:
+        stats.error(name, type(e).__name__)
+        raise _StepFailed from e
+    stats.latencies[name].append(time.perf_counter() - start)
+    if response.status_code >= 400:
+        stats.error(name, str(response.status_code))
+        raise _StepFailed
+    return response
+
+
+async def run_flow(client, stats: LoadStats, user_id: int, index: int, doc_chars: int, audience: str | None) -> None:
+    """Один сценарий пользователя: загрузка, анализ summary, AI Magic, экспорт отчёта в PDF."""
+    start = time.perf_counter()
+    text = fixtures.make_text(doc_chars, seed=index) + f"\n\nДокумент нагрузочного теста №{index}."
+    try:
+        r = await _step(stats, "upload", client.post(
+            f"/api/users/{user_id}/documents",
+            files={"file": (f"load-{index}.txt", text.encode("utf-8"), "text/plain")},
+        ))
+        document_id = r.json()["document_id"]
+        await _step(stats, "analyze", client.post(
+            "/api/analyze",
+            json={"document_id": document_id, "analysis_type": "summary", "user_id": user_id},
+        ))
+        r = await _step(stats, "ai_magic", client.post(
+            "/api/ai-magic",
+            json={"document_id": document_id, "audience": audience},
+        ))
+        result_id = r.json()["result_id"]
+        await _step(stats, "export", client.get(f"/api/results/{result_id}/report.pdf"))
+    except _StepFailed:
+        stats.failed += 1
+        return
+    stats.latencies["flow"].append(time.perf_counter() - start)
+    stats.completed += 1
+
+
+async def run_load(args) -> dict:
+    import httpx
+
+    stats = LoadStats()
+    limits = httpx.Limits(max_connections=args.max_in_flight * 2, max_keepalive_connections=args.max_in_flight)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        r = await client.post("/api/login", json={"username": args.username})
+        r.raise_for_status()
+        user_id = r.json()["user_id"]
+
+        rnd = random.Random(args.seed)
+        tasks: set[asyncio.Task] = set()
+        start = time.perf_counter()
+        next_at = start
+        index = 0
+        while next_at - start < args.duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            index += 1
+            if len(tasks) >= args.max_in_flight:
+                stats.dropped += 1
+            else:
+                stats.started += 1
+                task = asyncio.create_task(
+                    run_flow(client, stats, user_id, args.seed * 1_000_000 + index, args.doc_chars, args.audience)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            interval = 1 / args.rate
+            next_at += rnd.expovariate(args.rate) if args.arrival == "poisson" else interval
+        if tasks:
+            await asyncio.wait(tasks)
+        elapsed = time.perf_counter() - start
+
+    report = stats.report(elapsed)
+    report["config"] = {
+        "url": args.url,
+        "rate": args.rate,
+        "duration_s": args.duration,
+        "arrival": args.arrival,
+        "max_in_flight": args.max_in_flight,
+        "doc_chars": args.doc_chars,
+    }
+    return report
+
+
+def _print_report(report: dict) -> None:
+    flows, tp = report["flows"], report["throughput"]
+    print(
+        f"Сценарии: запущено {flows['started']}, завершено {flows['completed']}, "
+        f"с ошибкой {flows['failed']}, пропущено {flows['dropped']} за {report['elapsed_s']:.1f} с"
+    )
+    print(f"Пропускная способность: {tp['flows_per_s']:.2f} сценариев/с, {tp['requests_per_s']:.2f} запросов/с")
+    print(f"\n{'шаг':<12}{'n':>6}{'p50, мс':>11}{'p95, мс':>11}{'p99, мс':>11}{'max, мс':>11}")
+    for name, s in report["latency"].items():
+        print(
+            f"{name:<12}{s['count']:>6}{s['p50_s'] * 1000:>11.1f}{s['p95_s'] * 1000:>11.1f}"
+            f"{s['p99_s'] * 1000:>11.1f}{s['max_s'] * 1000:>11.1f}"
+        )
+    if report["errors"]:
+        print("\nОшибки:")
+        for key, count in sorted(report["errors"].items()):
+            print(f"  {key:<30}{count:>6}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="адрес сервера DocMind")
+    parser.add_argument("--rate", type=float, default=1.0, help="новых сценариев в секунду")
+    parser.add_argument("--duration", type=float, default=30.0, help="сколько секунд запускать сценарии")
+    parser.add_argument("--arrival", choices=("fixed", "poisson"), default="fixed")
+    parser.add_argument("--max-in-flight", type=int, default=100)
+    parser.add_argument("--doc-chars", type=int, default=20_000, help="размер документа, символов")
+    parser.add_argument("--audience", choices=("business", "legal", "manager", "student"))
+    parser.add_argument("--username", default="loadtest")
+    parser.add_argument("--timeout", type=float, default=300.0, help="таймаут одного запроса, секунд")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", type=Path, help="сохранить отчёт в JSON")
+    args = parser.parse_args()
+    if args.rate <= 0 or args.duration <= 0 or args.max_in_flight < 1:
+        parser.error("--rate и --duration должны быть больше 0, --max-in-flight — не меньше 1")
+
+    report = asyncio.run(run_load(args))
+    _print_report(report)
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+        print(f"\nОтчёт: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Локальная заглушка OpenRouter (OpenAI-совместимый POST /api/v1/chat/completions) для нагрузочных тестов.
+Не тратит кредиты: ответ генерируется из слов запроса, задержки и ошибки задаются параметрами.
+
+Запуск:
+    python -m benchmarks.mock_openrouter --port 8100 --latency lognormal:0.8,0.5 --tokens-per-second 60 \\
+        --error-rate-429 0.02 --error-rate-5xx 0.01
+    OPENROUTER_BASE_URL=http://127.0.0.1:8100/api/v1 OPENROUTER_API_KEY=mock uvicorn backend.main:app
+
+Модель времени ответа: задержка до первого токена (--latency) + completion_tokens / --tokens-per-second.
+В потоковом режиме (stream=true) токены отдаются SSE-чанками с этой скоростью.
+Распределения задержки (секунды):
+    fixed:0.5 | uniform:0.2,1.5 | normal:0.8,0.2 | lognormal:<медиана>,<sigma> | exp:<среднее>
+«Хвост» задержек (проверка дублирующих запросов): доля --slow-rate запросов ждёт --slow-latency.
+Ошибки: доли запросов с ответом 402 (нет кредитов), 429 (с Retry-After) и 5xx (500/502/503)
+в формате ошибок OpenRouter; --fail-model <модель>:<код> — модель всегда отвечает этой ошибкой
+(проверка запасных моделей, backend/llm_router.py). GET /stats — счётчики запросов, POST /stats/reset — сброс.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+_ERROR_MESSAGES = {
+    402: "Insufficient credits (mock)",
+    404: "Model not found (mock)",
+    429: "Rate limit exceeded (mock)",
+    500: "Internal server error (mock)",
+    502: "Upstream provider error (mock)",
+    503: "Service temporarily unavailable (mock)",
+}
+
+
+def parse_latency(spec: str):
+    """Разбирает описание распределения задержки; возвращает функцию rnd -> секунды (не меньше 0)."""
+    kind, _, raw = spec.partition(":")
+    try:
+        args = [float(x) for x in raw.split(",")] if raw else []
+    except ValueError as e:
+        raise ValueError(f"Некорректные параметры задержки: {spec}") from e
+    kind = kind.strip().lower()
+    if kind == "fixed" and len(args) == 1:
+        return lambda rnd: max(0.0, args[0])
+    if kind == "uniform" and len(args) == 2:
+        return lambda rnd: max(0.0, rnd.uniform(args[0], args[1]))
+    if kind == "normal" and len(args) == 2:
+        return lambda rnd: max(0.0, rnd.gauss(args[0], args[1]))
+    if kind == "lognormal" and len(args) == 2 and args[0] > 0:
+        return lambda rnd: rnd.lognormvariate(math.log(args[0]), args[1])
+    if kind == "exp" and len(args) == 1 and args[0] > 0:
+        return lambda rnd: rnd.expovariate(1 / args[0])
+    raise ValueError(f"Неизвестное распределение задержки: {spec}")
+
+
+class MockSettings:
+    """Параметры заглушки (из аргументов командной строки)."""
+
+    def __init__(
+        self,
+        latency: str = "fixed:0.3",
+        tokens_per_second: float = 80.0,
+        completion_tokens: int = 400,
+        error_rate_402: float = 0.0,
+        error_rate_429: float = 0.0,
+        error_rate_5xx: float = 0.0,
+        retry_after: int = 1,
+        seed: int | None = None,
+        slow_rate: float = 0.0,
+        slow_latency: str = "fixed:10",
+        model_errors: dict[str, int] | None = None,
+    ) -> None:
+        self.latency_spec = latency
+        self._latency = parse_latency(latency)
+        self.slow_rate = slow_rate
+        self.slow_latency = parse_latency(slow_latency)
+        self.model_errors = dict(model_errors or {})
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rates = ((402, error_rate_402), (429, error_rate_429), (500, error_rate_5xx))
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+    def latency(self, rnd) -> float:
+        """Задержка до первого токена; с вероятностью slow_rate — из распределения «хвоста»."""
+        if self.slow_rate and rnd.random() < self.slow_rate:
+            return self.slow_latency(rnd)
+        return self._latency(rnd)
+
+    def pick_error(self, model: str | None = None) -> int | None:
+        """Код ошибки для очередного запроса или None (успешный ответ)."""
+        if model in self.model_errors:
+            return self.model_errors[model]
+        x = self.random.random()
+        for status, rate in self.error_rates:
+            if x < rate:
+                return self.random.choice((500, 502, 503)) if status == 500 else status
+            x -= rate
+        return None
+
+
+def _completion_tokens(settings: MockSettings, body: dict) -> list[str]:
+    """Токены ответа: слова из последнего сообщения запроса, не больше max_tokens."""
+    limit = settings.completion_tokens
+    if body.get("max_tokens"):
+        limit = min(limit, int(body["max_tokens"]))
+    messages = body.get("messages") or [{}]
+    words = str(messages[-1].get("content") or "").split()[:200] or ["ok"]
+    return [words[i % len(words)] + " " for i in range(max(1, limit))]
+
+
+def _prompt_tokens(body: dict) -> int:
+    # Грубая оценка, как у большинства токенизаторов для смешанного текста: ~4 символа на токен
+    return sum(len(str(m.get("content") or "")) for m in body.get("messages") or []) // 4
+
+
+def create_app(settings: MockSettings):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    stats = {"requests": 0, "streams": 0, "in_flight": 0, "errors": {}}
+
+    def error_response(status: int) -> JSONResponse:
+        stats["errors"][str(status)] = stats["errors"].get(str(status), 0) + 1
+        headers = {"Retry-After": str(settings.retry_after)} if status == 429 else None
+        return JSONResponse(
+            {"error": {"code": status, "message": _ERROR_MESSAGES[status]}},
+            status_code=status,
+            headers=headers,
+        )
+
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        status = settings.pick_error(body.get("model"))
+        if status is not None:
+            # Ошибки тоже приходят не мгновенно: половина задержки до первого токена
+            await asyncio.sleep(settings.latency(settings.random) / 2)
+            return error_response(status)
+
+        model = body.get("model") or "mock/model"
+        tokens = _completion_tokens(settings, body)
+        ttft = settings.latency(settings.random)
+        rate = settings.tokens_per_second or float("inf")
+        completion_id = f"gen-{uuid.uuid4().hex}"
+        created = int(time.time())
+        usage = {
+            "prompt_tokens": _prompt_tokens(body),
+            "completion_tokens": len(tokens),
+            "total_tokens": _prompt_tokens(body) + len(tokens),
+        }
+
+        if not body.get("stream"):
+            stats["in_flight"] += 1
+            try:
+                await asyncio.sleep(ttft + len(tokens) / rate)
+            finally:
+                stats["in_flight"] -= 1
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens).strip()},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+        def chunk(delta: dict | None, finish_reason: str | None = None, **extra) -> str:
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra,
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def events():
+            stats["streams"] += 1
+            stats["in_flight"] += 1
+            try:
+                await asyncio.sleep(ttft)
+                yield chunk({"role": "assistant", "content": ""})
+                # Токены пачками не чаще раза в 20 мс: скорость та же, без тысяч мелких sleep
+                per_batch = max(1, int(rate * 0.02)) if math.isfinite(rate) else len(tokens)
+                for i in range(0, len(tokens), per_batch):
+                    batch = tokens[i:i + per_batch]
+                    if math.isfinite(rate):
+                        await asyncio.sleep(len(batch) / rate)
+                    yield chunk({"content": "".join(batch)})
+                yield chunk({}, "stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    # Как у OpenAI/OpenRouter: отдельный последний чанк без choices, с usage
+                    yield chunk(None, usage=usage)
+                yield "data: [DONE]\n\n"
+            finally:
+                stats["in_flight"] -= 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def models(request: Request):
+        return JSONResponse({"data": [{"id": "deepseek/deepseek-chat", "object": "model"}]})
+
+    async def get_stats(request: Request):
+        return JSONResponse({**stats, "latency": settings.latency_spec, "tokens_per_second": settings.tokens_per_second})
+
+    async def reset_stats(request: Request):
+        stats.update(requests=0, streams=0, errors={})
+        return JSONResponse({"ok": True})
+
+    routes = []
+    # /api/v1 — как у OpenRouter, /v1 — как у OpenAI
+    for prefix in ("/api/v1", "/v1"):
+        routes.append(Route(f"{prefix}/chat/completions", chat_completions, methods=["POST"]))
+        routes.append(Route(f"{prefix}/models", models, methods=["GET"]))
+    routes.append(Route("/stats", get_stats, methods=["GET"]))
+    routes.append(Route("/stats/reset", reset_stats, methods=["POST"]))
+    return Starlette(routes=routes)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", default="fixed:0.3", help="задержка до первого токена, например lognormal:0.8,0.5")
+    parser.add_argument("--tokens-per-second", type=float, default=80.0, help="0 — без ограничения скорости")
+    parser.add_argument("--completion-tokens", type=int, default=400, help="длина ответа (не больше max_tokens запроса)")
+    parser.add_argument("--error-rate-402", type=float, default=0.0)
+    parser.add_argument("--error-rate-429", type=float, default=0.0)
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After для 429, секунд")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="доля запросов с задержкой --slow-latency")
+    parser.add_argument("--slow-latency", default="fixed:10", help="задержка медленных запросов, например uniform:5,10")
+    parser.add_argument(
+        "--fail-model", action="append", default=[], metavar="MODEL:STATUS",
+        help="модель всегда отвечает ошибкой (402, 404, 429, 500, 502, 503); можно повторять",
+    )
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    model_errors = {}
+    for spec in args.fail_model:
+        model, _, status = spec.rpartition(":")
+        if not model or not status.isdigit() or int(status) not in _ERROR_MESSAGES:
+            parser.error(f"Некорректный --fail-model: {spec}")
+        model_errors[model] = int(status)
+    try:
+        settings = MockSettings(
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second,
+            completion_tokens=args.completion_tokens,
+            error_rate_402=args.error_rate_402,
+            error_rate_429=args.error_rate_429,
+            error_rate_5xx=args.error_rate_5xx,
+            retry_after=args.retry_after,
+            seed=args.seed,
+            slow_rate=args.slow_rate,
+            slow_latency=args.slow_latency,
+            model_errors=model_errors,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
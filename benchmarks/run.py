@@ -0,0 +1,245 @@
+"""
+Набор бенчмарков DocMind: стадии конвейера и ключевые эндпоинты.
+
+Запуск из корня репозитория:
+    python -m benchmarks.run                                  # результат в benchmarks/results/latest.json
+    python -m benchmarks.run --output base.json               # сохранить базовую линию
+    python -m benchmarks.run --baseline base.json --threshold 0.25 --fail-on-regression
+
+Документы TXT/PDF/DOCX трёх размеров генерируются детерминированно (benchmarks/fixtures.py).
+Запросы к LLM заменены заглушкой (без сети), БД, загрузки и кэши — во временном каталоге.
+Каждый замер: медиана, минимум и p95 по --repeat прогонам после прогрева.
+При сравнении с --baseline регрессией считается рост медианы больше чем на threshold
+(и не меньше --min-delta-ms в абсолютном выражении, чтобы не реагировать на шум микросекундных замеров).
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+from benchmarks import fixtures
+
+
+def _prepare_environment(sandbox: Path) -> None:
+    """До импорта backend: отдельная БД, без фоновых воркеров и кэша ответов LLM."""
+    os.environ["DATABASE_URL"] = f"sqlite:///{sandbox / 'bench.db'}"
+    os.environ["DOCMIND_JOB_WORKERS"] = "0"
+    os.environ["DOCMIND_LLM_CACHE"] = "0"
+    os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+
+def _fake_llm_answer(system_prompt: str, user_content: str) -> str:
+    """Детерминированный ответ заглушки: размер похож на реальный ответ модели (~1–2 тыс. символов)."""
+    head = " ".join(user_content.split()[:40])
+    return ("1. Краткое содержание\n" + head + "\n\n2. Риски\n- пункт\n- пункт\n") * 8
+
+
+def _install_llm_stub() -> None:
+    """Подменяет complete/acomplete во всех модулях, которые импортировали их по имени."""
+    from backend import ai_magic_service, analysis_service, chunking, openai_client
+
+    def complete(system_prompt, user_content, model=None):
+        return _fake_llm_answer(system_prompt, user_content)
+
+    async def acomplete(system_prompt, user_content, model=None):
+        return _fake_llm_answer(system_prompt, user_content)
+
+    openai_client.complete = complete
+    for module in (openai_client, analysis_service, chunking, ai_magic_service):
+        module.acomplete = acomplete
+
+
+def _isolate_storage(sandbox: Path) -> None:
+    """Загрузки, кэш текста и кэш PDF — во временном каталоге, а не в backend/."""
+    from backend import file_upload, report_pdf, text_cache
+
+    file_upload.BASE_DIR = sandbox
+    file_upload.UPLOADS_DIR = sandbox / "uploads"
+    text_cache.TEXT_CACHE_DIR = sandbox / "cache" / "text"
+    report_pdf.PDF_CACHE_DIR = sandbox / "cache" / "pdf"
+
+
+def _measure(func, repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        "median_s": statistics.median(times),
+        "min_s": times[0],
+        "p95_s": times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))],
+        "runs": repeat,
+    }
+
+
+def _stage_benchmarks(documents: dict[str, Path], repeat: int) -> dict:
+    from backend.chunking import split_text
+    from backend.document_parser import extract_text
+    from backend.prompts import get_user_content
+    from backend.report_pdf import report_text_to_pdf
+
+    results = {}
+    for name, path in documents.items():
+        size = name.split(".")[0]
+        runs = max(1, repeat // 3) if size == "large" else repeat
+        results[f"extract.{name}"] = _measure(lambda p=path: extract_text(str(p), p.name), runs)
+        # Ранний останов: только начало документа (анализ без разбиения на части)
+        results[f"extract_budget.{name}"] = _measure(
+            lambda p=path: extract_text(str(p), p.name, max_chars=6_001), repeat
+        )
+
+    for size, chars in fixtures.SIZES.items():
+        text = fixtures.make_text(chars)
+        results[f"prompt.user_content.{size}"] = _measure(lambda t=text: get_user_content(t), repeat)
+        results[f"chunking.split.{size}"] = _measure(lambda t=text: split_text(t), repeat)
+
+    for size, chars in (("short", 2_000), ("long", 20_000)):
+        report = fixtures.make_text(chars, seed=7)
+        results[f"pdf.render.{size}"] = _measure(lambda r=report: report_text_to_pdf(r), repeat)
+    return results
+
+
+def _endpoint_benchmarks(documents: dict[str, Path], repeat: int) -> dict:
+    from fastapi.testclient import TestClient
+
+    from backend.main import app
+
+    results = {}
+    with TestClient(app) as client:
+        user_id = client.post("/api/login", json={"username": "bench"}).json()["user_id"]
+        docs_url = f"/api/users/{user_id}/documents"
+
+        def upload(name: str) -> int:
+            path = documents[name]
+            with open(path, "rb") as f:
+                r = client.post(docs_url, files={"file": (path.name, f, "application/octet-stream")})
+            r.raise_for_status()
+            return r.json()["document_id"]
+
+        for name in ("small.pdf", "medium.pdf", "medium.docx"):
+            results[f"endpoint.upload.{name}"] = _measure(lambda n=name: upload(n), repeat)
+
+        document_id = upload("medium.txt")
+
+        def analyze() -> None:
+            r = client.post("/api/analyze", json={"document_id": document_id, "analysis_type": "summary"})
+            r.raise_for_status()
+
+        results["endpoint.analyze.medium.txt"] = _measure(analyze, repeat)
+        results["endpoint.list_documents"] = _measure(lambda: client.get(docs_url).raise_for_status(), repeat)
+        results["endpoint.list_results"] = _measure(
+            lambda: client.get(f"/api/documents/{document_id}/results").raise_for_status(), repeat
+        )
+
+        def ai_magic() -> int:
+            r = client.post("/api/ai-magic", json={"document_id": document_id})
+            r.raise_for_status()
+            return r.json()["result_id"]
+
+        # Первый вызов строит отчёт, последующие — повторное использование сохранённого
+        report_id = ai_magic()
+        results["endpoint.ai_magic.stored"] = _measure(ai_magic, repeat)
+        results["endpoint.export_report.cached"] = _measure(
+            lambda: client.get(f"/api/results/{report_id}/report.pdf").raise_for_status(), repeat
+        )
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).resolve().parent.parent,
+            timeout=10,
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(current: dict, baseline: dict, threshold: float, min_delta_s: float) -> list[dict]:
+    """Регрессии: замеры, медиана которых выросла больше чем на threshold и на min_delta_s."""
+    regressions = []
+    for name, result in current["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if not base or not base.get("median_s"):
+            continue
+        new, old = result["median_s"], base["median_s"]
+        if new > old * (1 + threshold) and new - old >= min_delta_s:
+            regressions.append({"name": name, "baseline_s": old, "current_s": new, "ratio": new / old})
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("--output", type=Path, default=RESULTS_DIR / "latest.json")
+    parser.add_argument("--baseline", type=Path, help="JSON предыдущего запуска для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.25, help="допустимый рост медианы (0.25 = +25%%)")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0)
+    parser.add_argument("--fail-on-regression", action="store_true", help="код выхода 1 при регрессиях")
+    parser.add_argument("--skip-endpoints", action="store_true")
+    args = parser.parse_args()
+
+    sandbox = Path(tempfile.mkdtemp(prefix="docmind-bench-"))
+    _prepare_environment(sandbox)
+    _install_llm_stub()
+    _isolate_storage(sandbox)
+    try:
+        documents = fixtures.generate(sandbox / "documents")
+        results = _stage_benchmarks(documents, args.repeat)
+        if not args.skip_endpoints:
+            results.update(_endpoint_benchmarks(documents, args.repeat))
+    finally:
+        shutil.rmtree(sandbox, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    print(f"{'замер':<40}{'медиана, мс':>13}{'p95, мс':>11}")
+    for name, r in results.items():
+        print(f"{name:<40}{r['median_s'] * 1000:>13.2f}{r['p95_s'] * 1000:>11.2f}")
+    print(f"\nРезультат: {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.threshold, args.min_delta_ms / 1000)
+        if regressions:
+            print(f"\nРегрессии (порог +{args.threshold:.0%}) относительно {baseline['meta'].get('commit')}:")
+            for r in regressions:
+                print(f"  {r['name']:<38}{r['baseline_s'] * 1000:>9.2f} -> {r['current_s'] * 1000:.2f} мс (x{r['ratio']:.2f})")
+            if args.fail_on_regression:
+                sys.exit(1)
+        else:
+            print(f"\nРегрессий нет (порог +{args.threshold:.0%}).")
+
+
+if __name__ == "__main__":
+    main()